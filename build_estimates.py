@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# ①〜④ の件数の事前推定ツール（アプリの入力欄の初期値になる）
+#
+# 使い方:
+#   python build_estimates.py --root C:\mix\images     # ローカルフォルダから
+#   python build_estimates.py                           # 画像リストシートの画像URLから
+#
+# 推定はプロセスプールで並列化し、COMMIT_EVERY 枚ごとに保存する。
+# 途中で止めても再実行で続きから（推定済みの画像は飛ばす。新しい画像だけ計算）。
+# 出力は .fusion_cache/count_estimates.sqlite。
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from fusion_images import image_sources
+from fusion_estimate import EstimateStore, estimate_source, ESTIMATE_DB
+from fusion_imagelist import IMAGE_SHEET_ID
+
+COMMIT_EVERY   = 200
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="①〜④ の件数を画像から推定して保存する")
+    ap.add_argument("--root", help="ローカル画像フォルダ（省略時は画像リストシートの画像URL）")
+    ap.add_argument("--sheet-id", default=IMAGE_SHEET_ID)
+    ap.add_argument("--credentials", help="サービスアカウント JSON（省略時は .streamlit/secrets.toml）")
+    ap.add_argument("--out", default=ESTIMATE_DB)
+    ap.add_argument("--workers", type=int, default=os.cpu_count())
+    ap.add_argument("--force", action="store_true", help="推定済みの画像も計算し直す")
+    args = ap.parse_args(argv)
+
+    t0 = time.time()
+    sources = image_sources(args.root, args.sheet_id, args.credentials)
+    store = EstimateStore(args.out)
+    done = set() if args.force else store.done_keys()
+    todo = [s for s in sources if (s[0], s[1]) not in done]
+    print(f"対象: {len(sources):,} 枚（未推定 {len(todo):,} 枚）")
+
+    batch, saved, failed = [], 0, 0
+    with ProcessPoolExecutor(max_workers=args.workers) as ex:
+        for (folder, name, _), counts in zip(todo, ex.map(estimate_source, [s[2] for s in todo], chunksize=16)):
+            if counts is None:
+                failed += 1
+                continue
+            batch.append(((folder, name), counts))
+            if len(batch) >= COMMIT_EVERY:
+                store.put_many(batch)
+                saved += len(batch)
+                batch = []
+                print(f"  {saved:,} / {len(todo):,} 枚（{time.time() - t0:.1f}s）")
+    if batch:
+        store.put_many(batch)
+        saved += len(batch)
+
+    print(f"推定: {saved:,} 枚 / 読めなかった画像 {failed:,} 枚 / 保存済み合計 {len(store):,} 枚")
+    print(f"保存: {args.out}（{time.time() - t0:.1f}s）")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
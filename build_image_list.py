@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+# 画像リストシートの一括作成・追記ツール
+#
+# 使い方:
+#   python build_image_list.py C:\mix\images --url-prefix https://storage.example.com/bucket/
+#   python build_image_list.py /mnt/bucket_mirror --hash --dry-run   # 内容が変わったファイルも数える
+#   python build_image_list.py C:\mix\images --index   # フォルダ順に並べ替えて索引シートも作る
+#
+# 画像フォルダ（ローカル or オブジェクトストレージのミラー）をスレッドプールで走査し、
+# 既存の画像リストと (フォルダ_norm, 画像ファイル名) で差分を取って、新規行だけを
+# まとめて append_rows する（chunk 行ずつ）。
+# --hash のときは既存行の SHA1（D 列）と比べ、同じ内容のファイルは触らず、内容が変わった・
+# SHA1 が未記入の行だけ D 列を書き換える。
+# --index のときは既存行 + 新規行をフォルダ_norm 順に並べ替えて一時シートに書き、
+# 画像フォルダ索引（フォルダ_norm -> 開始行・行数）と一緒に元のシートと入れ替える（アプリはフォルダ単位で読む）。
+
+import argparse
+import hashlib
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+import gspread
+import pandas as pd
+
+from fusion_images import scan_image_folder, SCAN_WORKERS
+from fusion_schema import image_cols, parse_table, norm_folder_series, concat_typed, drop_blank_keys
+from fusion_sheets import open_client, batch_get_safe, ensure_ws, append_rows_chunked, replace_ws
+from fusion_imagelist import IMAGE_SHEET_ID, IMAGE_WS, INDEX_WS, index_cols, sort_by_folder
+
+HASH_COL       = "SHA1"      # --hash 時に D 列へ書く（アプリは A:C しか読まない）
+UPLOAD_CHUNK   = 5000
+
+def file_sha1(path, bufsize=1 << 20):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        while chunk := f.read(bufsize):
+            h.update(chunk)
+    return h.hexdigest()
+
+def build_rows(root, url_prefix=None, with_hash=False, workers=SCAN_WORKERS):
+    """走査結果 -> 画像リストの行（フォルダ, 画像ファイル名, 画像URL[, SHA1]）の DataFrame"""
+    df = scan_image_folder(root, workers=workers)
+    paths = df["画像URL"].tolist()   # 走査直後はローカルの絶対パス
+    if with_hash:
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            df[HASH_COL] = list(ex.map(file_sha1, paths))
+    if url_prefix:
+        rel = [os.path.relpath(p, root).replace(os.sep, "/") for p in paths]
+        df["画像URL"] = [url_prefix.rstrip("/") + "/" + quote(r) for r in rel]
+    return df
+
+def existing_rows(image_sheet):
+    """既存の画像リスト（SHA1 列があれば含む。行列はシート上の行番号）。シートが無ければ空"""
+    try:
+        vals = batch_get_safe(image_sheet, [f"{IMAGE_WS}!A1:D"])
+    except gspread.exceptions.WorksheetNotFound:
+        vals = []
+    except gspread.exceptions.APIError as e:
+        # シートが無いときの範囲エラーだけ「空」とみなす（通信・権限エラーで全件を新規扱いにしない）
+        if "Unable to parse range" not in str(e):
+            raise
+        vals = []
+    values = vals[0] if vals else []
+    cols = image_cols + ([HASH_COL] if values and HASH_COL in [str(h).strip() for h in values[0]] else [])
+    # キー列が空の行も一度残して行番号を振る（SHA1 を書き換える位置に使う）
+    df, _ = parse_table(values, cols, IMAGE_WS, drop_bad_keys=False)
+    df["行"] = range(2, len(df) + 2)
+    df = drop_blank_keys(df, IMAGE_WS)
+    df["フォルダ_norm"] = norm_folder_series(df["フォルダ"])
+    return df
+
+def _keys(df):
+    return list(zip(df["フォルダ_norm"], df["画像ファイル名"]))
+
+def _stored_hashes(old):
+    if HASH_COL not in old.columns:
+        return pd.Series("", index=old.index, dtype=object)
+    return old[HASH_COL].astype(object).fillna("")
+
+def changed_hashes(old, df):
+    """既存行のうち SHA1 が走査結果と違う（内容が変わった・未記入の）行 -> [(シート行番号, SHA1)]"""
+    scanned = dict(zip(_keys(df), df[HASH_COL]))
+    out = []
+    for k, row, h in zip(_keys(old), old["行"], _stored_hashes(old)):
+        new_h = scanned.get(k)
+        if new_h is not None and new_h != h:
+            out.append((int(row), new_h))
+    return sorted(out)
+
+def update_hashes(ws, changed, chunk=UPLOAD_CHUNK):
+    """[(行番号, SHA1)] を D 列に書く（連続する行は1範囲にまとめ、chunk 範囲ずつ batch_update）"""
+    runs = []
+    for row, h in changed:
+        if runs and runs[-1][0] + len(runs[-1][1]) == row:
+            runs[-1][1].append([h])
+        else:
+            runs.append((row, [[h]]))
+    data = [{"range": f"D{row}:D{row + len(v) - 1}", "values": v} for row, v in runs]
+    for i in range(0, len(data), chunk):
+        ws.batch_update(data[i:i + chunk], value_input_option="RAW")
+
+def write_sorted(image_sheet, rows_df, cols):
+    """フォルダ_norm 順に並べ替えた画像リストと索引を一時シートに書き、両方まとめて入れ替える。戻り値は索引
+
+    書き込み中もアプリは元の画像リスト・索引を読める（clear してから書くと途中で空に見える）。
+    グリッドは「ヘッダー + 全行」ちょうどにする（後から追記されるとアプリが索引の古さに気付ける）。
+    """
+    sorted_df, index = sort_by_folder(rows_df)
+    replace_ws(image_sheet, [(IMAGE_WS, cols, sorted_df[cols].astype(object).fillna("").values.tolist()),
+                             (INDEX_WS, index_cols, index.to_rows())], chunk=UPLOAD_CHUNK)
+    return index
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="画像フォルダから画像リストシートを作成・追記する")
+    ap.add_argument("root", help="画像フォルダ（ローカル or オブジェクトストレージのミラー）")
+    ap.add_argument("--url-prefix", help="画像URL の接頭辞（省略時はローカルの絶対パス）")
+    ap.add_argument("--sheet-id", default=IMAGE_SHEET_ID)
+    ap.add_argument("--credentials", help="サービスアカウント JSON（省略時は .streamlit/secrets.toml）")
+    ap.add_argument("--hash", action="store_true",
+                    help=f"内容ハッシュ（{HASH_COL}）を D 列に書き、既存行は内容が変わったものだけ書き換える")
+    ap.add_argument("--workers", type=int, default=SCAN_WORKERS)
+    ap.add_argument("--dry-run", action="store_true", help="差分件数だけ表示してアップロードしない")
+    ap.add_argument("--index", action="store_true",
+                    help=f"フォルダ順に並べ替えて書き直し、{INDEX_WS} シートを作る（新規が無くても実行）")
+    args = ap.parse_args(argv)
+
+    t0 = time.time()
+    df = build_rows(args.root, args.url_prefix, args.hash, args.workers)
+    print(f"走査: {len(df):,} 枚 / {df['フォルダ'].nunique():,} フォルダ（{time.time() - t0:.1f}s）")
+
+    image_sheet = open_client(args.credentials).open_by_key(args.sheet_id)
+    old = existing_rows(image_sheet)
+    done = set(_keys(old))
+    new = df[[k not in done for k in _keys(df)]]
+    changed = changed_hashes(old, df) if args.hash else []
+    print(f"既存: {len(done):,} 行 / 新規: {len(new):,} 行"
+          + (f" / 内容変更・{HASH_COL} 未記入: {len(changed):,} 行" if args.hash else ""))
+    if args.dry_run or (new.empty and not changed and not args.index):
+        return 0
+
+    cols = image_cols + ([HASH_COL] if args.hash else [])
+    if args.index:
+        # 既存の SHA1 列は残す（今回 --hash で計算していない行は空欄）
+        cols = image_cols + ([HASH_COL] if args.hash or HASH_COL in old.columns else [])
+        keep = cols + ["フォルダ_norm"]
+        if args.hash:
+            scanned = dict(zip(_keys(df), df[HASH_COL]))
+            old[HASH_COL] = [scanned.get(k, h) for k, h in zip(_keys(old), _stored_hashes(old))]
+        index = write_sorted(image_sheet, concat_typed([old.reindex(columns=keep), new.reindex(columns=keep)]), cols)
+        print(f"並べ替えて書き直し: {index.total:,} 行 / 索引 {len(index):,} フォルダ（合計 {time.time() - t0:.1f}s）")
+        return 0
+    ws = ensure_ws(image_sheet, IMAGE_WS, cols)
+    if args.hash and ws.col_count < len(cols):
+        ws.resize(cols=len(cols))
+    if args.hash:
+        ws.update("D1", [[HASH_COL]])
+        update_hashes(ws, changed)
+        print(f"{HASH_COL} 書き換え: {len(changed):,} 行（同じ内容のファイルは {len(df) - len(new) - len(changed):,} 行）")
+    rows = new[cols].astype(object).values.tolist()
+    append_rows_chunked(ws, rows, chunk=UPLOAD_CHUNK)
+    print(f"アップロード: {len(rows):,} 行（{-(-len(rows) // UPLOAD_CHUNK)} 回の append_rows, 合計 {time.time() - t0:.1f}s）")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
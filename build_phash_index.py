@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# 重複画像インデックス（pHash / aHash）の作成ツール
+#
+# 使い方:
+#   python build_phash_index.py --root C:\mix\images          # ローカルフォルダから
+#   python build_phash_index.py                                # 画像リストシートの画像URLから
+#
+# ハッシュ計算はプロセスプールで並列化。既存インデックスにあるキーは再計算しない（差分のみ）。
+# 出力は .fusion_cache/phash_index.npz（アプリはあれば自動で読み込む）。
+# インデックスがあると重複画像は1枚しか出題されず、その回答をグループの他の画像にも使う
+# （シートには書かない。集計側で展開する。fusion_phash.py 参照）。
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from fusion_images import image_sources
+from fusion_phash import PhashIndex, hash_source, INDEX_PATH, MAX_DIST
+from fusion_imagelist import IMAGE_SHEET_ID
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="重複画像インデックス（知覚ハッシュ）を作成する")
+    ap.add_argument("--root", help="ローカル画像フォルダ（省略時は画像リストシートの画像URL）")
+    ap.add_argument("--sheet-id", default=IMAGE_SHEET_ID)
+    ap.add_argument("--credentials", help="サービスアカウント JSON（省略時は .streamlit/secrets.toml）")
+    ap.add_argument("--out", default=INDEX_PATH)
+    ap.add_argument("--max-dist", type=int, default=MAX_DIST,
+                    help="同一とみなすハミング距離（pHash。グループ内のどの2枚もこれ以下）")
+    ap.add_argument("--workers", type=int, default=os.cpu_count())
+    args = ap.parse_args(argv)
+
+    t0 = time.time()
+    sources = image_sources(args.root, args.sheet_id, args.credentials)
+
+    # 既存インデックスのハッシュを再利用
+    known = {}
+    old = PhashIndex.load(args.out)
+    if old is not None:
+        known = {(f, n): (p, a) for f, n, p, a in zip(old.folders, old.files, old.phashes, old.ahashes)}
+    todo = [s for s in sources if (s[0], s[1]) not in known]
+    print(f"対象: {len(sources):,} 枚（新規 {len(todo):,} 枚）")
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as ex:
+        for (folder, name, _), h in zip(todo, ex.map(hash_source, [s[2] for s in todo], chunksize=64)):
+            if h is None:
+                failed += 1
+                continue
+            known[(folder, name)] = h
+
+    keys = [(f, n) for f, n, _ in sources if (f, n) in known]
+    hashes = np.array([known[k] for k in keys], dtype=np.uint64).reshape(-1, 2)
+    index = PhashIndex([k[0] for k in keys], [k[1] for k in keys], hashes[:, 0], hashes[:, 1],
+                       max_dist=args.max_dist)
+    index.save(args.out)
+
+    dup = len(index.members())
+    n_groups = len(set(index.groups.tolist()))
+    print(f"インデックス: {len(index):,} 枚 / {n_groups:,} グループ（重複を含む画像 {dup:,} 枚, 読めなかった画像 {failed:,} 枚）")
+    print(f"保存: {args.out}（{time.time() - t0:.1f}s）")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+# タイルピラミッドの事前作成ツール
+#
+# 使い方:
+#   python build_tiles.py --root C:\mix\images     # ローカルフォルダから
+#   python build_tiles.py                           # 画像リストシートの画像URLから
+#
+# 作成済みの画像は飛ばす（途中で止めても再実行で続きから）。
+# 出力は .fusion_cache/tiles/（アプリの「タイル表示」が使う）。
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from fusion_images import image_sources, read_source
+from fusion_tiles import TileStore, TILE_DIR
+from fusion_imagelist import IMAGE_SHEET_ID
+
+
+def _build_one(args):
+    url, root = args
+    store = TileStore(root)
+    if store.meta(url) is not None:
+        return "skip"
+    try:
+        store.build(url, read_source(url))
+        return "ok"
+    except Exception:
+        return "error"
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="画像のタイルピラミッドを事前に作成する")
+    ap.add_argument("--root", help="ローカル画像フォルダ（省略時は画像リストシートの画像URL）")
+    ap.add_argument("--sheet-id", default=IMAGE_SHEET_ID)
+    ap.add_argument("--credentials", help="サービスアカウント JSON（省略時は .streamlit/secrets.toml）")
+    ap.add_argument("--out", default=TILE_DIR)
+    ap.add_argument("--workers", type=int, default=os.cpu_count())
+    args = ap.parse_args(argv)
+
+    t0 = time.time()
+    urls = [u for _, _, u in image_sources(args.root, args.sheet_id, args.credentials)]
+    counts = {"ok": 0, "skip": 0, "error": 0}
+    with ProcessPoolExecutor(max_workers=args.workers) as ex:
+        for status in ex.map(_build_one, [(u, args.out) for u in urls], chunksize=8):
+            counts[status] += 1
+    print(f"作成 {counts['ok']:,} / 作成済み {counts['skip']:,} / 失敗 {counts['error']:,}（{time.time() - t0:.1f}s）")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
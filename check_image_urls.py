@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# 画像URL の一括チェックツール（切れている・遅い URL を事前に見つける）
+#
+# 使い方:
+#   python check_image_urls.py                      # 画像リストシートの画像URL
+#   python check_image_urls.py --root C:\mix\images  # ローカルフォルダ
+#   python check_image_urls.py --workers 64 --list   # 問題のある URL を一覧表示
+#
+# 結果は .fusion_cache/url_status.sqlite に保存し、アプリは dead の画像を出題しない。
+# 前回の確認から時間が経っていない URL は飛ばす（状態ごとの間隔は fusion_urlcheck.RECHECK_SEC）。
+
+import argparse
+import sys
+import time
+
+from fusion_images import image_sources
+from fusion_urlcheck import UrlHealthChecker, URL_STATUS_DB, CHECK_WORKERS, CHECK_TIMEOUT
+from fusion_imagelist import IMAGE_SHEET_ID
+
+REPORT_EVERY   = 1000
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="画像リストの画像URL を並列に確認して状態を保存する")
+    ap.add_argument("--root", help="ローカル画像フォルダ（省略時は画像リストシートの画像URL）")
+    ap.add_argument("--sheet-id", default=IMAGE_SHEET_ID)
+    ap.add_argument("--credentials", help="サービスアカウント JSON（省略時は .streamlit/secrets.toml）")
+    ap.add_argument("--out", default=URL_STATUS_DB)
+    ap.add_argument("--workers", type=int, default=CHECK_WORKERS)
+    ap.add_argument("--timeout", type=float, default=CHECK_TIMEOUT)
+    ap.add_argument("--list", action="store_true", help="dead / slow / error の URL を表示する")
+    args = ap.parse_args(argv)
+
+    t0 = time.time()
+    sources = image_sources(args.root, args.sheet_id, args.credentials)
+    checker = UrlHealthChecker(args.out, workers=args.workers, timeout=args.timeout)
+    urls = [s[2] for s in sources]
+    done = [0]
+
+    def progress(url, row):
+        done[0] += 1
+        if done[0] % REPORT_EVERY == 0:
+            print(f"  {done[0]:,} 件（{time.time() - t0:.1f}s）")
+
+    n = checker.check_many(urls, progress)
+    print(f"対象: {len(urls):,} 件（今回確認 {n:,} 件, {time.time() - t0:.1f}s）")
+    print("状態: " + " / ".join(f"{k} {v:,}" for k, v in checker.stats().items() if k != "pending"))
+    if args.list:
+        names = {s[2]: f"{s[0]}/{s[1]}" for s in sources}
+        for url, r in sorted(checker.problems(urls).items(), key=lambda kv: kv[1]["state"]):
+            ms = "-" if r["latency_ms"] is None else f"{r['latency_ms']:.0f}ms"
+            print(f"  [{r['state']}] {names.get(url, url)}  {r['status'] or '-'} {ms} {r['error']}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+# 分析用スナップショット（Parquet）の書き出しツール
+#
+# 使い方:
+#   python export_snapshot.py                      # 画像リスト + 全ログシートの差分を書き出す
+#   python export_snapshot.py --only arai yamazaki
+#
+# 出力（hive 形式のパーティション。pd.read_parquet(ディレクトリ) でまとめて読める）:
+#   snapshot/画像リスト/date=YYYY-MM-DD/<ログ>_<開始行>-<終了行>.parquet
+#   snapshot/今回の評価/annotator=<回答者>/date=YYYY-MM-DD/<ログ>_<開始行>-<終了行>.parquet
+#   snapshot/スキップログ/annotator=<回答者>/date=...
+#   （今回の評価_packed の行は通常形式に戻して 今回の評価 に入れる。形式列で区別できる）
+#
+# 行に時刻が無いので date は「取り込んだ日」。シートごとの取得済み行数（ウォーターマーク）を
+# _watermarks.json に持ち、次回はその次の行からだけ読む（前回の最後の行も一緒に読み、内容が
+# 同じか確かめる）。重複削除・アーカイブで行数が減っていたり最後の行が変わっていたら全行を読み、
+# 既にスナップショットにある行と内容が同じ行を除いた行だけを足す（直した回答は足す）。
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from fusion_schema import image_cols, required_cols, skip_cols, parse_table, add_norm_col, NORM_COLS
+from fusion_sheets import open_client, batch_get_safe, fetch_grid_sizes, trim_row, _quote
+from fusion_dashboard import LOG_SHEETS
+from fusion_packed import PACKED_WS, packed_cols, unpack_values
+from fusion_imagelist import IMAGE_SHEET_ID
+
+SNAPSHOT_DIR   = os.environ.get("FUSION_SNAPSHOT_DIR", "snapshot")
+WATERMARKS     = "_watermarks.json"
+TABLES = {"画像リスト": ("C", image_cols), "今回の評価": ("I", required_cols), "スキップログ": ("F", skip_cols),
+          PACKED_WS: ("D", packed_cols)}
+OUT_TABLE = {PACKED_WS: "今回の評価"}   # 圧縮形式は通常形式に戻して 今回の評価 に書く
+
+def _content_cols(table_name):
+    """行の内容の比較に使う列（フォルダは正規化列。重複削除で正規化名に書き直されても同じ行とみなす）"""
+    src, dst = NORM_COLS[table_name]
+    return [dst if c == src else c for c in TABLES[table_name][1]]
+
+def _content_rows(df, cols):
+    return zip(*(df[c].astype(object).where(df[c].notna(), "").astype(str) for c in cols))
+
+def load_snapshot(table_name, root=SNAPSHOT_DIR, columns=None):
+    """スナップショットを1つの DataFrame として読む（分析用）"""
+    path = os.path.join(root, table_name)
+    if not os.path.isdir(path):
+        return pd.DataFrame(columns=columns)
+    return pd.read_parquet(path, columns=columns)
+
+def load_watermarks(root):
+    p = os.path.join(root, WATERMARKS)
+    if not os.path.exists(p):
+        return {}
+    with open(p, encoding="utf-8") as f:
+        return json.load(f)
+
+def save_watermarks(root, marks):
+    p = os.path.join(root, WATERMARKS)
+    tmp = p + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(marks, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, p)
+
+def write_partitions(df, table_name, label, part_name, root, date):
+    """回答者・日付でパーティション分けして書く。戻り値は書いたファイル数"""
+    base = os.path.join(root, table_name)
+    groups = [((), df)] if "回答者" not in df.columns else [
+        ((f"annotator={user}",), g) for user, g in df.groupby(df["回答者"].astype(object))
+    ]
+    for parts, g in groups:
+        out_dir = os.path.join(base, *parts, f"date={date}")
+        os.makedirs(out_dir, exist_ok=True)
+        # 同じ範囲の再実行（ウォーターマーク保存前に落ちた場合）は上書きになる
+        g.to_parquet(os.path.join(out_dir, f"{label}_{part_name}.parquet"), index=False)
+    return len(groups)
+
+def snapshot_sheet(gc, label, sheet_id, tables, marks, root, now):
+    """1スプレッドシート分：メタデータ1回 + 値の一括取得1回。戻り値は {テーブル: 追加行数}"""
+    sheet = gc.open_by_key(sheet_id)
+    grid = {g["title"]: g["rows"] for g in fetch_grid_sizes(sheet)}
+    sheet_marks = marks.setdefault(sheet_id, {})
+
+    plan = []
+    for name in tables:
+        if name not in grid:
+            continue
+        last_col = TABLES[name][0]
+        m = sheet_marks.get(name)
+        if m is None or grid[name] < m["rows"] + 1 or (m["rows"] and "last" not in m):
+            plan.append((name, True, f"{_quote(name)}!A1:{last_col}"))
+        elif m["rows"]:
+            # 前回の最後の行から読む（1行目で書き直しを検出する）
+            plan.append((name, False, f"{_quote(name)}!A{m['rows'] + 1}:{last_col}"))
+        elif grid[name] >= 2:
+            plan.append((name, False, f"{_quote(name)}!A2:{last_col}"))
+    vals = batch_get_safe(sheet, [p[2] for p in plan]) if plan else []
+
+    # 前回の最後の行が変わっていたシートは全行を読み直す（もう1回の一括取得）
+    reread = []
+    for i, ((name, is_full, _), v) in enumerate(zip(plan, vals)):
+        m = sheet_marks.get(name)
+        if is_full or not m["rows"]:
+            continue
+        if not v or trim_row(v[0]) != m["last"]:
+            reread.append(i)
+        else:
+            vals[i] = v[1:]
+    if reread:
+        again = batch_get_safe(sheet, [f"{_quote(plan[i][0])}!A1:{TABLES[plan[i][0]][0]}" for i in reread])
+        for i, v in zip(reread, again):
+            plan[i], vals[i] = (plan[i][0], True, None), v
+
+    date = time.strftime("%Y-%m-%d", time.localtime(now))
+    added = {}
+    for (name, is_full, _), v in zip(plan, vals):
+        cols = TABLES[name][1]
+        m = sheet_marks.get(name)
+        if is_full:
+            if not v:
+                continue
+            header, body = v[0], v[1:]
+        else:
+            header, body = m["header"], v
+        start = 0 if is_full else m["rows"]
+        end = start + len(body)
+
+        out_name = OUT_TABLE.get(name, name)
+        if name == PACKED_WS:
+            df, _ = parse_table(unpack_values([header] + body)[0], required_cols, out_name)
+        else:
+            df, _ = parse_table([header] + body, cols, name)
+        add_norm_col(df, out_name)
+        # カテゴリ型はファイルごとに辞書が違うので文字列で書く（ディレクトリ単位で読めるように）
+        for c in df.columns:
+            if isinstance(df[c].dtype, pd.CategoricalDtype):
+                df[c] = df[c].astype("string")
+        df["ログ"] = label
+        df["形式"] = "packed" if name == PACKED_WS else "rows"
+        df["取り込み日時"] = pd.Timestamp(now, unit="s")
+        part_name = f"{start + 1:08d}-{end:08d}"
+        if name == PACKED_WS:
+            part_name = "packed_" + part_name
+        if is_full and m is not None:
+            # 書き直されたシート：既に取り込んだのと同じ内容の行を除く（キーが同じでも
+            # 件数を直した回答は新しい行として足す）
+            cols = _content_cols(out_name)
+            old = load_snapshot(out_name, root, columns=cols + ["ログ"])
+            old = old[old["ログ"].astype(object) == label]
+            seen = set(_content_rows(old, cols)) if len(old) else set()
+            df = df[[r not in seen for r in _content_rows(df, cols)]]
+            part_name = f"{'packed_' if name == PACKED_WS else ''}resync{int(now)}"
+        if len(df):
+            write_partitions(df, out_name, label, part_name, root, date)
+        last = trim_row(body[-1]) if body else (m.get("last", []) if m is not None and not is_full else [])
+        sheet_marks[name] = {"rows": end, "header": [str(h).strip() for h in header], "last": last,
+                             "synced_at": now}
+        added[name] = len(df)
+    return added
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="画像リスト・評価ログを分析用の Parquet スナップショットに書き出す")
+    ap.add_argument("--out", default=SNAPSHOT_DIR)
+    ap.add_argument("--credentials", help="サービスアカウント JSON（省略時は .streamlit/secrets.toml）")
+    ap.add_argument("--image-sheet-id", default=IMAGE_SHEET_ID)
+    ap.add_argument("--only", nargs="*", help=f"対象のログシート（既定: すべて {list(LOG_SHEETS)}）")
+    args = ap.parse_args(argv)
+
+    t0 = time.time()
+    os.makedirs(args.out, exist_ok=True)
+    marks = load_watermarks(args.out)
+    gc = open_client(args.credentials)
+    jobs = [("images", args.image_sheet_id, ["画像リスト"])]
+    jobs += [(label, sid, ["今回の評価", PACKED_WS, "スキップログ"]) for label, sid in LOG_SHEETS.items()
+             if not args.only or label in args.only]
+
+    # シートごとに並列（ウォーターマークはシートIDごとに別キーなので競合しない）
+    with ThreadPoolExecutor(max_workers=len(jobs)) as ex:
+        futures = {label: ex.submit(snapshot_sheet, gc, label, sid, tables, marks, args.out, t0)
+                   for label, sid, tables in jobs}
+        failed = 0
+        for label, fut in futures.items():
+            try:
+                added = fut.result()
+                print(f"{label}: " + (", ".join(f"{k} +{v:,} 行" for k, v in added.items()) or "変更なし"))
+            except Exception as e:
+                failed += 1
+                print(f"{label}: 失敗 {e}")
+    save_watermarks(args.out, marks)
+    print(f"保存: {args.out}（{time.time() - t0:.1f}s）")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
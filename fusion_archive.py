@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+# 今回の評価 / スキップログ のホット/コールド分割
+#
+# 古い行（末尾 keep_recent 行より前）や、回答者ごとに完了したフォルダの行を
+# アーカイブ（別ワークシート or ローカル Parquet）へ移し、ホット側には残さない。
+# 今回の評価_packed（圧縮形式）の回答も同じ判定に含める。
+# 残り枚数の判定に必要な (回答者, 選択フォルダ_norm, 画像ファイル名) は
+# 「完了ダイジェスト」シートにフォルダ単位でまとめて保持する。
+
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from fusion_schema import TABLE_COLS, norm_folder_series
+from fusion_sheets import batch_get_safe, ensure_ws, append_rows_chunked, row_delete_requests, fetch_grid_sizes, trim_row, _quote
+from fusion_packed import PACKED_WS, unpack_values
+
+DIGEST_WS    = "完了ダイジェスト"
+digest_cols  = ["回答者", "種別", "選択フォルダ", "件数", "画像ファイル名一覧"]
+DIGEST_KIND  = {"今回の評価": "評価", "スキップログ": "スキップ"}
+DIGEST_SEP   = "\n"
+DIGEST_CELL_LIMIT = 40000   # 1セル 50,000 文字の上限に余裕を持たせる
+ARCHIVE_DIR  = os.environ.get("FUSION_ARCHIVE_DIR", "archive")
+ARCHIVE_SUFFIX = "_archive"
+
+# =========================
+# 完了ダイジェスト
+# =========================
+def build_digest_rows(df, table_name):
+    """アーカイブ対象行 -> ダイジェスト行（回答者×フォルダごとに画像名を連結）"""
+    kind = DIGEST_KIND[table_name]
+    rows = []
+    pairs = df[["回答者", "選択フォルダ_norm", "画像ファイル名"]].drop_duplicates()
+    for (user, folder), g in pairs.groupby(["回答者", "選択フォルダ_norm"], sort=True):
+        chunk, size = [], 0
+        for name in g["画像ファイル名"]:
+            if chunk and size + len(name) + 1 > DIGEST_CELL_LIMIT:
+                rows.append([user, kind, folder, len(chunk), DIGEST_SEP.join(chunk)])
+                chunk, size = [], 0
+            chunk.append(name)
+            size += len(name) + 1
+        if chunk:
+            rows.append([user, kind, folder, len(chunk), DIGEST_SEP.join(chunk)])
+    return rows
+
+def expand_digest(values):
+    """ダイジェストの値配列 -> (回答者, 種別, 選択フォルダ_norm, 画像ファイル名) の DataFrame"""
+    out_cols = ["回答者", "種別", "選択フォルダ_norm", "画像ファイル名"]
+    if not values or len(values) < 2:
+        return pd.DataFrame({c: pd.Series(dtype="category" if c != "画像ファイル名" else object) for c in out_cols})
+    width = len(digest_cols)
+    body = pd.DataFrame([(r + [""] * width)[:width] for r in values[1:]], columns=digest_cols)
+    body["画像ファイル名"] = body["画像ファイル名一覧"].str.split(DIGEST_SEP)
+    body = body.explode("画像ファイル名", ignore_index=True)
+    body = body[body["画像ファイル名"].fillna("") != ""]
+    out = pd.DataFrame({
+        "回答者": body["回答者"].astype("category"),
+        "種別": body["種別"].astype("category"),
+        "選択フォルダ_norm": body["選択フォルダ"].astype("category"),
+        "画像ファイル名": body["画像ファイル名"].astype(object),
+    })
+    return out.reset_index(drop=True)
+
+def digest_pairs(archived_df, username):
+    """ダイジェストから (回答済みペア, スキップ済みペア) を返す（スキップは全回答者分）"""
+    if archived_df is None or archived_df.empty:
+        return set(), set()
+    ans = archived_df[(archived_df["種別"] == "評価") & (archived_df["回答者"] == username)]
+    skp = archived_df[archived_df["種別"] == "スキップ"]
+    return (set(zip(ans["選択フォルダ_norm"], ans["画像ファイル名"])),
+            set(zip(skp["選択フォルダ_norm"], skp["画像ファイル名"])))
+
+# =========================
+# アーカイブ対象の選定
+# =========================
+def completed_user_folders(image_df, eval_df, skip_df, archived_df=None):
+    """全画像が回答/スキップ済みの (回答者, フォルダ_norm) 集合"""
+    pairs = pd.DataFrame({"f": image_df["フォルダ_norm"].astype(object), "n": image_df["画像ファイル名"].astype(object)})
+    users = set(eval_df["回答者"].astype(object)) | set(skip_df["回答者"].astype(object))
+    skipped = set(zip(skip_df["選択フォルダ_norm"], skip_df["画像ファイル名"]))
+    done = set()
+    for user in users:
+        ans_arc, skp_arc = digest_pairs(archived_df, user)
+        u = eval_df[eval_df["回答者"] == user]
+        done_pairs = set(zip(u["選択フォルダ_norm"], u["画像ファイル名"])) | skipped | ans_arc | skp_arc
+        mark = pd.Series([p in done_pairs for p in zip(pairs["f"], pairs["n"])], index=pairs.index)
+        complete = mark.groupby(pairs["f"]).all()
+        done.update((user, f) for f in complete[complete].index)
+    return done
+
+def select_archive_rows(df, keep_recent=None, completed=None):
+    """アーカイブする行のマスク（古い行 = 末尾 keep_recent 行より前 / 完了フォルダの行）"""
+    mask = np.zeros(len(df), dtype=bool)
+    if keep_recent is not None:
+        mask[:max(len(df) - int(keep_recent), 0)] = True
+    if completed:
+        keys = pd.Series(list(zip(df["回答者"], df["選択フォルダ_norm"])), index=df.index, dtype=object)
+        mask |= keys.isin(completed).to_numpy()
+    return mask
+
+# =========================
+# 書き出し
+# =========================
+def write_archive(df, table_name, target="parquet", archive_sheet=None):
+    """アーカイブ行を Parquet（ローカル）または {table}_archive シートへ追記"""
+    cols = TABLE_COLS[table_name]
+    if df.empty:
+        return None
+    if target == "parquet":
+        out_dir = os.path.join(ARCHIVE_DIR, table_name)
+        os.makedirs(out_dir, exist_ok=True)
+        path = os.path.join(out_dir, time.strftime("%Y%m%d-%H%M%S") + ".parquet")
+        out = df[cols + ["選択フォルダ_norm"]].copy()
+        out["archived_at"] = pd.Timestamp.now()
+        out.to_parquet(path, index=False)
+        return path
+    ws = ensure_ws(archive_sheet, table_name + ARCHIVE_SUFFIX, cols)
+    append_rows_chunked(ws, df[cols].values.tolist())
+    return ws.title
+
+def _raw_frame(values, cols):
+    """書き戻し用の生の文字列 DataFrame（ヘッダーに合わせて列を揃える）"""
+    header, data = (values[0], values[1:]) if values else (cols, [])
+    width = len(header)
+    df = pd.DataFrame([(r + [""] * width)[:width] for r in data], columns=header)
+    df = df.reindex(columns=cols, fill_value="").astype(object)
+    df["選択フォルダ_norm"] = norm_folder_series(df["選択フォルダ"])
+    return df
+
+def _packed_frame(values):
+    """圧縮形式の値配列 -> 回答ごとの生の DataFrame（_row 列 = 圧縮シートのデータ行の位置）"""
+    cols = TABLE_COLS["今回の評価"]
+    frames = []
+    for pos, r in enumerate(values[1:] if values else []):
+        rows, _ = unpack_values([values[0], r])
+        df = _raw_frame(rows, cols)
+        df["_row"] = pos
+        frames.append(df)
+    if not frames:
+        df = _raw_frame([], cols)
+        df["_row"] = pd.Series(dtype=np.int64)
+        return df
+    return pd.concat(frames, ignore_index=True)
+
+def run_archive(log_sheet, image_df, keep_recent=None, completed_only=False,
+                target="parquet", archive_sheet=None):
+    """アーカイブ実行。戻り値は {テーブル名: (移動行数, 残り行数, 出力先)}
+
+    順序: アーカイブ書き出し → ダイジェスト追記 → ホット側から移した行だけを削除
+    （途中で失敗してもダイジェストとホットが重複するだけで、判定は崩れない）。
+    ホット側は書き直さず、読んだ行の位置を deleteDimension でまとめて消す（1回の batch_update）。
+    作業中に末尾へ追記された行は位置が変わらないので残る。削除の直前に対象シートを読み直し、
+    消す位置の行がすべて読んだときと同じか確かめる（重複削除等で書き換えられていたら削除せずに中止）。
+    中止後にもう一度実行しても、ダイジェストにある回答（同じ回答者・種別・フォルダ・画像）は
+    アーカイブに二重に書かず、ホット側から消すだけにする。
+    今回の評価_packed（圧縮形式）は回答に戻して完了判定に含め、全回答を移せる行だけを移す。
+    """
+    names = ["今回の評価", "スキップログ"]
+    ranges = {"今回の評価": "A1:I", "スキップログ": "A1:F", PACKED_WS: "A1:D"}
+    vals = batch_get_safe(log_sheet, [f"{_quote(n)}!{r}" for n, r in ranges.items()] + [f"{_quote(DIGEST_WS)}!A1:E"])
+    values = {name: vals[i] if len(vals) > i else [] for i, name in enumerate(ranges)}
+    raw = {name: _raw_frame(values[name], TABLE_COLS[name]) for name in names}
+    packed = _packed_frame(values[PACKED_WS])
+    archived_df = expand_digest(vals[3] if len(vals) > 3 else [])
+
+    completed = None
+    if completed_only:
+        eval_all = pd.concat([raw["今回の評価"], packed.drop(columns="_row")], ignore_index=True)
+        completed = completed_user_folders(image_df, eval_all, raw["スキップログ"], archived_df)
+
+    # 移す行（シートごとのデータ行の位置）と、アーカイブ・ダイジェストに書く回答
+    delete_pos, moved_rows = {}, {}
+    for name in names:
+        df = raw[name]
+        mask = select_archive_rows(df, keep_recent, completed)
+        delete_pos[name] = np.flatnonzero(mask).tolist()
+        moved_rows[name] = [df[mask]]
+    if len(packed):
+        ans_mask = pd.Series(select_archive_rows(packed, keep_recent, completed), index=packed.index)
+        whole = ans_mask.groupby(packed["_row"]).all()       # 1行の回答が全部移せる行だけ
+        rows = set(whole[whole].index)
+        delete_pos[PACKED_WS] = sorted(rows)
+        moved_rows["今回の評価"].append(packed[packed["_row"].isin(rows)].drop(columns="_row"))
+
+    # ダイジェストにある回答は前回（中止した実行など）アーカイブ済み
+    digested = set(zip(archived_df["回答者"].astype(object), archived_df["種別"].astype(object),
+                       archived_df["選択フォルダ_norm"].astype(object), archived_df["画像ファイル名"].astype(object)))
+
+    summary = {}
+    digest_ws = None
+    for name in names:
+        moved = pd.concat(moved_rows[name], ignore_index=True)
+        hot = len(raw[name]) - len(delete_pos[name])
+        if name == "今回の評価":
+            hot += len(packed) - int(packed["_row"].isin(delete_pos.get(PACKED_WS, [])).sum())
+        kind = DIGEST_KIND[name]
+        keys = zip(moved["回答者"], [kind] * len(moved), moved["選択フォルダ_norm"], moved["画像ファイル名"])
+        new = moved[[k not in digested for k in keys]]
+        if new.empty:
+            summary[name] = (len(moved), hot, None)
+            continue
+        dest = write_archive(new, name, target, archive_sheet or log_sheet)
+        if digest_ws is None:
+            digest_ws = ensure_ws(log_sheet, DIGEST_WS, digest_cols)
+        append_rows_chunked(digest_ws, build_digest_rows(new, name))
+        summary[name] = (len(moved), hot, dest)
+
+    targets = {n: p for n, p in delete_pos.items() if p}
+    if targets:
+        # 消す位置の行がすべて読んだときと同じか確かめてから消す（末尾への追記は構わない）
+        now = batch_get_safe(log_sheet, [f"{_quote(n)}!{ranges[n]}" for n in targets])
+        for (n, pos), v in zip(targets.items(), now):
+            changed = [p for p in pos if p + 1 >= len(v) or trim_row(v[p + 1]) != trim_row(values[n][p + 1])]
+            if changed or trim_row(v[0] if v else []) != trim_row(values[n][0]):
+                raise RuntimeError(f"{n}: 読み込み後に書き換えられたため、ホット側の行を削除せずに中止しました"
+                                   "（アーカイブ・ダイジェストは書き込み済み。もう一度実行すれば、"
+                                   "アーカイブ済みの回答は二重に書かずにホット側から消します）")
+        ids = {g["title"]: g["sheet_id"] for g in fetch_grid_sizes(log_sheet)}
+        reqs = [r for n, pos in targets.items() for r in row_delete_requests(ids[n], pos)]
+        log_sheet.batch_update({"requests": reqs})
+    return summary
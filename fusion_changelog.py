@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# 書き込み済み行のプロセス内共有（read-your-writes）
+#
+# append_df_to_sheet が成功するたびに行をここへ記録し、キャッシュ済みの
+# 今回の評価 / スキップログ に重ねて返す。シートの再読取は発生しない。
+
+import threading
+
+from fusion_schema import concat_typed
+
+
+class ChangeLog:
+    """append 済みの行をバージョン付きで保持し、ベーステーブルへマージする"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = 0
+        self._entries = []     # (version, table_name, typed_df)
+        self._overrides = {}   # table_name -> (version, typed_df)  ※重複削除などの全置換
+        self._merged = {}      # table_name -> ((base_token, version), merged_df)
+        self._seen_base = 0
+
+    def record(self, table_name, typed_df):
+        """追記された行を記録してバージョンを進める"""
+        with self._lock:
+            self.version += 1
+            self._entries.append((self.version, table_name, typed_df))
+            return self.version
+
+    def replace(self, table_name, typed_df):
+        """シート全体を書き換えた場合（重複削除など）。以後はこの内容をベースにする"""
+        with self._lock:
+            self.version += 1
+            self._overrides[table_name] = (self.version, typed_df)
+            self._entries = [e for e in self._entries if e[1] != table_name]
+            return self.version
+
+    def merged(self, table_name, base_df, base_version, base_token):
+        """base_df（base_version 時点で読み始めたもの）に、それ以降の変更を重ねて返す"""
+        with self._lock:
+            self._seen_base = max(self._seen_base, base_version)
+            ov = self._overrides.get(table_name)
+            if ov and ov[0] > base_version:
+                start_version, start_df, token = ov[0], ov[1], ("override", ov[0])
+            else:
+                start_version, start_df, token = base_version, base_df, base_token
+
+            cache_key = (token, self.version)
+            hit = self._merged.get(table_name)
+            if hit and hit[0] == cache_key:
+                return hit[1]
+
+            deltas = [df for v, t, df in self._entries if t == table_name and v > start_version]
+            out = concat_typed([start_df] + deltas) if deltas else start_df
+            self._merged[table_name] = (cache_key, out)
+            self._prune()
+            return out
+
+    def _prune(self):
+        # 最新のベースに取り込み済みの変更は不要
+        self._entries = [e for e in self._entries if e[0] > self._seen_base]
+        self._overrides = {t: ov for t, ov in self._overrides.items() if ov[0] > self._seen_base}
+
+    def stats(self):
+        with self._lock:
+            return {"version": self.version, "pending_entries": len(self._entries),
+                    "pending_rows": sum(len(e[2]) for e in self._entries)}
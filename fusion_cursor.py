@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+# 回答者ごとの評価カーソル（フォルダ順・位置・未保存バッファ）のサーバ側永続化
+#
+# 再接続・サーバ再起動後もログイン時に1回引くだけで続きから再開できる。
+# 未保存バッファはセッション（owner）ごとの行に置く。ログインしたセッションは同じ回答者の
+# バッファをすべて引き取り（行を消して自分の分にする）、引き取られたセッションは保存時・書き込み時に
+# 自分の行が無いことで気づいてその分を捨てる（同じ回答を2つのセッションが書かない）。
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+CURSOR_DB = os.path.join(os.environ.get("FUSION_CACHE_DIR", ".fusion_cache"), "cursors.sqlite")
+
+
+class CursorStore:
+    """username -> カーソル(JSON) の小さなローカルストア（SQLite）"""
+
+    def __init__(self, path=CURSOR_DB):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cursors (username TEXT PRIMARY KEY, payload TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS buffers (username TEXT NOT NULL, owner TEXT NOT NULL, payload TEXT NOT NULL, "
+            "updated_at REAL NOT NULL, PRIMARY KEY (username, owner))"
+        )
+        self._conn.commit()
+
+    def load(self, username):
+        with self._lock:
+            row = self._conn.execute("SELECT payload FROM cursors WHERE username = ?", (username,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, username, cursor):
+        payload = json.dumps(cursor, ensure_ascii=False, default=_json_default)
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO cursors (username, payload, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(username) DO UPDATE SET payload = excluded.payload, updated_at = excluded.updated_at",
+                (username, payload, time.time()),
+            )
+            self._conn.commit()
+
+    def save_buffer(self, username, owner, entries, expect_row=False):
+        """owner の未保存バッファを書く（空なら行を消す）。
+
+        expect_row=True（前に書いた行がまだあるはず）なのに無ければ、他のセッションに引き取られている。
+        そのときは書かずに False を返す。
+        """
+        payload = json.dumps(entries, ensure_ascii=False, default=_json_default)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            exists = self._conn.execute("SELECT 1 FROM buffers WHERE username = ? AND owner = ?",
+                                        (username, owner)).fetchone() is not None
+            if expect_row and not exists:
+                self._conn.commit()
+                return False
+            if entries:
+                self._conn.execute(
+                    "INSERT INTO buffers (username, owner, payload, updated_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(username, owner) DO UPDATE SET payload = excluded.payload, "
+                    "updated_at = excluded.updated_at", (username, owner, payload, time.time()))
+            else:
+                self._conn.execute("DELETE FROM buffers WHERE username = ? AND owner = ?", (username, owner))
+            self._conn.commit()
+            return True
+
+    def take_buffers(self, username, owner=None):
+        """未保存バッファを引き取る（行を消して返す）。
+
+        owner 指定時はその行だけ（書き込みの直前に自分の分を確保する。無ければ None）。
+        省略時は回答者の全セッションの分（ログイン時。古い形式でカーソルに入っている分も）。
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            if owner is not None:
+                row = self._conn.execute("SELECT payload FROM buffers WHERE username = ? AND owner = ?",
+                                         (username, owner)).fetchone()
+                self._conn.execute("DELETE FROM buffers WHERE username = ? AND owner = ?", (username, owner))
+                self._conn.commit()
+                return json.loads(row[0]) if row else None
+            rows = self._conn.execute("SELECT payload FROM buffers WHERE username = ? ORDER BY updated_at",
+                                      (username,)).fetchall()
+            self._conn.execute("DELETE FROM buffers WHERE username = ?", (username,))
+            entries = [e for (p,) in rows for e in json.loads(p)]
+            cur = self._conn.execute("SELECT payload FROM cursors WHERE username = ?", (username,)).fetchone()
+            if cur:
+                cursor = json.loads(cur[0])
+                legacy = cursor.pop("buffered_entries", None)
+                if legacy is not None:
+                    entries = list(legacy) + entries
+                    self._conn.execute("UPDATE cursors SET payload = ? WHERE username = ?",
+                                       (json.dumps(cursor, ensure_ascii=False), username))
+            self._conn.commit()
+            return entries
+
+    def clear(self, username):
+        with self._lock:
+            self._conn.execute("DELETE FROM cursors WHERE username = ?", (username,))
+            self._conn.commit()
+
+
+def _json_default(o):
+    # numpy の整数・pandas の NA などを JSON 化
+    if hasattr(o, "item"):
+        return o.item()
+    if o is None or str(o) == "<NA>":
+        return None
+    return str(o)
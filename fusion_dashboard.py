@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+# 全回答者の進捗ダッシュボード（複数のログシートを並列に差分同期）
+#
+# 回答者ごとにログシートが分かれているので、各シートの 今回の評価 / スキップログ /
+# 完了ダイジェスト を「前回読んだ行の次から」だけ取得して手元の表に足していく。
+# 差分の取得は前回の最後の行から読み、その行が前回と同じか確かめる（重複削除・アーカイブで
+# 書き直されていたら、行数が同じか増えていても最初から読み直す）。
+# 処理速度（枚/時）は同期のたびに増えた行数から求める（行に時刻が無いため）。
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from fusion_schema import required_cols, skip_cols, parse_table, add_norm_col, concat_typed
+from fusion_sheets import batch_get_safe, fetch_grid_sizes, trim_row, _quote
+from fusion_archive import DIGEST_WS, digest_cols, expand_digest
+from fusion_packed import PACKED_WS, packed_cols, unpack_values, log_formats
+
+# 各アプリの LOG_SHEET_ID（streamlit_mamiya.py / streamlit_arai1.py / streamlit_yamazaki1.py）
+LOG_SHEETS = {
+    "mamiya":   "17xAIAz6xIoM9eZHona-GyMMdM5zku4cRtUXCud5Rc5Y",
+    "arai":     "1X5lbBCYZg0ZaQT6LE_mB1Y69kh73rbSsn22h5r-Du8Y",
+    "yamazaki": "1enxtvK8528BrDxkvuPRcMlJwBHKtek75eQQSa0K2Xm8",
+}
+SYNC_TABLES = {"今回の評価": ("I", required_cols), "スキップログ": ("F", skip_cols), DIGEST_WS: ("E", digest_cols),
+               PACKED_WS: ("D", packed_cols)}
+REFRESH_SEC     = 60          # これより短い間隔の再同期は前回の結果を使う
+FULL_RESYNC_SEC = 6 * 3600    # 念のため、この間隔で全行を読み直す
+RATE_WINDOW_SEC = 3600        # 処理速度を測る直近の時間幅
+
+
+class LogSheetMirror:
+    """1つのログシートの手元の写し（追記された行だけを取得して足す）"""
+
+    def __init__(self, label, sheet_id):
+        self.label = label
+        self.sheet_id = sheet_id
+        self._sheet = None
+        self.header = {}       # ワークシート名 -> ヘッダー行
+        self.n_rows = {}       # ワークシート名 -> 取得済みのデータ行数
+        self.last_row = {}     # ワークシート名 -> 取得済みの最後のデータ行（書き直しの検出用）
+        self.frames = {}       # ワークシート名 -> 型付き DataFrame
+        self.events = deque()  # (時刻, 回答者, 増えた評価行数)
+        self.synced_at = None
+        self.full_at = 0.0
+        self.error = None
+
+    def _reset(self, ws_name):
+        self.header.pop(ws_name, None)
+        self.n_rows[ws_name] = 0
+        self.last_row.pop(ws_name, None)
+        self.frames.pop(ws_name, None)
+
+    def _append(self, ws_name, new_rows):
+        header = self.header[ws_name]
+        if ws_name == DIGEST_WS:
+            part = expand_digest([header] + new_rows)
+        elif ws_name == PACKED_WS:
+            # 圧縮形式は通常形式の評価行に戻す
+            part, _ = parse_table(unpack_values([header] + new_rows)[0], required_cols, "今回の評価")
+            add_norm_col(part, "今回の評価")
+        else:
+            part, _ = parse_table([header] + new_rows, SYNC_TABLES[ws_name][1], ws_name)
+            add_norm_col(part, ws_name)
+        old = self.frames.get(ws_name)
+        self.frames[ws_name] = part if old is None else concat_typed([old, part])
+        self.n_rows[ws_name] = self.n_rows.get(ws_name, 0) + len(new_rows)
+        self.last_row[ws_name] = trim_row(new_rows[-1])
+        return part
+
+    def sync(self, gc, now=None):
+        """メタデータ1回 + 値の一括取得1回で差分を取り込む"""
+        now = now or time.time()
+        if self._sheet is None:
+            self._sheet = gc.open_by_key(self.sheet_id)
+        grid = {g["title"]: g["rows"] for g in fetch_grid_sizes(self._sheet)}
+        full = now - self.full_at > FULL_RESYNC_SEC
+
+        plan = []
+        for ws_name, (last_col, _) in SYNC_TABLES.items():
+            if ws_name not in grid:
+                continue
+            seen = self.n_rows.get(ws_name, 0)
+            # 行数が減っていたら（重複削除・アーカイブで書き直された）最初から読み直す
+            if full or ws_name not in self.header or grid[ws_name] < seen + 1:
+                self._reset(ws_name)
+                plan.append((ws_name, True, f"{_quote(ws_name)}!A1:{last_col}"))
+            elif seen:
+                # 前回の最後の行から読む（1行目で書き直しを検出する）
+                plan.append((ws_name, False, f"{_quote(ws_name)}!A{seen + 1}:{last_col}"))
+            elif grid[ws_name] >= 2:
+                plan.append((ws_name, False, f"{_quote(ws_name)}!A2:{last_col}"))
+        vals = batch_get_safe(self._sheet, [p[2] for p in plan]) if plan else []
+
+        # 前回の最後の行が変わっていたシートは最初から読み直す（もう1回の一括取得）
+        reread = []
+        for i, ((ws_name, is_full, _), v) in enumerate(zip(plan, vals)):
+            if is_full or not self.n_rows.get(ws_name):
+                continue
+            if not v or trim_row(v[0]) != self.last_row.get(ws_name):
+                self._reset(ws_name)
+                reread.append(i)
+            else:
+                vals[i] = v[1:]
+        if reread:
+            again = batch_get_safe(self._sheet, [f"{_quote(plan[i][0])}!A1:{SYNC_TABLES[plan[i][0]][0]}"
+                                                 for i in reread])
+            for i, v in zip(reread, again):
+                plan[i], vals[i] = (plan[i][0], True, None), v
+
+        first_sync = self.synced_at is None
+        for (ws_name, is_full, _), v in zip(plan, vals):
+            if is_full:
+                if not v:
+                    continue
+                self.header[ws_name], v = [str(h).strip() for h in v[0]], v[1:]
+            if not v:
+                continue
+            part = self._append(ws_name, v)
+            # 差分で増えた評価行だけを処理速度に数える（初回・全件読み直しは除く）
+            if ws_name in ("今回の評価", PACKED_WS) and not is_full and not first_sync:
+                for user, n in part["回答者"].astype(object).value_counts().items():
+                    self.events.append((now, user, int(n)))
+        if full:
+            self.full_at = now
+        while self.events and self.events[0][0] < now - RATE_WINDOW_SEC:
+            self.events.popleft()
+        self.synced_at = now
+        self.error = None
+
+
+class ProgressDashboard:
+    """全ログシートの写しと、回答者 x フォルダの残り枚数・処理速度の集計"""
+
+    def __init__(self, sheets=LOG_SHEETS):
+        self.mirrors = {label: LogSheetMirror(label, sid) for label, sid in sheets.items()}
+        self._lock = threading.Lock()
+        self.refreshed_at = None
+        self.started_at = time.time()
+
+    def refresh(self, gc, force=False):
+        """全シートを並列に差分同期（REFRESH_SEC 以内の再呼び出しは何もしない）"""
+        with self._lock:
+            now = time.time()
+            if not force and self.refreshed_at and now - self.refreshed_at < REFRESH_SEC:
+                return False
+
+            def run(m):
+                try:
+                    m.sync(gc, now)
+                except Exception as e:   # 1シートの失敗で全体を止めない（前回の写しを使う）
+                    m.error = str(e)
+
+            with ThreadPoolExecutor(max_workers=len(self.mirrors)) as ex:
+                list(ex.map(run, self.mirrors.values()))
+            self.refreshed_at = now
+            return True
+
+    def tables(self):
+        """全シートを結合した (評価, スキップ, ダイジェスト)。どのシートの行かは「ログ」列"""
+        def cat(ws_names, empty):
+            frames = [m.frames[n].assign(ログ=label) for label, m in self.mirrors.items()
+                      for n in ws_names if n in m.frames]
+            return concat_typed(frames) if frames else empty.assign(ログ=pd.Series(dtype=object))
+        eval_df = cat(log_formats(),
+                      add_norm_col(parse_table([], required_cols, "今回の評価")[0], "今回の評価"))
+        skip_df = cat(("スキップログ",), add_norm_col(parse_table([], skip_cols, "スキップログ")[0], "スキップログ"))
+        return eval_df, skip_df, cat((DIGEST_WS,), expand_digest([]))
+
+    def throughput(self, now=None):
+        """回答者 -> 直近の処理速度（枚/時）。観測時間が短すぎる間は None"""
+        now = now or time.time()
+        span = min(RATE_WINDOW_SEC, now - self.started_at)
+        if span < REFRESH_SEC:
+            return {}
+        counts = {}
+        for m in self.mirrors.values():
+            for t, user, n in m.events:
+                if t >= now - RATE_WINDOW_SEC:
+                    counts[user] = counts.get(user, 0) + n
+        return {u: n * 3600 / span for u, n in counts.items()}
+
+    def errors(self):
+        return {label: m.error for label, m in self.mirrors.items() if m.error}
+
+
+def remaining_by_user(image_df, eval_df, skip_df, archived_df=None, dup_index=None):
+    """回答者 x フォルダ_norm の残り枚数（行 = フォルダ、列 = 回答者）
+
+    ログシート（「ログ」列。無ければ全体で1つ）ごとに、そのシートを使うアプリの compute_remaining と
+    同じ規則で数える（スキップ・アーカイブ済みスキップはそのシートの全員分を除く）。
+    同じ回答者が複数のシートにいれば、シートごとの残りを足す。
+    """
+    pairs = pd.Series(list(zip(image_df["フォルダ_norm"].astype(object), image_df["画像ファイル名"])),
+                      index=image_df.index, dtype=object)
+    frames = [f for f in (eval_df, skip_df, archived_df) if f is not None]
+    if not all("ログ" in f.columns for f in frames):
+        return _remaining_one(image_df, pairs, eval_df, skip_df, archived_df, dup_index)
+
+    def pick(f, log):
+        return None if f is None else f[f["ログ"].astype(object) == log]
+
+    logs = sorted(set().union(*(set(f["ログ"].astype(object)) for f in frames)))
+    parts = [_remaining_one(image_df, pairs, pick(eval_df, log), pick(skip_df, log), pick(archived_df, log),
+                            dup_index)
+             for log in logs]
+    parts = [p for p in parts if len(p.columns)]
+    if not parts:
+        return _remaining_one(image_df, pairs, eval_df.iloc[:0], skip_df.iloc[:0], None, dup_index)
+    df = pd.concat(parts, axis=1).T.groupby(level=0).sum().T.fillna(0).astype(int)
+    df.index.name = "フォルダ_norm"
+    return df
+
+def _remaining_one(image_df, pairs, eval_df, skip_df, archived_df, dup_index):
+    """1つのログシートの回答者 x フォルダ_norm の残り枚数"""
+    skipped = set(zip(skip_df["選択フォルダ_norm"], skip_df["画像ファイル名"]))
+    users = set(eval_df["回答者"].astype(object)) | set(skip_df["回答者"].astype(object))
+    arc_skip, arc_by_user = set(), {}
+    if archived_df is not None and not archived_df.empty:
+        s = archived_df[archived_df["種別"] == "スキップ"]
+        arc_skip = set(zip(s["選択フォルダ_norm"], s["画像ファイル名"]))
+        a = archived_df[archived_df["種別"] == "評価"]
+        users |= set(a["回答者"].astype(object))
+        for user, g in a.groupby("回答者", observed=True):
+            arc_by_user[user] = set(zip(g["選択フォルダ_norm"], g["画像ファイル名"]))
+
+    answered = {u: set(zip(g["選択フォルダ_norm"], g["画像ファイル名"]))
+                for u, g in eval_df.groupby("回答者", observed=True)}
+    out = {}
+    for user in sorted(users):
+        done = answered.get(user, set()) | skipped | arc_skip | arc_by_user.get(user, set())
+        if dup_index is not None:
+            done = dup_index.expand_done(done)
+        left = ~pairs.isin(done)
+        if dup_index is not None:
+            # 未評価の重複グループは1回だけ数える（compute_remaining と同じ）
+            idx = left.index[left]
+            left.loc[idx[dup_index.redundant(pairs.loc[idx].tolist())]] = False
+        out[user] = left.groupby(image_df["フォルダ_norm"].astype(object)).sum()
+    if not out:
+        return pd.DataFrame(index=pd.Index([], name="フォルダ_norm"))
+    df = pd.DataFrame(out).fillna(0).astype(int)
+    df.index.name = "フォルダ_norm"
+    return df
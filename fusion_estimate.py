@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+# ①〜④ の件数の自動推定（古典的な二値化 + 連結成分。GPU 不要）
+#
+# 背景差分 -> 大津の二値化 -> 連結成分 -> 成分ごとの面積・縦横比・外接矩形充填率で
+# 4分類する粗い推定。評価者が数え直す代わりに確認・修正するための初期値なので、
+# 精度よりも速さと安定性を優先している。
+#
+# 推定結果は (フォルダ_norm, 画像ファイル名) ごとに SQLite に保存（途中再開・差分実行用）。
+# アプリで推定値を初期値に入れた回答は、送信値が推定のままだったかを「推定値の採用」シートに残す
+# （確認せずに受け入れた推定を後から監査するため）。
+
+import io
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+from fusion_images import read_source, _as_8bit
+
+ESTIMATE_DB   = os.path.join(os.environ.get("FUSION_CACHE_DIR", ".fusion_cache"), "count_estimates.sqlite")
+ALGO_VERSION  = 2        # 推定方法を変えたら上げる（古い推定は再計算対象になる。2: 16bit 画像の正規化）
+WORK_SIDE     = 1024     # 推定は長辺この px に縮小して行う
+MIN_AREA      = 30       # これ未満の成分はゴミとして捨てる（縮小後 px）
+SINGLE_RATIO  = 1.6      # 面積が単独細胞の中央値のこの倍未満 -> ①未融合
+CONTACT_ASPECT = 1.6     # 大きな成分の外接矩形の縦横比がこれ以上 -> ②接触（細胞が並んでいる）
+FUSING_EXTENT  = 0.70    # 丸い成分の外接矩形充填率がこれ未満 -> ③融合中（いびつ）、以上 -> ④完全融合
+ESTIMATE_LOG_WS   = "推定値の採用"
+estimate_log_cols = ["回答者", "選択フォルダ", "画像ファイル名", "推定値", "採用"]   # 採用 = そのまま / 修正
+
+# =========================
+# 二値化・連結成分
+# =========================
+def otsu_threshold(a):
+    """0〜255 の配列に対する大津の閾値"""
+    hist = np.bincount(a.ravel(), minlength=256).astype(np.float64)
+    p = hist / max(1.0, hist.sum())
+    omega = np.cumsum(p)
+    mu = np.cumsum(p * np.arange(256))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sigma_b = (mu[-1] * omega - mu) ** 2 / (omega * (1 - omega))
+    if np.isnan(sigma_b).all():   # 一様な画像（分けようがない）
+        return int(a.max())
+    return int(np.nanargmax(sigma_b))
+
+def foreground_mask(img, work_side=WORK_SIDE):
+    """細胞らしい領域の二値マスク（背景の明るさムラを差し引いてから大津の二値化）"""
+    g = _as_8bit(img).convert("L")   # 16bit の TIFF は切り捨てずに伸ばしてから
+    if max(g.size) > work_side:
+        s = work_side / max(g.size)
+        g = g.resize((max(1, round(g.width * s)), max(1, round(g.height * s))), Image.Resampling.BOX)
+    bg = g.filter(ImageFilter.GaussianBlur(radius=max(16, max(g.size) // 8)))
+    diff = np.abs(np.asarray(g, dtype=np.int16) - np.asarray(bg, dtype=np.int16))
+    diff = np.clip(diff * (255.0 / max(1, diff.max())), 0, 255).astype(np.uint8)
+    mask = Image.fromarray(((diff > otsu_threshold(diff)) * 255).astype(np.uint8))
+    # 膜の輪郭を閉じてから小さなノイズを落とす（closing -> opening）
+    mask = mask.filter(ImageFilter.MaxFilter(3)).filter(ImageFilter.MinFilter(3))
+    mask = mask.filter(ImageFilter.MinFilter(3)).filter(ImageFilter.MaxFilter(3))
+    return np.asarray(mask) > 0
+
+def label_components(mask):
+    """8連結の連結成分 -> (面積, 外接矩形の幅, 高さ) の配列
+
+    行ごとのラン（連続する True 区間）を単位に union-find するので、画素ループは無い。
+    """
+    h, w = mask.shape
+    padded = np.zeros((h, w + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    d = np.diff(padded, axis=1)
+    ys, xs = np.nonzero(d == 1)          # ランの開始（行優先の順）
+    _, xe = np.nonzero(d == -1)          # ランの終了（排他的）
+    n = len(ys)
+    if n == 0:
+        return np.zeros((0, 3), dtype=np.int64)
+
+    parent = np.arange(n)
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    row_start = np.searchsorted(ys, np.arange(h + 1))
+    for y in range(1, h):
+        a0, a1 = row_start[y - 1], row_start[y]
+        b0, b1 = row_start[y], row_start[y + 1]
+        i, j = a0, b0
+        while i < a1 and j < b1:
+            # 8連結: 斜めに接するランも同じ成分
+            if xs[i] <= xe[j] and xs[j] <= xe[i]:
+                ri, rj = find(i), find(j)
+                if ri != rj:
+                    parent[max(ri, rj)] = min(ri, rj)
+            if xe[i] < xe[j]:
+                i += 1
+            else:
+                j += 1
+
+    roots = np.array([find(i) for i in range(n)])
+    _, lab = np.unique(roots, return_inverse=True)
+    k = lab.max() + 1
+    area = np.bincount(lab, weights=xe - xs, minlength=k).astype(np.int64)
+    x0 = np.full(k, w); np.minimum.at(x0, lab, xs)
+    x1 = np.zeros(k, dtype=np.int64); np.maximum.at(x1, lab, xe)
+    y0 = np.full(k, h); np.minimum.at(y0, lab, ys)
+    y1 = np.zeros(k, dtype=np.int64); np.maximum.at(y1, lab, ys + 1)
+    return np.stack([area, x1 - x0, y1 - y0], axis=1)
+
+# =========================
+# 4分類
+# =========================
+def classify_components(comps, min_area=MIN_AREA):
+    """成分 -> (①未融合, ②接触, ③融合中, ④完全融合) の件数"""
+    comps = comps[comps[:, 0] >= min_area]
+    if len(comps) == 0:
+        return (0, 0, 0, 0)
+    area = comps[:, 0].astype(np.float64)
+    # 単独細胞の面積 = 小さい方の半分の中央値（大きな融合塊に引っ張られないように）
+    single = np.median(np.sort(area)[: max(1, len(area) // 2)])
+    ratio = area / max(1.0, single)
+    side_w, side_h = comps[:, 1].astype(np.float64), comps[:, 2].astype(np.float64)
+    aspect = np.maximum(side_w, side_h) / np.maximum(1.0, np.minimum(side_w, side_h))
+    extent = area / np.maximum(1.0, side_w * side_h)
+    big = ratio >= SINGLE_RATIO
+    contact = big & (aspect >= CONTACT_ASPECT)
+    n1 = int((~big).sum())
+    n2 = int(contact.sum())
+    n3 = int((big & ~contact & (extent < FUSING_EXTENT)).sum())
+    n4 = int((big & ~contact & (extent >= FUSING_EXTENT)).sum())
+    return (min(n1, 1000), min(n2, 1000), min(n3, 1000), min(n4, 1000))
+
+def estimate_counts(img):
+    return classify_components(label_components(foreground_mask(img)))
+
+def estimate_source(src):
+    """ローカルパス or URL -> (①, ②, ③, ④)。読めなければ None（プロセスプールから呼ぶ）"""
+    try:
+        img = Image.open(io.BytesIO(read_source(src)))
+        img.load()
+        return estimate_counts(img)
+    except Exception:
+        return None
+
+
+# =========================
+# 推定結果の保存（SQLite）
+# =========================
+class EstimateStore:
+    """(フォルダ_norm, 画像ファイル名) -> 推定件数"""
+
+    def __init__(self, path=ESTIMATE_DB):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS estimates ("
+            "folder TEXT NOT NULL, file TEXT NOT NULL, n1 INTEGER, n2 INTEGER, n3 INTEGER, n4 INTEGER, "
+            "algo INTEGER NOT NULL, updated_at REAL NOT NULL, PRIMARY KEY (folder, file))"
+        )
+        self._conn.commit()
+
+    def get(self, folder, file):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT n1, n2, n3, n4 FROM estimates WHERE folder = ? AND file = ?", (folder, file)
+            ).fetchone()
+        return row
+
+    def done_keys(self, algo=ALGO_VERSION):
+        """現在の推定方法で計算済みのキー（差分実行用）"""
+        with self._lock:
+            rows = self._conn.execute("SELECT folder, file FROM estimates WHERE algo = ?", (algo,)).fetchall()
+        return set(rows)
+
+    def put_many(self, items, algo=ALGO_VERSION):
+        """items: [((フォルダ_norm, 画像ファイル名), (n1, n2, n3, n4)), ...]"""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO estimates (folder, file, n1, n2, n3, n4, algo, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(folder, file) DO UPDATE SET n1 = excluded.n1, n2 = excluded.n2, n3 = excluded.n3, "
+                "n4 = excluded.n4, algo = excluded.algo, updated_at = excluded.updated_at",
+                [(f, n, *c, algo, now) for (f, n), c in items],
+            )
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM estimates").fetchone()[0]
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+# 画像リストのフォルダ索引（フォルダ_norm -> 行範囲）と、フォルダ単位の遅延読み込み
+#
+# 画像リストをフォルダ_norm 順に並べておけば、1フォルダの行は連続した範囲になる。
+# 索引シート（画像フォルダ索引）にその開始行・行数を持たせ、アプリは索引だけを読んで
+# 「今のフォルダ」と「次のフォルダ」の範囲だけを取得する（build_image_list.py --index で作成）。
+# 手元に全件がある場合も、並べ替え済みなら iloc の切り出しだけで済む。
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from fusion_schema import image_cols, parse_table, add_norm_col, drop_blank_keys
+from fusion_sheets import batch_get_safe, fetch_grid_sizes, _quote
+
+IMAGE_SHEET_ID = "1gDGW6B3Sj9piVHN5vEvQ9JlMp2BjGhdnyL32R7MdF8I"   # 画像リストのスプレッドシート（アプリ・CLI 共通）
+IMAGE_WS      = "画像リスト"
+INDEX_WS      = "画像フォルダ索引"
+index_cols    = ["フォルダ_norm", "開始行", "行数"]   # 開始行はシート上の行番号（ヘッダーが1行目）
+FOLDER_CACHE  = 64      # 共有キャッシュに残すフォルダ数（LRU）
+
+
+class StaleIndexError(Exception):
+    """索引と画像リストの中身が合わない（並べ替え後に追記された等）"""
+
+
+class FolderIndex:
+    """フォルダ_norm -> (開始位置, 行数)。位置は並べ替え済みの表の 0 始まりの行番号"""
+
+    def __init__(self, folders, starts, counts):
+        self.folders = list(folders)
+        self.starts = [int(s) for s in starts]
+        self.counts = [int(n) for n in counts]
+        self._pos = {f: i for i, f in enumerate(self.folders)}
+
+    def __len__(self):
+        return len(self.folders)
+
+    def __contains__(self, folder):
+        return folder in self._pos
+
+    @property
+    def total(self):
+        return sum(self.counts)
+
+    def span(self, folder):
+        """(開始位置, 行数)。無いフォルダは (0, 0)"""
+        i = self._pos.get(folder)
+        return (0, 0) if i is None else (self.starts[i], self.counts[i])
+
+    def count(self, folder):
+        return self.span(folder)[1]
+
+    def slice(self, df, folder):
+        """並べ替え済みの表からフォルダの行だけを切り出す（O(1)）"""
+        start, n = self.span(folder)
+        return df.iloc[start:start + n]
+
+    @classmethod
+    def from_sorted(cls, df):
+        """フォルダ_norm 順に並んだ表の連続区間から索引を作る（並んでいなければ ValueError）"""
+        keys = df["フォルダ_norm"].astype(object).to_numpy()
+        if len(keys) == 0:
+            return cls([], [], [])
+        change = [0] + [i for i in range(1, len(keys)) if keys[i] != keys[i - 1]]
+        folders = [keys[i] for i in change]
+        if len(set(folders)) != len(folders):
+            raise ValueError("画像リストがフォルダ順に並んでいません")
+        counts = [b - a for a, b in zip(change, change[1:] + [len(keys)])]
+        return cls(folders, change, counts)
+
+    @classmethod
+    def from_values(cls, values):
+        """索引シートの値配列（ヘッダー付き）-> FolderIndex（開始行はシート行番号 -> 0 始まりに直す）"""
+        if not values:
+            return cls([], [], [])
+        pos = {str(h).strip(): i for i, h in enumerate(values[0])}
+        i_f, i_s, i_n = (pos[c] for c in index_cols)
+        folders, starts, counts = [], [], []
+        for r in values[1:]:
+            if len(r) <= max(i_f, i_s, i_n) or not r[i_f]:
+                continue
+            folders.append(r[i_f])
+            starts.append(int(r[i_s]) - 2)
+            counts.append(int(r[i_n]))
+        return cls(folders, starts, counts)
+
+    def to_rows(self):
+        """索引シートに書く行（ヘッダーなし）"""
+        return [[f, s + 2, n] for f, s, n in zip(self.folders, self.starts, self.counts)]
+
+
+def sort_by_folder(df):
+    """フォルダ_norm 順に並べ替えた表（フォルダ内の順序は元のまま）と索引"""
+    order = df["フォルダ_norm"].astype(object).fillna("")
+    out = df.iloc[order.argsort(kind="stable")].reset_index(drop=True)
+    return out, FolderIndex.from_sorted(out)
+
+
+class LazyImageList:
+    """索引を使って画像リストをフォルダ単位で取得（全セッション共有。取得済みのフォルダは LRU で保持）"""
+
+    def __init__(self, sheet, max_folders=FOLDER_CACHE):
+        self.sheet = sheet
+        self.max_folders = max_folders
+        self._rows = OrderedDict()     # フォルダ_norm -> DataFrame
+        self._pending = {}             # フォルダ_norm -> Future（同時取得の合流）
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=2)
+        self._full = None
+        self.fetches = 0
+        self.stale = False             # 一度でも範囲が合わなければ、プロセス内では索引を使わない
+
+    def load_index(self):
+        """索引を読む（メタデータ1回 + 値1回）。索引が無い・画像リストの行数と合わなければ None
+
+        build_image_list.py --index は画像リストのグリッドを「ヘッダー + 全行」ちょうどに
+        縮めるので、その後に追記されるとグリッド行数が増えて索引が古いと分かる。
+        """
+        if self.stale:
+            return None
+        grid = {g["title"]: g["rows"] for g in fetch_grid_sizes(self.sheet)}
+        if INDEX_WS not in grid or IMAGE_WS not in grid:
+            return None
+        vals = batch_get_safe(self.sheet, [f"{_quote(INDEX_WS)}!A1:C"])
+        index = FolderIndex.from_values(vals[0] if vals else [])
+        if not len(index) or grid[IMAGE_WS] != index.total + 1:
+            return None
+        with self._lock:
+            self._rows.clear()
+            self._full = None
+        return index
+
+    def _fetch(self, index, folder):
+        start, n = index.span(folder)
+        if n == 0:
+            return add_norm_col(parse_table([], image_cols, IMAGE_WS)[0], IMAGE_WS)
+        # 範囲の1行後ろも読み、隣のフォルダが混ざっていない・このフォルダが続いていないことを確かめる
+        rng = f"{_quote(IMAGE_WS)}!A{start + 2}:C{start + n + 2}"
+        vals = batch_get_safe(self.sheet, [f"{_quote(IMAGE_WS)}!A1:C1", rng])
+        self.fetches += 1
+        # キー列が空の行も残して読む（落とすと以降の行がずれる）。確認の後で除く
+        df, _ = parse_table([vals[0][0] if vals[0] else image_cols] + vals[1], image_cols, IMAGE_WS,
+                            drop_bad_keys=False)
+        add_norm_col(df, IMAGE_WS)
+        same = (df["フォルダ_norm"].astype(object) == folder).to_numpy()
+        if same[:n].sum() != n or (len(same) > n and same[n]):
+            self.stale = True
+            raise StaleIndexError(f"{folder}: 索引の行範囲と画像リストが一致しません")
+        return drop_blank_keys(df.iloc[:n].reset_index(drop=True), IMAGE_WS)
+
+    def rows(self, index, folder):
+        """フォルダの画像行（取得済みならキャッシュから。取得中なら合流して待つ）"""
+        with self._lock:
+            if self._full is not None:
+                return drop_blank_keys(index.slice(self._full, folder).reset_index(drop=True), IMAGE_WS)
+            if folder in self._rows:
+                self._rows.move_to_end(folder)
+                return self._rows[folder]
+            fut = self._pending.get(folder)
+            if fut is None:
+                fut = self._pending[folder] = self._pool.submit(self._fetch, index, folder)
+        try:
+            df = fut.result()
+        finally:
+            with self._lock:
+                self._pending.pop(folder, None)
+        with self._lock:
+            self._rows[folder] = df
+            self._rows.move_to_end(folder)
+            while len(self._rows) > self.max_folders:
+                self._rows.popitem(last=False)
+        return df
+
+    def prefetch(self, index, folder):
+        """次のフォルダを裏で取得しておく（失敗は表示時に取り直す）"""
+        with self._lock:
+            if folder is None or folder in self._rows or folder in self._pending or self._full is not None:
+                return
+            fut = self._pending[folder] = self._pool.submit(self._fetch, index, folder)
+
+        def done(f):
+            with self._lock:
+                self._pending.pop(folder, None)
+                if f.exception() is None:
+                    self._rows[folder] = f.result()
+                    while len(self._rows) > self.max_folders:
+                        self._rows.popitem(last=False)
+        fut.add_done_callback(done)
+
+    def full(self, index):
+        """全件（管理者向けの集計・アーカイブ用。1回だけ読んで保持）
+
+        rows() は以後この全件を索引の位置で切り出すので、読んだ時点で全フォルダの範囲が索引と
+        合うかを _fetch と同じように確かめる（合わなければ StaleIndexError）。
+        """
+        with self._lock:
+            if self._full is not None:
+                return drop_blank_keys(self._full, IMAGE_WS)
+        vals = batch_get_safe(self.sheet, [f"{_quote(IMAGE_WS)}!A1:C"])
+        # 索引の位置で切り出すので、キー列が空の行も残したまま保持する
+        df, _ = parse_table(vals[0] if vals else [], image_cols, IMAGE_WS, drop_bad_keys=False)
+        add_norm_col(df, IMAGE_WS)
+        self._check_full(index, df)
+        with self._lock:
+            self._full = df
+        return drop_blank_keys(df, IMAGE_WS)
+
+    def _check_full(self, index, df):
+        """全件の各行が、索引の範囲から決まるフォルダと一致するか（行数も索引の合計と同じか）"""
+        keys = df["フォルダ_norm"].astype(object).to_numpy()
+        expected = np.full(len(keys), None, dtype=object)
+        spans = list(zip(index.folders, index.starts, index.counts))
+        if len(keys) != index.total or any(s < 0 or s + n > len(keys) for _, s, n in spans):
+            self.stale = True
+            raise StaleIndexError(f"画像リスト {len(keys):,} 行 / 索引 {index.total:,} 行: 索引の行範囲と一致しません")
+        for f, s, n in spans:
+            expected[s:s + n] = f
+        wrong = np.flatnonzero(expected != keys)
+        if len(wrong):
+            self.stale = True
+            raise StaleIndexError(f"{wrong[0] + 2}行目: 索引の行範囲と画像リストが一致しません")
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+# ローカル画像フォルダ（顕微鏡PCなど）を画像リストとして使うためのバックエンド
+#
+# googlestart.py が渡すフォルダ引数を起点に並列 os.scandir で走査し、
+# 画像リストシートと同じ列（フォルダ, 画像ファイル名, 画像URL）の表を作る。
+# 画像URL にはローカルの絶対パスが入り、表示時はそのファイルを読む。
+
+import io
+import mmap
+import os
+import threading
+import time
+import urllib.request
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+from fusion_schema import image_cols, parse_table, norm_folder_series, time_from_folder_series
+
+IMAGE_EXTS   = (".png", ".jpg", ".jpeg", ".gif", ".bmp", ".webp", ".tif", ".tiff")
+SCAN_WORKERS = min(32, (os.cpu_count() or 4) * 4)
+
+def _walk(root, rel):
+    """rel 以下を再帰的に走査して (フォルダ, 画像ファイル名, 絶対パス) を返す"""
+    out, stack = [], [rel]
+    while stack:
+        cur = stack.pop()
+        try:
+            with os.scandir(os.path.join(root, cur) if cur else root) as it:
+                for e in it:
+                    if e.name.startswith("."):
+                        continue
+                    if e.is_dir(follow_symlinks=False):
+                        stack.append(f"{cur}/{e.name}" if cur else e.name)
+                    elif e.name.lower().endswith(IMAGE_EXTS) and e.is_file():
+                        out.append((cur, e.name, os.path.abspath(e.path)))
+        except OSError:
+            continue
+    return out
+
+def scan_image_folder(root, workers=SCAN_WORKERS):
+    """root 以下の画像を走査 -> image_cols + 時間 + フォルダ_norm の DataFrame
+
+    直下のサブフォルダ単位でスレッドに分けて os.scandir する（NAS/ネットワークドライブでも並列に効く）。
+    """
+    root = os.path.abspath(root)
+    top_dirs, rows = [], []
+    with os.scandir(root) as it:
+        for e in it:
+            if e.name.startswith("."):
+                continue
+            if e.is_dir(follow_symlinks=False):
+                top_dirs.append(e.name)
+            elif e.name.lower().endswith(IMAGE_EXTS) and e.is_file():
+                rows.append(("", e.name, os.path.abspath(e.path)))
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as ex:
+        for part in ex.map(lambda d: _walk(root, d), top_dirs):
+            rows.extend(part)
+
+    rows.sort()
+    df = pd.DataFrame(rows, columns=image_cols)
+    df["フォルダ"] = df["フォルダ"].astype("category")
+    df["画像ファイル名"] = df["画像ファイル名"].astype(object)
+    df["画像URL"] = df["画像URL"].astype(object)
+    df["時間"] = time_from_folder_series(df["フォルダ"])
+    df["フォルダ_norm"] = norm_folder_series(df["フォルダ"])
+    return df
+
+def is_local_path(url):
+    return isinstance(url, str) and not url.startswith(("http://", "https://")) and os.path.isfile(url)
+
+def image_sources(root=None, sheet_id=None, credentials=None):
+    """オフライン処理用の (フォルダ_norm, 画像ファイル名, 画像URL) リスト（ローカルフォルダ or 画像リストシート）"""
+    if root:
+        df = scan_image_folder(root)
+    else:
+        from fusion_sheets import open_client, batch_get_safe
+        sheet = open_client(credentials).open_by_key(sheet_id)
+        vals = batch_get_safe(sheet, ["画像リスト!A1:C"])
+        df, _ = parse_table(vals[0] if vals else [], image_cols, "画像リスト")
+        df["フォルダ_norm"] = norm_folder_series(df["フォルダ"])
+    return list(zip(df["フォルダ_norm"].astype(object), df["画像ファイル名"], df["画像URL"]))
+
+def read_source(src, timeout=30):
+    """ローカルパス or URL の生バイト列"""
+    if src.startswith(("http://", "https://")):
+        with urllib.request.urlopen(src, timeout=timeout) as r:
+            return r.read()
+    with open(src, "rb") as f:
+        return f.read()
+
+
+class MmapImageReader:
+    """画像ファイルを mmap で開いて保持（開いたままにする数は max_open まで・LRU）
+
+    SharedImageCache から追い出された画像を読み直すときに効く（20 ファイルの再読込で
+    1MB: 0.17 -> 0.06 ms, 8MB: 1.23 -> 0.94 ms, 48MB: 35.7 -> 29.6 ms/ファイル。初回は普通の read と同等）。
+    """
+
+    def __init__(self, max_open=256):
+        self.max_open = max_open
+        self._maps = OrderedDict()   # path -> (file, mmap)
+        self._lock = threading.Lock()
+
+    def read(self, path):
+        with self._lock:
+            hit = self._maps.get(path)
+            if hit is not None:
+                self._maps.move_to_end(path)
+                return hit[1][:]
+            f = open(path, "rb")
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:   # 空ファイル
+                f.close()
+                return b""
+            self._maps[path] = (f, mm)
+            while len(self._maps) > self.max_open:
+                _, (old_f, old_mm) = self._maps.popitem(last=False)
+                old_mm.close()
+                old_f.close()
+            return mm[:]
+
+
+# =========================
+# 全セッション共有の画像キャッシュ（デコード・再エンコード済み）
+# =========================
+IMAGE_CACHE_BYTES = int(os.environ.get("FUSION_IMAGE_CACHE_MB", "512")) * 1024 * 1024
+FETCH_TIMEOUT     = 20
+FAILURE_TTL       = 60     # 取得・デコードに失敗した URL はこの秒数だけ再取得しない（再実行ごとに待たない）
+
+def _to_8bit(img):
+    """16bit / 32bit 整数・浮動小数の画像（顕微鏡の TIFF 等）-> 8bit グレースケール
+
+    PIL の convert は上位ビットを切り捨てて真っ白/真っ黒になるので、値の 0.5〜99.5 パーセンタイルを
+    0〜255 に伸ばす（外れ値の画素で全体が暗くならないように）。
+    """
+    a = np.asarray(img, dtype=np.float64)
+    finite = a[np.isfinite(a)]
+    if finite.size == 0:
+        return Image.new("L", img.size)
+    lo, hi = np.percentile(finite, [0.5, 99.5])
+    if hi <= lo:
+        lo, hi = float(finite.min()), float(finite.max())
+    scaled = (np.nan_to_num(a, nan=lo) - lo) * (255.0 / (hi - lo)) if hi > lo else np.zeros_like(a)
+    return Image.fromarray(np.clip(scaled, 0, 255).astype(np.uint8), mode="L")
+
+HIGH_BIT_MODES = ("I;16", "I;16B", "I;16L", "I;16N", "I", "F")
+
+def _as_8bit(img):
+    """16bit 以上の画像だけ _to_8bit で伸ばす（それ以外はそのまま）。convert の前に通す"""
+    return _to_8bit(img) if img.mode in HIGH_BIT_MODES else img
+
+def reencode(data, quality=90):
+    """どの形式（TIFF 等）でもブラウザで表示できる JPEG/PNG に揃える
+
+    元が JPEG のときだけ JPEG に戻す（それ以外を JPEG にすると劣化するので PNG）。
+    """
+    img = Image.open(io.BytesIO(data))
+    src_format = img.format
+    img.load()
+    img = _as_8bit(img)
+    out = io.BytesIO()
+    if src_format == "JPEG" and img.mode in ("RGB", "L", "CMYK"):
+        if img.mode == "CMYK":
+            img = img.convert("RGB")
+        img.save(out, format="JPEG", quality=quality)
+        return out.getvalue()
+    if img.mode not in ("RGB", "RGBA", "L", "LA", "P", "1"):
+        img = img.convert("RGBA" if "A" in img.mode else "RGB")
+    img.save(out, format="PNG", optimize=False)
+    return out.getvalue()
+
+
+class SharedImageCache:
+    """画像URL -> 再エンコード済みバイト列 の LRU（バイト数上限）。
+
+    同じ URL の同時取得は1回にまとめる（single-flight）。ヒット率などは stats() で確認。
+    """
+
+    def __init__(self, max_bytes=IMAGE_CACHE_BYTES, reader=None, prefetch_workers=2):
+        self.max_bytes = max_bytes
+        self.reader = reader or MmapImageReader()
+        self._data = OrderedDict()     # url -> bytes
+        self._bytes = 0
+        self._inflight = {}            # url -> {"event": Event, "data": 取得結果}
+        self._failed = {}              # url -> 再取得してよい時刻（monotonic）
+        self._lock = threading.Lock()
+        self._session = None
+        self._prefetch = ThreadPoolExecutor(max_workers=prefetch_workers)
+        self.hits = self.misses = self.coalesced = self.evictions = self.errors = self.failed_hits = 0
+
+    def _fetch(self, url):
+        if url.startswith(("http://", "https://")):
+            if self._session is None:
+                import requests
+                self._session = requests.Session()
+            r = self._session.get(url, timeout=FETCH_TIMEOUT)
+            r.raise_for_status()
+            data = r.content
+        else:
+            data = self.reader.read(url)
+        return reencode(data)
+
+    def get(self, url):
+        """キャッシュから取得（無ければ1回だけ取得してデコード）。失敗時は None（FAILURE_TTL 秒は再取得しない）"""
+        with self._lock:
+            data = self._data.get(url)
+            if data is not None:
+                self._data.move_to_end(url)
+                self.hits += 1
+                return data
+            retry_at = self._failed.get(url)
+            if retry_at is not None:
+                if time.monotonic() < retry_at:
+                    self.failed_hits += 1
+                    return None
+                del self._failed[url]
+            flight = self._inflight.get(url)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[url] = {"event": threading.Event(), "data": None}
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            # 先行の取得を待って同じ結果を使う
+            flight["event"].wait(FETCH_TIMEOUT * 2)
+            return flight["data"]
+
+        try:
+            data = self._fetch(url)
+        except Exception:
+            data = None
+        with self._lock:
+            if data is None:
+                self.errors += 1
+                now = time.monotonic()
+                if len(self._failed) >= 10000:   # 期限切れを掃除
+                    self._failed = {u: t for u, t in self._failed.items() if t > now}
+                self._failed[url] = now + FAILURE_TTL
+            elif len(data) <= self.max_bytes:
+                self._data[url] = data
+                self._bytes += len(data)
+                while self._bytes > self.max_bytes:
+                    _, old = self._data.popitem(last=False)
+                    self._bytes -= len(old)
+                    self.evictions += 1
+            flight["data"] = data
+            self._inflight.pop(url, None)
+        flight["event"].set()
+        return data
+
+    def prefetch(self, url):
+        """次のカードなどをバックグラウンドで温める"""
+        with self._lock:
+            if url in self._data or url in self._inflight or self._failed.get(url, 0) > time.monotonic():
+                return
+        self._prefetch.submit(self.get, url)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {"items": len(self._data), "bytes": self._bytes, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses, "coalesced": self.coalesced,
+                    "evictions": self.evictions, "errors": self.errors, "failed_hits": self.failed_hits,
+                    "hit_rate": self.hits / total if total else 0.0}
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+# 融合キネティクス：条件 × 時間点ごとの融合率とブートストラップ信頼区間
+#
+# 画像1枚を再標本化の単位とし、Poisson ブートストラップ（各行に Poisson(1) の重みを
+# B 本ぶん与える）で比率の分布を作る。重み付き和だけを保持するので、新しい回答が
+# 来たらその行の分だけ足せばよい（全件の再計算は不要）。
+# 同じ画像の回答が後から来たら後の回答を使う（last-wins）。そのときは前の回答が入っていた
+# 条件×時間のグループだけを作り直す（ブートストラップ和からは行ごとの寄与を引けないため）。
+
+import os
+import re
+import threading
+
+import numpy as np
+import pandas as pd
+
+from fusion_schema import count_cols, time_from_folder_series, condition_from_folder_series
+
+N_BOOT     = 200          # ブートストラップ回数
+CI_LEVEL   = 0.95
+CHUNK_ROWS = 20_000       # 重み行列（行数 x N_BOOT）を作る単位
+GROUP_COLS = ["条件", "時間"]
+KEY_COLS   = ["回答者", "選択フォルダ_norm", "画像ファイル名"]
+
+# 比率 = 分子の列の和 / ①〜④の和（count_cols の位置で指定）
+RATIOS = {
+    "融合率":     (2, 3),      # (③+④) / 全体
+    "完全融合率": (3,),        # ④ / 全体
+    "接触率":     (1,),        # ② / 全体
+}
+
+# Poisson(1) の重みを乱数バイトの表引きで作る（rng.poisson より一桁速い。確率は 1/256 刻みで近似）
+_cdf = np.cumsum([np.exp(-1.0) / np.prod(np.arange(1, k + 1)) for k in range(8)])
+_POISSON_LUT = np.searchsorted(np.round(_cdf * 256), np.arange(256), side="right").astype(np.float32)
+
+def poisson_weights(rng, shape):
+    return _POISSON_LUT[rng.integers(0, 256, size=shape, dtype=np.uint8)]
+
+def minutes(t):
+    m = re.match(r"(\d+)min", str(t))
+    return int(m.group(1)) if m else np.nan
+
+
+class KineticsEngine:
+    """評価ログを追記分ずつ取り込み、(条件, 時間) ごとの和とブートストラップ和を持つ"""
+
+    def __init__(self, n_boot=N_BOOT, seed=0):
+        self.n_boot = n_boot
+        self._dup_index = None
+        self._rng = np.random.default_rng(seed)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._groups = {}                                     # (条件, 時間) -> 行番号
+        self._sums = np.zeros((0, len(count_cols)))            # 件数の和
+        self._n = np.zeros(0, dtype=np.int64)                  # 画像数
+        self._boot = np.zeros((0, self.n_boot, len(count_cols)), dtype=np.float64)
+        self._rows = {}                                       # キー -> (グループ, 件数)。最後の回答
+        self._n_rows = 0
+        self._tail = None
+
+    def _group_ids(self, conds, times):
+        ids = np.empty(len(conds), dtype=np.int64)
+        for i, k in enumerate(zip(conds, times)):
+            g = self._groups.get(k)
+            if g is None:
+                g = self._groups[k] = len(self._groups)
+            ids[i] = g
+        grow = len(self._groups) - len(self._n)
+        if grow > 0:
+            self._sums = np.vstack([self._sums, np.zeros((grow, len(count_cols)))])
+            self._n = np.r_[self._n, np.zeros(grow, dtype=np.int64)]
+            self._boot = np.concatenate([self._boot, np.zeros((grow, self.n_boot, len(count_cols)))])
+        return ids
+
+    def _accumulate(self, x, g):
+        """件数 x（行 x 4）をグループ g に足す（和・画像数・ブートストラップ和）"""
+        np.add.at(self._sums, g, x)
+        np.add.at(self._n, g, 1)
+        for a in range(0, len(x), CHUNK_ROWS):
+            xs, gs = x[a:a + CHUNK_ROWS], g[a:a + CHUNK_ROWS]
+            w = poisson_weights(self._rng, (len(xs), self.n_boot))
+            order = np.argsort(gs, kind="stable")
+            starts = np.flatnonzero(np.r_[True, gs[order][1:] != gs[order][:-1]])
+            for s, e in zip(starts, np.r_[starts[1:], len(order)]):
+                idx = order[s:e]
+                self._boot[gs[idx[0]]] += w[idx].T @ xs[idx]    # (B, 4)
+
+    def _rebuild(self, groups):
+        """グループを最後の回答だけから作り直す"""
+        idx = sorted(groups)
+        self._sums[idx] = 0
+        self._n[idx] = 0
+        self._boot[idx] = 0
+        members = [(g, x) for g, x in self._rows.values() if g in groups]
+        if members:
+            g, x = zip(*members)
+            self._accumulate(np.array(x, dtype=np.float32), np.array(g, dtype=np.int64))
+
+    def _add(self, df):
+        if df.empty:
+            return
+        keys = pd.Series(list(zip(*(df[c].astype(object) for c in KEY_COLS))), dtype=object)
+        last = ~keys.duplicated(keep="last").to_numpy()   # 同じ回答が複数行あれば最後の行
+        df, keys = df[last], keys[last].tolist()
+
+        x = df[count_cols].astype("float32").fillna(0).to_numpy()
+        ok = x.sum(axis=1) > 0
+        conds = condition_from_folder_series(df["選択フォルダ_norm"]).astype(object).to_numpy()
+        times = time_from_folder_series(df["選択フォルダ_norm"]).astype(object).to_numpy()
+        g = self._group_ids(conds, times)
+
+        # 新しいキーは足すだけ。既に見たキーは前の回答のグループ（と新しいグループ）を作り直す
+        dirty, fresh = set(), np.zeros(len(keys), dtype=bool)
+        for i, k in enumerate(keys):
+            prior = self._rows.get(k)
+            row = (int(g[i]), tuple(x[i].tolist())) if ok[i] else None
+            if prior == row:
+                continue
+            if prior is not None:
+                dirty.add(prior[0])
+                if row is not None:
+                    dirty.add(row[0])
+            else:
+                fresh[i] = True
+            if row is None:
+                self._rows.pop(k, None)
+            else:
+                self._rows[k] = row
+        add = fresh & ok & ~np.isin(g, list(dirty))
+        if add.any():
+            self._accumulate(x[add], g[add])
+        if dirty:
+            self._rebuild(dirty)
+
+    def update(self, eval_df, dup_index=None):
+        """eval_df（追記のみで伸びていく評価ログ）の未処理の行だけを取り込む。
+
+        前回処理した最後の行が変わっていたら（再読込・重複削除など）作り直す。
+        dup_index（PhashIndex）があれば、回答を重複画像にも使う（インデックスが変わったら作り直す）。
+        """
+        with self._lock:
+            n = len(eval_df)
+            tail = tuple(eval_df[c].iat[self._n_rows - 1] for c in KEY_COLS) if 0 < self._n_rows <= n else None
+            if n < self._n_rows or (self._n_rows and tail != self._tail) or dup_index is not self._dup_index:
+                self.reset()
+                self._dup_index = dup_index
+            if n > self._n_rows:
+                new = eval_df.iloc[self._n_rows:]
+                self._add(dup_index.expand_answers(new) if dup_index is not None else new)
+                self._n_rows = n
+                self._tail = tuple(eval_df[c].iat[n - 1] for c in KEY_COLS)
+
+    def table(self, level=CI_LEVEL):
+        """(条件, 時間) ごとの画像数・件数・比率と信頼区間の DataFrame（条件・分の順）"""
+        with self._lock:
+            keys = list(self._groups)
+            sums, n, boot = self._sums.copy(), self._n.copy(), self._boot.copy()
+        out = pd.DataFrame(keys, columns=GROUP_COLS)
+        out["分"] = [minutes(t) for t in out["時間"]]
+        out["画像数"] = n
+        for j, c in enumerate(count_cols):
+            out[c] = sums[:, j].astype(np.int64)
+        total = sums.sum(axis=1)
+        out["細胞数"] = total.astype(np.int64)
+        boot_total = boot.sum(axis=2)
+        lo_q, hi_q = (1 - level) / 2 * 100, (1 + level) / 2 * 100
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for name, cols in RATIOS.items():
+                out[name] = sums[:, cols].sum(axis=1) / total
+                r = boot[:, :, cols].sum(axis=2) / boot_total
+                if len(r):
+                    lo, hi = np.nanpercentile(r, [lo_q, hi_q], axis=1)
+                else:
+                    lo = hi = np.zeros(0)
+                out[f"{name}_下限"], out[f"{name}_上限"] = lo, hi
+        return out.sort_values(["条件", "分", "時間"], na_position="last").reset_index(drop=True)
+
+
+def export_table(df, path_or_buf, fmt=None):
+    """集計表を CSV（Excel で開ける UTF-8 BOM 付き）または Parquet で保存。
+
+    fmt 省略時はパスの拡張子で決める（バッファに書くときは fmt を指定）。
+    """
+    fmt = fmt or ("parquet" if str(path_or_buf).lower().endswith(".parquet") else "csv")
+    if fmt == "parquet":
+        df.to_parquet(path_or_buf, index=False)
+    else:
+        data = df.to_csv(index=False).encode("utf-8-sig")
+        if isinstance(path_or_buf, (str, os.PathLike)):
+            with open(path_or_buf, "wb") as f:
+                f.write(data)
+        else:
+            path_or_buf.write(data)
+    return path_or_buf
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+# セル使用量モニタ（メタデータ + 使用行数の読み取り・履歴・自動縮小）
+
+import json
+import os
+import threading
+import time
+
+from fusion_schema import TABLE_COLS
+from fusion_sheets import APPEND_CHUNK, CELL_LIMIT, fetch_grid_sizes, fetch_used_rows, resize_grids
+from fusion_archive import DIGEST_WS, digest_cols, ARCHIVE_SUFFIX
+from fusion_packed import PACKED_WS, packed_cols
+from fusion_estimate import ESTIMATE_LOG_WS, estimate_log_cols
+
+HISTORY_PATH  = os.path.join(os.environ.get("FUSION_CACHE_DIR", ".fusion_cache"), "cell_usage.jsonl")
+HISTORY_MAX   = 2000     # 履歴の最大行数
+SHRINK_MARGIN = APPEND_CHUNK   # 縮小後に残す空き行（読んでから縮めるまでの追記1回分より多く）
+
+def known_widths():
+    """縮小対象のワークシートと列数（スキーマが分かっているものだけ）"""
+    widths = {name: len(cols) for name, cols in TABLE_COLS.items()}
+    widths.update({name + ARCHIVE_SUFFIX: len(cols) for name, cols in TABLE_COLS.items()})
+    widths[DIGEST_WS] = len(digest_cols)
+    widths[PACKED_WS] = len(packed_cols)
+    widths[ESTIMATE_LOG_WS] = len(estimate_log_cols)
+    return widths
+
+
+class CellUsageMonitor:
+    """セル使用量を定期チェックし、閾値を超えたら既知シートの行を使用行 + 余白まで縮小する"""
+
+    def __init__(self, history_path=HISTORY_PATH, interval=1800, threshold_ratio=0.8):
+        self.history_path = history_path
+        self.interval = interval
+        self.threshold_cells = int(CELL_LIMIT * threshold_ratio)
+        self.last_check = 0.0
+        self.last_report = None
+        self._lock = threading.Lock()
+        self._running = False
+
+    def check(self, sheet, auto_shrink=False, force_shrink=False):
+        """サイズ取得（メタデータ1回 + 使用行数）→ 履歴追記 →（必要なら）一括リサイズ"""
+        sizes = fetch_grid_sizes(sheet)
+        widths = known_widths()
+        targets = [s["title"] for s in sizes if s["title"] in widths]
+        used = fetch_used_rows(sheet, targets, sizes)
+        total = sum(s["rows"] * s["cols"] for s in sizes)
+        report = {"ts": time.time(), "spreadsheet": getattr(sheet, "id", ""), "total_cells": total,
+                  "sheets": [dict(s, used_rows=used.get(s["title"])) for s in sizes], "shrunk": []}
+
+        if force_shrink or (auto_shrink and total >= self.threshold_cells):
+            # 縮めるのは行だけ（列は使用幅が分からないので触らない）。使用行数が取れなかったシートも触らない
+            plan = []
+            for s in sizes:
+                if s["title"] not in widths or used.get(s["title"]) is None:
+                    continue
+                rows = max(used[s["title"]], 1) + SHRINK_MARGIN
+                if rows < s["rows"]:
+                    plan.append((s["sheet_id"], rows, s["cols"], s["title"]))
+            if plan:
+                # 読んだ後に追記されたシートは縮めない（次回のチェックに回す）
+                now = fetch_used_rows(sheet, [p[3] for p in plan], sizes)
+                plan = [p for p in plan if now.get(p[3]) == used[p[3]]]
+            for sid, rows, cols, title in plan:
+                old_rows = next(s["rows"] for s in sizes if s["sheet_id"] == sid)
+                report["shrunk"].append(f"{title}: {old_rows} → {rows} 行")
+            plan = [p[:3] for p in plan]
+            resize_grids(sheet, plan)
+            if plan:
+                for s in sizes:
+                    for sid, rows, cols in plan:
+                        if s["sheet_id"] == sid:
+                            s["rows"], s["cols"] = rows, cols
+                report["total_cells"] = sum(s["rows"] * s["cols"] for s in sizes)
+
+        self._append_history(report)
+        self.last_check, self.last_report = report["ts"], report
+        return report
+
+    def maybe_check(self, sheet):
+        """interval 秒に1回だけ自動チェック（閾値超過で自動縮小）。
+
+        チェックは裏のスレッドで行い、呼び出した再実行は待たない（結果は last_report に入る）。
+        実行中に呼ばれても2本目は起動しない。失敗しても例外を出さない。戻り値は起動したら True
+        """
+        with self._lock:
+            if time.time() - self.last_check < self.interval or self._running:
+                return False
+            self.last_check = time.time()
+            self._running = True
+        threading.Thread(target=self._background_check, args=(sheet,), name="cell-usage-check",
+                         daemon=True).start()
+        return True
+
+    def _background_check(self, sheet):
+        try:
+            self.check(sheet, auto_shrink=True)
+        except Exception:
+            pass
+        finally:
+            with self._lock:
+                self._running = False
+
+    def _append_history(self, report):
+        os.makedirs(os.path.dirname(self.history_path) or ".", exist_ok=True)
+        line = {"ts": report["ts"], "spreadsheet": report["spreadsheet"], "total_cells": report["total_cells"],
+                "used_rows": {s["title"]: s["used_rows"] for s in report["sheets"] if s["used_rows"] is not None}}
+        with open(self.history_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(line, ensure_ascii=False) + "\n")
+        with open(self.history_path, encoding="utf-8") as f:
+            lines = f.readlines()
+        if len(lines) > HISTORY_MAX:
+            with open(self.history_path, "w", encoding="utf-8") as f:
+                f.writelines(lines[-HISTORY_MAX:])
+
+    def history(self, spreadsheet_id=None):
+        if not os.path.exists(self.history_path):
+            return []
+        with open(self.history_path, encoding="utf-8") as f:
+            rows = [json.loads(l) for l in f if l.strip()]
+        return [r for r in rows if spreadsheet_id is None or r.get("spreadsheet") == spreadsheet_id]
+
+    def growth_per_day(self, spreadsheet_id=None):
+        """履歴の最初と最後から、使用行数の増加ペース（行/日）をシート別に計算"""
+        hist = self.history(spreadsheet_id)
+        if len(hist) < 2 or hist[-1]["ts"] - hist[0]["ts"] < 60:
+            return {}
+        days = (hist[-1]["ts"] - hist[0]["ts"]) / 86400
+        first, last = hist[0]["used_rows"], hist[-1]["used_rows"]
+        return {t: (last[t] - first.get(t, 0)) / days for t in last}
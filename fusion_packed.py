@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# 今回の評価 の圧縮形式（1回の保存 = 1行）
+#
+# 通常形式は回答1件で 9 セル使う（親フォルダは常に "mix"、時間はフォルダ名から分かる）。
+# 圧縮形式では保存1回分の回答をまとめて JSON -> zlib -> base64 にし、
+# [回答者, 形式, 件数, データ] の 4 セルに入れる。読み込み時は通常形式の行に戻して
+# parse_table に渡すので、以降の処理はどちらの形式でも同じ。
+
+import base64
+import json
+import os
+import zlib
+
+from fusion_schema import required_cols, count_cols, time_from_folder
+
+PACKED_WS     = "今回の評価_packed"
+packed_cols   = ["回答者", "形式", "件数", "データ"]
+PACKED_FORMAT = "z1"           # zlib + JSON（列を辞書化）の第1版
+PAYLOAD_LIMIT = 45000          # 1セル 50,000 文字の上限に余裕を持たせる
+PACKED_LOG    = os.environ.get("FUSION_PACKED_LOG", "0") == "1"   # 1 で書き込みを圧縮形式にする
+MIXED_ISSUE   = ("今回の評価: 通常形式と圧縮形式（今回の評価_packed）の両方に回答があります。"
+                 "どちらが新しいか分からないため、重複クリーニングで1つの形式にまとめてください")
+
+# 通常形式の行には書き込み時刻がないので、2つの形式をまたいだ前後は分からない。
+# 混在させないよう、片方の形式にだけ回答があるうちはその形式に書き続け、
+# PACKED_LOG の切り替えは重複クリーニング（全回答を1つの形式に書き直す）で行う。
+
+def write_target(used):
+    """今回の評価 の追記先シート名。used は {シート名: 使用行数（ヘッダー込み）}"""
+    has_rows, has_packed = used.get("今回の評価", 0) > 1, used.get(PACKED_WS, 0) > 1
+    if has_rows != has_packed:
+        return PACKED_WS if has_packed else "今回の評価"
+    return PACKED_WS if PACKED_LOG else "今回の評価"
+
+def log_formats():
+    """今回の評価 の2形式のシート名を結合順（後ろの回答を新しいとみなす）に。
+
+    混在は PACKED_LOG を切り替えた直後にしか起きないので、現在の書き込み形式を後ろにする。
+    """
+    return ("今回の評価", PACKED_WS) if PACKED_LOG else (PACKED_WS, "今回の評価")
+
+def _encode(rows):
+    """通常形式の行（required_cols 順の dict）-> base64 文字列"""
+    users, parents, folders = {}, {}, {}
+    body, times = [], {}
+    for i, r in enumerate(rows):
+        u = users.setdefault(r["回答者"], len(users))
+        p = parents.setdefault(r["親フォルダ"], len(parents))
+        f = folders.setdefault(r["選択フォルダ"], len(folders))
+        if r["時間"] != time_from_folder(r["選択フォルダ"]):
+            times[i] = r["時間"]    # フォルダ名から導けない時間だけ残す
+        body.append([u, p, f, r["画像ファイル名"], *(r[c] for c in count_cols)])
+    doc = {"u": list(users), "p": list(parents), "f": list(folders), "r": body}
+    if times:
+        doc["t"] = times
+    raw = json.dumps(doc, ensure_ascii=False, separators=(",", ":"), default=_json_count).encode("utf-8")
+    return base64.urlsafe_b64encode(zlib.compress(raw, 9)).decode("ascii")
+
+def _json_count(o):
+    # numpy の整数・pandas の NA
+    if hasattr(o, "item"):
+        return o.item()
+    return None
+
+def pack_rows(df):
+    """今回の評価 の DataFrame -> 圧縮形式のシート行（セル上限を超える場合は分割）"""
+    rows = df[required_cols].to_dict("records")
+    out, stack = [], [rows] if rows else []
+    while stack:
+        part = stack.pop()
+        payload = _encode(part)
+        if len(payload) > PAYLOAD_LIMIT and len(part) > 1:
+            mid = len(part) // 2
+            stack.extend([part[mid:], part[:mid]])
+            continue
+        users = sorted({str(r["回答者"]) for r in part})
+        out.append([",".join(users), PACKED_FORMAT, len(part), payload])
+    return out
+
+def _decode(fmt, payload):
+    if fmt != PACKED_FORMAT:
+        raise ValueError(f"未対応の形式 {fmt!r}")
+    doc = json.loads(zlib.decompress(base64.urlsafe_b64decode(payload)).decode("utf-8"))
+    users, parents, folders, times = doc["u"], doc["p"], doc["f"], doc.get("t", {})
+    out = []
+    for i, (u, p, f, name, *counts) in enumerate(doc["r"]):
+        folder = folders[f]
+        t = times.get(str(i), time_from_folder(folder))
+        out.append([users[u], parents[p], t, folder, name, *("" if c is None else str(c) for c in counts)])
+    return out
+
+def unpack_values(values, table_name=PACKED_WS):
+    """圧縮形式の値配列 -> (通常形式の値配列（ヘッダー付き）, issues)
+
+    戻り値はそのまま parse_table(..., required_cols, "今回の評価") に渡せる。
+    """
+    out, issues = [required_cols], []
+    if not values:
+        return out, issues
+    header = [str(h).strip() for h in values[0]]
+    pos = {h: i for i, h in enumerate(header)}
+    i_fmt, i_data = pos.get("形式", 1), pos.get("データ", 3)
+    for n, r in enumerate(values[1:], start=2):
+        if len(r) <= max(i_fmt, i_data) or not r[i_data]:
+            continue
+        try:
+            out.extend(_decode(r[i_fmt], r[i_data]))
+        except Exception as e:
+            issues.append(f"{table_name}: {n}行目 復号できません（{e}）")
+    return out, issues
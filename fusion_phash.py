@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+# 知覚ハッシュ（pHash / aHash）による重複画像インデックス
+#
+# 同じ視野の画像が別フォルダ・別名で入っていても、ハッシュの近さでまとめて
+# 1回だけ評価すればよいようにする。インデックスは numpy 配列（npz）で保持。
+#
+# 重複相手の回答行はシートに書かない（実際に表示した1枚の行だけ）。集計では expand_answers で
+# 同じ回答者の回答をグループの他の画像にも使う（融合キネティクスはこれを使う）。
+
+import io
+import os
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+from fusion_images import read_source, _as_8bit
+
+INDEX_PATH = os.path.join(os.environ.get("FUSION_CACHE_DIR", ".fusion_cache"), "phash_index.npz")
+HASH_SIZE  = 8       # 8x8 = 64bit
+DCT_SIZE   = 32      # pHash の縮小サイズ
+MAX_DIST   = 4       # これ以下のハミング距離を「同じ画像」とみなす（pHash）
+AHASH_DIST = 8       # 確認用：aHash もこれ以下であること
+HASH_VERSION = 2     # ハッシュの計算方法を変えたら上げる（古いインデックスのハッシュは再計算）
+
+def _dct_matrix(n):
+    k = np.arange(n)
+    m = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n)) * np.sqrt(2 / n)
+    m[0] /= np.sqrt(2)
+    return m
+
+_DCT = _dct_matrix(DCT_SIZE)
+_BITS = (1 << np.arange(HASH_SIZE * HASH_SIZE, dtype=np.uint64)[::-1]).astype(np.uint64)
+
+def _pack(bits):
+    return int(np.bitwise_or.reduce(_BITS[bits.ravel()]) if bits.any() else 0)
+
+def ahash(img):
+    """平均ハッシュ：8x8 グレースケールの平均との大小"""
+    a = np.asarray(_as_8bit(img).convert("L").resize((HASH_SIZE, HASH_SIZE), Image.Resampling.BOX), dtype=np.float64)
+    return _pack(a > a.mean())
+
+def phash(img):
+    """DCT ハッシュ：32x32 の 2次元 DCT の低周波 8x8 の中央値との大小"""
+    a = np.asarray(_as_8bit(img).convert("L").resize((DCT_SIZE, DCT_SIZE), Image.Resampling.LANCZOS), dtype=np.float64)
+    low = (_DCT @ a @ _DCT.T)[:HASH_SIZE, :HASH_SIZE]
+    return _pack(low > np.median(low.ravel()[1:]))
+
+def hash_source(src):
+    """ローカルパス or URL -> (phash, ahash)。読めなければ None（プロセスプールから呼ぶ）"""
+    try:
+        img = Image.open(io.BytesIO(read_source(src)))
+        img.load()
+        return phash(img), ahash(img)
+    except Exception:
+        return None
+
+def popcount64(x):
+    x = np.asarray(x, dtype=np.uint64)
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(x).astype(np.int64)
+    return np.unpackbits(x.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1).reshape(x.shape)
+
+
+class PhashIndex:
+    """(フォルダ_norm, 画像ファイル名) ごとのハッシュと重複グループ（配列で保持）"""
+
+    def __init__(self, folders, files, phashes, ahashes, groups=None, max_dist=MAX_DIST):
+        self.folders = np.asarray(folders, dtype=object)
+        self.files   = np.asarray(files, dtype=object)
+        self.phashes = np.asarray(phashes, dtype=np.uint64)
+        self.ahashes = np.asarray(ahashes, dtype=np.uint64)
+        self.groups  = np.asarray(groups, dtype=np.int64) if groups is not None else self._cluster(max_dist)
+        self._members = None
+
+    def __len__(self):
+        return len(self.files)
+
+    # --- 近傍探索：64bit を (MAX_DIST+1) 分割し、どれか1ブロックが一致する組だけ比較（鳩の巣原理） ---
+    def _pairs(self, max_dist):
+        """pHash が max_dist 以下かつ aHash が AHASH_DIST 以下の組 (距離, i, j)"""
+        n = len(self.phashes)
+        found = set()
+        blocks = max_dist + 1
+        width = 64 // blocks
+        for b in range(blocks):
+            shift = np.uint64(b * width)
+            w = 64 - b * width if b == blocks - 1 else width
+            key = (self.phashes >> shift) & np.uint64((1 << w) - 1)
+            order = np.argsort(key, kind="stable")
+            sk = key[order]
+            starts = np.flatnonzero(np.r_[True, sk[1:] != sk[:-1]])
+            ends = np.r_[starts[1:], n]
+            for s, e in zip(starts, ends):
+                if e - s < 2:
+                    continue
+                idx = order[s:e]
+                h, ah = self.phashes[idx], self.ahashes[idx]
+                for a in range(0, len(idx), 1024):   # 巨大バケツでもメモリを抑える
+                    d = popcount64(h[a:a + 1024, None] ^ h[None, :])
+                    ok = (d <= max_dist) & (popcount64(ah[a:a + 1024, None] ^ ah[None, :]) <= AHASH_DIST)
+                    ii, jj = np.nonzero(ok)
+                    for i, j, dist in zip(idx[ii + a], idx[jj], d[ii, jj]):
+                        if i != j:
+                            found.add((int(dist), int(min(i, j)), int(max(i, j))))
+        return sorted(found)
+
+    def _cluster(self, max_dist):
+        """完全連結：グループ内のどの2枚も近い（鎖状に似ているだけの画像はまとめない）"""
+        n = len(self.phashes)
+        group = np.arange(n)
+        members = {}
+        for _, i, j in self._pairs(max_dist):   # 近い組から順にまとめる
+            gi, gj = group[i], group[j]
+            if gi == gj:
+                continue
+            a, b = members.get(gi, [gi]), members.get(gj, [gj])
+            pa, pb = self.phashes[a], self.phashes[b]
+            aa, ab = self.ahashes[a], self.ahashes[b]
+            if (popcount64(pa[:, None] ^ pb[None, :]).max() > max_dist
+                    or popcount64(aa[:, None] ^ ab[None, :]).max() > AHASH_DIST):
+                continue
+            keep, drop = min(gi, gj), max(gi, gj)
+            merged = sorted(a + b)
+            group[merged] = keep
+            members[keep] = merged
+            members.pop(drop, None)
+        return group.astype(np.int64)
+
+    def members(self):
+        """重複のあるキーだけ: (フォルダ_norm, 画像ファイル名) -> グループ全員のキー"""
+        if self._members is None:
+            by_group = {}
+            for g, f, n in zip(self.groups, self.folders, self.files):
+                by_group.setdefault(int(g), []).append((f, n))
+            self._members = {k: tuple(v) for v in by_group.values() if len(v) > 1 for k in v}
+        return self._members
+
+    def group_of(self, key):
+        m = self.members().get(key)
+        return m[0] if m else key
+
+    def expand_done(self, done_pairs):
+        """済みペアに、その重複相手もすべて加える（重複は1回評価すれば済み扱い）"""
+        mem = self.members()
+        extra = set()
+        for p in done_pairs:
+            if p in mem:
+                extra.update(mem[p])
+        return done_pairs | extra
+
+    def redundant(self, keys):
+        """キーの並びのうち、同じグループの2枚目以降（出題されない重複）なら True"""
+        if not self.members():
+            return np.zeros(len(keys), dtype=bool)
+        return np.asarray(_duplicated([self.group_of(k) for k in keys]), dtype=bool)
+
+    def extra_copies(self, done_pairs):
+        """未評価のグループの2枚目以降の枚数（フォルダごと）。残り枚数から引く分"""
+        counts = {}
+        for v in {m for m in self.members().values() if m[0] not in done_pairs}:
+            for f, _ in v[1:]:
+                counts[f] = counts.get(f, 0) + 1
+        return counts
+
+    def collapse(self, df, folder_col="フォルダ_norm", file_col="画像ファイル名"):
+        """キューの中で同じグループの2枚目以降を落とす（回答は expand_answers で共有する）"""
+        if not self.members():
+            return df
+        keep = ~self.redundant(list(zip(df[folder_col], df[file_col])))
+        return df[keep].reset_index(drop=True)
+
+    def expand_answers(self, df, folder_col="選択フォルダ_norm", file_col="画像ファイル名"):
+        """評価の行を同じグループの他の画像にも複製して足す（追記分ごとに呼べるよう末尾に足す）
+
+        同じ回答者がその画像自体にも回答していれば、そちらを使う（複製しない）。
+        """
+        mem = self.members()
+        if not mem or df.empty:
+            return df
+        keys = list(zip(df[folder_col].astype(object), df[file_col].astype(object)))
+        users = df["回答者"].astype(object).tolist()
+        own = set(zip(users, keys))
+        src, dst = [], []
+        for i, (u, k) in enumerate(zip(users, keys)):
+            for m in mem.get(k, ()):
+                if m != k and (u, m) not in own:
+                    src.append(i)
+                    dst.append(m)
+        if not src:
+            return df
+        extra = df.iloc[src].copy()
+        extra[folder_col] = [m[0] for m in dst]
+        extra[file_col] = [m[1] for m in dst]
+        if "選択フォルダ" in extra.columns and folder_col != "選択フォルダ":
+            extra["選択フォルダ"] = extra[folder_col]
+        return pd.concat([df.astype({c: object for c in (folder_col, file_col, "選択フォルダ") if c in df.columns}),
+                          extra], ignore_index=True)
+
+    def save(self, path=INDEX_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        np.savez_compressed(path, folders=self.folders.astype(str), files=self.files.astype(str),
+                            phashes=self.phashes, ahashes=self.ahashes, groups=self.groups,
+                            version=np.int64(HASH_VERSION))
+
+    @classmethod
+    def load(cls, path=INDEX_PATH):
+        if not os.path.exists(path):
+            return None
+        z = np.load(path, allow_pickle=False)
+        if "version" not in z or int(z["version"]) != HASH_VERSION:
+            return None   # 計算方法の違うハッシュ（作り直すまで使わない）
+        return cls(z["folders"].astype(object), z["files"].astype(object), z["phashes"], z["ahashes"], z["groups"])
+
+
+def _duplicated(values):
+    seen, out = set(), []
+    for v in values:
+        out.append(v in seen)
+        seen.add(v)
+    return out
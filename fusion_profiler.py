@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+# 遅い再実行のサンプリングプロファイル（本番の操作から重い箇所を探す）
+#
+# 有効にすると、再実行のあいだスクリプトのスレッドのスタックを一定間隔で記録し、
+# しきい値より時間のかかった再実行だけを .fusion_cache/profiles/ に保存する。
+# ファイルは collapsed stack 形式（1行 = 「フレーム;フレーム;… 回数」）なので、
+# flamegraph.pl・speedscope・inferno でそのままフレームグラフにできる。
+# 主な処理は stage() で囲み、スタックの先頭に [段階名] を付けて段階ごとの時間も残す。
+#
+# 再実行の終わりは、スクリプト（コールバックを含む）のフレームがスタックから消えたことで判定する
+# （st.stop / st.rerun / 例外のどれで終わっても追える）。終了時刻の誤差はサンプル間隔程度。
+
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+
+PROFILE_DIR  = os.path.join(os.environ.get("FUSION_CACHE_DIR", ".fusion_cache"), "profiles")
+PROFILE_MS   = int(os.environ.get("FUSION_PROFILE_MS", "0"))   # 0 = 無効（起動時から有効にするならしきい値 ms）
+SAMPLE_MS    = 5        # サンプル間隔
+MAX_PROFILES = 50       # 保存するファイル数の上限（古いものから消す）
+RECENT       = 200      # サイドバー用に覚えておく遅い再実行の数
+END_GRACE    = 3        # スクリプトのフレームがこの回数続けて見えなければ終了とみなす
+
+
+class _Capture:
+    """1回の再実行の記録"""
+
+    def __init__(self, script, label, callback=False):
+        self.script = script
+        self.label = label
+        self.callback = callback        # コールバック（スクリプト本体の前）から始まった
+        self.started = time.perf_counter()
+        self.started_at = time.time()
+        self.last_seen = self.started
+        self.missing = 0
+        self.stages = []                # 実行中の段階（入れ子）
+        self.stage_ms = Counter()
+        self.samples = Counter()
+
+
+class RerunProfiler:
+    """全セッション共有のサンプラー（計測中の再実行があるときだけ 1 スレッドで動く）"""
+
+    def __init__(self, out_dir=PROFILE_DIR, threshold_ms=PROFILE_MS, interval_ms=SAMPLE_MS, keep=MAX_PROFILES):
+        self.out_dir = out_dir
+        self.threshold_ms = threshold_ms
+        self.interval = interval_ms / 1000
+        self.keep = keep
+        self._captures = {}             # スレッド ID -> _Capture
+        self._recent = deque(maxlen=RECENT)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self.script = None
+        self.measured = 0
+        self.saved = 0
+
+    @property
+    def enabled(self):
+        return self.threshold_ms > 0
+
+    def configure(self, threshold_ms):
+        """しきい値（ms）を変える。0 で無効（計測中の再実行は捨てる）"""
+        self.threshold_ms = int(threshold_ms)
+        if not self.enabled:
+            with self._lock:
+                self._captures.clear()
+
+    # ---- 記録の開始・段階 ----
+    def begin(self, script, label=""):
+        """再実行の先頭で呼ぶ（script はアプリの __file__）。同じスレッドの前の再実行（st.rerun）はここで締める"""
+        if not self.enabled:
+            return
+        tid = threading.get_ident()
+        self.script = script
+        with self._lock:
+            cap = self._captures.get(tid)
+            if cap is not None and cap.callback:
+                cap.callback = False     # コールバックから続く本体：同じ再実行として記録を続ける
+                return
+            self._captures[tid] = _Capture(self.script, label)
+        if cap is not None:
+            self._finish(cap, time.perf_counter())
+        self._start_sampler()
+
+    def tag(self, label):
+        """実行中の再実行に名前（回答者等）を付ける"""
+        cap = self._captures.get(threading.get_ident())
+        if cap is not None:
+            cap.label = label
+
+    @contextmanager
+    def stage(self, name):
+        """処理の段階を囲む（時間を記録し、サンプルの先頭に [段階名] を付ける）。デコレータとしても使える"""
+        tid = threading.get_ident()
+        cap = self._captures.get(tid)
+        if cap is None and self.enabled and self.script:
+            # コールバック（スクリプト本体の前）の書き込み等：ここから記録を始め、本体の begin に引き継ぐ
+            cap = _Capture(self.script, "", callback=True)
+            with self._lock:
+                self._captures[tid] = cap
+            self._start_sampler()
+        if cap is None:
+            yield
+            return
+        cap.stages.append(name)
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            cap.stage_ms[name] += (time.perf_counter() - t0) * 1000
+            if cap.stages and cap.stages[-1] == name:
+                cap.stages.pop()
+
+    # ---- サンプラー ----
+    def _start_sampler(self):
+        self._wake.set()
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="rerun-profiler", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        me = threading.get_ident()
+        while True:
+            with self._lock:
+                idle = not self._captures
+            if idle:
+                self._wake.clear()
+                self._wake.wait(60)
+                continue
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            now = time.perf_counter()
+            done = []
+            with self._lock:
+                for tid, cap in list(self._captures.items()):
+                    stack = _collapse(frames.get(tid), cap.script) if tid != me else None
+                    if stack is None:
+                        cap.missing += 1
+                        if cap.missing >= END_GRACE:
+                            done.append(self._captures.pop(tid))
+                        continue
+                    cap.missing = 0
+                    cap.last_seen = now
+                    prefix = "".join(f"[{s}];" for s in cap.stages)
+                    cap.samples[prefix + stack] += 1
+            for cap in done:
+                self._finish(cap, cap.last_seen)
+
+    def _finish(self, cap, end):
+        ms = (end - cap.started) * 1000
+        self.measured += 1
+        if not self.enabled or ms < self.threshold_ms or not cap.samples:
+            return
+        label = re.sub(r"[^0-9A-Za-z_\-]", "_", cap.label or "anon")
+        name = f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(cap.started_at))}_{label}_{ms:.0f}ms.folded"
+        path = os.path.join(self.out_dir, name)
+        try:
+            os.makedirs(self.out_dir, exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                for stack, n in cap.samples.most_common():
+                    f.write(f"{stack} {n}\n")
+            self._prune()
+        except OSError:
+            path = None
+        with self._lock:
+            self.saved += 1
+            self._recent.append({"at": cap.started_at, "label": cap.label, "ms": ms, "path": path,
+                                 "samples": sum(cap.samples.values()), "stages": dict(cap.stage_ms)})
+
+    def _prune(self):
+        files = sorted((os.path.join(self.out_dir, n) for n in os.listdir(self.out_dir) if n.endswith(".folded")),
+                       key=os.path.getmtime)
+        for p in files[:max(0, len(files) - self.keep)]:
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+
+    # ---- 表示用 ----
+    def slowest(self, n=10):
+        """覚えている遅い再実行のうち時間の長い順に n 件（ファイルが消えたものは path=None）"""
+        with self._lock:
+            items = [dict(r) for r in self._recent]
+        for r in items:
+            if r["path"] and not os.path.exists(r["path"]):
+                r["path"] = None
+        return sorted(items, key=lambda r: r["ms"], reverse=True)[:n]
+
+
+def _collapse(frame, script):
+    """スレッドの現在のフレーム -> "file:関数;…"（根から葉）。スクリプトのフレームが無ければ None"""
+    names, found = [], False
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        if code.co_filename == script:
+            found = True
+            cut = len(names)     # 一番外側のスクリプトのフレームより外（Streamlit の実行部）は捨てる
+        frame = frame.f_back
+    if not found:
+        return None
+    return ";".join(reversed(names[:cut]))
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+# 列定義・フォルダ名正規化・型付き取り込み（Streamlit 非依存）
+
+import re
+from itertools import zip_longest
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+# === 列定義 ===
+required_cols = ["回答者", "親フォルダ", "時間", "選択フォルダ", "画像ファイル名", "①未融合", "②接触", "③融合中", "④完全融合"]
+skip_cols     = ["回答者", "親フォルダ", "時間", "選択フォルダ", "画像ファイル名", "スキップ理由"]
+image_cols    = ["フォルダ", "画像ファイル名", "画像URL"]
+count_cols    = ["①未融合", "②接触", "③融合中", "④完全融合"]
+
+# === 型定義（カテゴリ列 / 件数列 / 行の必須キー） ===
+CATEGORY_COLS = {"回答者", "親フォルダ", "時間", "選択フォルダ", "フォルダ", "スキップ理由"}
+COUNT_DTYPE   = "UInt16"   # 0〜1000 の件数。空欄は <NA>
+KEY_COLS = {
+    "画像リスト": ["フォルダ", "画像ファイル名"],
+    "今回の評価": ["回答者", "選択フォルダ", "画像ファイル名"],
+    "スキップログ": ["回答者", "選択フォルダ", "画像ファイル名"],
+}
+
+# === 正規化設定（必要なら接頭辞を追加） ===
+STRIP_PREFIXES = ("homogeneous_mix/",)
+
+def norm_folder(s: str) -> str:
+    """選択フォルダの表記ゆれを正規化（接頭辞除去・区切り統一・前後空白除去）"""
+    if not isinstance(s, str):
+        return s
+    s = s.replace("\\", "/").strip()
+    for p in STRIP_PREFIXES:
+        if s.startswith(p):
+            s = s[len(p):]
+    return s
+
+def time_from_folder(folder_name: str) -> str:
+    m = re.search(r'(\d+min)', folder_name)
+    return m.group(1) if m else "不明"
+
+def _map_categories(s: pd.Series, func) -> pd.Series:
+    """カテゴリ列はユニーク値だけに func を適用してコードで展開（行数に依存しない）"""
+    if not isinstance(s.dtype, pd.CategoricalDtype):
+        return func(s.astype("string")).astype(object)
+    mapped = func(pd.Series(s.cat.categories, dtype="string")).astype(object).to_numpy()
+    codes = s.cat.codes.to_numpy()
+    out = np.where(codes >= 0, mapped[codes] if len(mapped) else None, None)
+    return pd.Series(out, index=s.index).astype("category")
+
+def norm_folder_series(s: pd.Series) -> pd.Series:
+    """norm_folder のベクトル版（.str 演算）"""
+    def _norm(x):
+        x = x.str.replace("\\", "/", regex=False).str.strip()
+        for p in STRIP_PREFIXES:
+            x = x.str.removeprefix(p)
+        return x
+    return _map_categories(s, _norm)
+
+def time_from_folder_series(s: pd.Series) -> pd.Series:
+    """time_from_folder のベクトル版"""
+    return _map_categories(s, lambda x: x.str.extract(r"(\d+min)", expand=False).fillna("不明"))
+
+def condition_from_folder_series(s: pd.Series) -> pd.Series:
+    """フォルダ名から時間（\d+min）を除いた残り = 条件名（例: condA/10min -> condA, f1_10min -> f1）"""
+    def _cond(x):
+        x = x.str.replace(r"[_\-/ ]*\d+min[_\-/ ]*", "/", regex=True).str.strip("/_- ")
+        return x.mask(x == "", "(条件なし)")
+    return _map_categories(s, _cond)
+
+def parse_table(values, header_expected, table_name="", drop_bad_keys=True):
+    """A1形式の値配列 -> 型付き DataFrame（列単位で構築）。
+
+    戻り値は (df, issues)。issues は不正行の説明文リスト（行番号はシート上の番号）。
+    キー列が空の行は除外し、件数が数値でない行・範囲外（負・65535 超）や小数の行・列数超過の行は
+    残したうえで報告する（範囲外・小数は 0〜65535 の整数に丸める）。
+    drop_bad_keys=False ならキー列が空の行も残す（行位置をシートの行と対応させたいとき。
+    索引の行範囲で切り出す画像リスト等）。
+    """
+    issues = []
+    if not values:
+        return _empty_typed(header_expected), issues
+    header = [str(h).strip() for h in values[0]]
+    rows   = values[1:]
+    width  = len(header)
+
+    missing = [c for c in header_expected if c not in header]
+    if missing:
+        issues.append(f"{table_name}: ヘッダーに列がありません {missing}")
+
+    lengths = np.fromiter((len(r) for r in rows), dtype=np.int64, count=len(rows))
+    for i in np.flatnonzero(lengths > width):
+        issues.append(f"{table_name}: {i + 2}行目 列数超過（{lengths[i]} > {width}）")
+
+    # 列単位に転置（短い行は末尾の空セル扱い）
+    columns = list(zip_longest(*rows, fillvalue="")) if rows else []
+    pos = {h: i for i, h in enumerate(header)}
+    data = {}
+    for c in header_expected:
+        j = pos.get(c)
+        col = columns[j] if j is not None and j < len(columns) else ("",) * len(rows)
+        data[c] = pd.Series(col, dtype=object).fillna("").astype("string")
+    df = pd.DataFrame(data)
+
+    # 必須キーが空の行は除外
+    keys = [c for c in KEY_COLS.get(table_name, []) if c in df.columns]
+    bad_key = np.zeros(len(df), dtype=bool)
+    for c in keys:
+        bad_key |= (df[c].str.strip() == "").to_numpy()
+    for i in np.flatnonzero(bad_key):
+        issues.append(f"{table_name}: {i + 2}行目 キー列が空" + ("のため除外" if drop_bad_keys else ""))
+
+    # 件数列は数値化（数値でないものは <NA> にして報告）
+    for c in count_cols:
+        if c not in df.columns:
+            continue
+        num = pd.to_numeric(df[c].replace("", None), errors="coerce")
+        bad_num = num.isna() & (df[c] != "")
+        for i in np.flatnonzero(bad_num.to_numpy() & ~bad_key):
+            issues.append(f"{table_name}: {i + 2}行目 {c} が数値ではありません（{df[c].iat[i]!r}）")
+        fixed = num.round().clip(0, np.iinfo(np.uint16).max)
+        changed = (fixed != num).fillna(False).to_numpy()
+        for i in np.flatnonzero(changed & ~bad_key):
+            issues.append(f"{table_name}: {i + 2}行目 {c} を {int(fixed.iat[i])} に丸めました（{df[c].iat[i]!r}）")
+        df[c] = fixed.astype(COUNT_DTYPE)
+
+    if drop_bad_keys:
+        df = df.loc[~bad_key].reset_index(drop=True)
+    for c in header_expected:
+        if c in CATEGORY_COLS:
+            df[c] = df[c].astype("category")
+        elif c not in count_cols:
+            df[c] = df[c].astype(object)
+    return df, issues
+
+def drop_blank_keys(df, table_name):
+    """キー列が空の行を除く（drop_bad_keys=False で読んだ表を、位置で切り出した後に使う）"""
+    keys = [c for c in KEY_COLS.get(table_name, []) if c in df.columns]
+    if not keys or df.empty:
+        return df
+    ok = np.ones(len(df), dtype=bool)
+    for c in keys:
+        ok &= (df[c].astype(object).fillna("").astype(str).str.strip() != "").to_numpy()
+    return df if ok.all() else df.loc[ok].reset_index(drop=True)
+
+def _empty_typed(header_expected):
+    df = pd.DataFrame({c: pd.Series(dtype=object) for c in header_expected})
+    for c in header_expected:
+        if c in CATEGORY_COLS:
+            df[c] = df[c].astype("category")
+        elif c in count_cols:
+            df[c] = df[c].astype(COUNT_DTYPE)
+    return df
+
+# === テーブル単位のヘルパー（列定義・正規化列） ===
+TABLE_COLS = {"画像リスト": image_cols, "今回の評価": required_cols, "スキップログ": skip_cols}
+NORM_COLS  = {"画像リスト": ("フォルダ", "フォルダ_norm"),
+              "今回の評価": ("選択フォルダ", "選択フォルダ_norm"),
+              "スキップログ": ("選択フォルダ", "選択フォルダ_norm")}
+
+def add_norm_col(df, table_name):
+    """正規化列（フォルダ_norm / 選択フォルダ_norm）を付与"""
+    src, dst = NORM_COLS[table_name]
+    df[dst] = norm_folder_series(df[src])
+    return df
+
+def frame_to_typed(df, table_name):
+    """書き込み用の DataFrame（生の値）を、読み込み時と同じ型・正規化列に揃える"""
+    cols = TABLE_COLS[table_name]
+    values = [cols] + df.reindex(columns=cols).fillna("").astype(str).values.tolist()
+    typed, _ = parse_table(values, cols, table_name)
+    return add_norm_col(typed, table_name)
+
+def concat_typed(frames):
+    """カテゴリ型を保ったまま縦結合（カテゴリは和集合）"""
+    frames = [f for f in frames if len(f)] or list(frames[:1])
+    if len(frames) == 1:
+        return frames[0]
+    out = pd.concat(frames, ignore_index=True)
+    for c in frames[0].columns:
+        if isinstance(frames[0][c].dtype, pd.CategoricalDtype):
+            out[c] = union_categoricals([f[c].astype("category") for f in frames])
+    return out
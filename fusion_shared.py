@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+# 複数プロセス（レプリカ）で共有する状態（ローカル SQLite / WAL）
+#
+# FUSION_SHARED=1 で起動したアプリは、プロセス内で持っていた次の3つをここに置く。
+#   - 書き込み済み行の共有ログ（read-your-writes。ChangeLog と同じ使い方）
+#   - 書き込みキュー（先にキューへ入れてから追記。失敗しても消えず、どのプロセスでも再送する。
+#     再送の前に既に書かれていないか確かめ、何度も失敗する項目は保留にして表示する）
+#   - リース（同じ回答者の同じ画像を2つのセッションで同時に出さない・シートの同時読込を1回にまとめる）
+# テーブルのディスクキャッシュ（fusion_tablecache.py）は元からファイルで共有される。
+# 同じマシンのプロセス間で共有する前提（SQLite をネットワークファイルシステムに置かないこと）。
+
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import pandas as pd
+
+from fusion_schema import TABLE_COLS, frame_to_typed, concat_typed
+
+SHARED_DB   = os.path.join(os.environ.get("FUSION_CACHE_DIR", ".fusion_cache"), "shared_state.sqlite")
+SHARED_MODE = os.environ.get("FUSION_SHARED", "0") == "1"
+WORKER_ID   = f"{socket.gethostname()}:{os.getpid()}"
+LEASE_SEC   = 1800       # 画像のリース（表示した時に取る。回答・スキップ後も残し、この秒数で切れる）
+FETCH_LEASE = 120        # シート読込の同時実行をまとめるリース
+PRUNE_AGE   = 3600       # 共有ログはこれより古く、全プロセスが取り込み済みの行だけ消す
+WORKER_TTL  = 3600       # これより更新が無いプロセスは取り込み状況の判定から外す
+RETRY_SEC   = 30         # 書き込みに失敗した項目の再送間隔（回数に比例して延ばす）
+CLAIM_SEC   = 120        # 書き込み中の項目を他のプロセスが引き取るまでの秒数
+MAX_ATTEMPTS = 8         # これだけ失敗した項目は再送をやめて保留（dead-letter）にする
+HOLDER_IDLE = 300        # リースの保持者がこの秒数動いていなければ、ログインし直したセッションが引き継げる
+
+
+def _connect(path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def image_lease_key(user, folder_norm, file_name):
+    return f"img\t{user}\t{folder_norm}\t{file_name}"
+
+
+# =========================
+# 共有ログ（ChangeLog の複数プロセス版）
+# =========================
+def _encode_rows(df, table_name):
+    df = df.reindex(columns=TABLE_COLS[table_name])
+    return json.dumps(df.astype(object).where(df.notna(), "").astype(str).values.tolist(), ensure_ascii=False)
+
+def _decode_rows(payload, table_name):
+    return frame_to_typed(pd.DataFrame(json.loads(payload), columns=TABLE_COLS[table_name]), table_name)
+
+
+class SharedChangeLog:
+    """append 済みの行を SQLite に記録し、各プロセスのベーステーブルへマージする
+
+    version は全プロセス共通の通し番号（AUTOINCREMENT）。merged() の意味は ChangeLog と同じ。
+    """
+
+    def __init__(self, path=SHARED_DB, worker=WORKER_ID):
+        self.worker = worker
+        self._lock = threading.Lock()
+        self._conn = _connect(path)
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS changes (id INTEGER PRIMARY KEY AUTOINCREMENT, table_name TEXT NOT NULL, "
+            "kind TEXT NOT NULL, payload TEXT NOT NULL, created_at REAL NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS workers (worker TEXT PRIMARY KEY, seen_base INTEGER NOT NULL, "
+            "heartbeat REAL NOT NULL);"
+        )
+        self._conn.commit()
+        self._decoded = {}     # id -> (table_name, kind, typed_df)  ※取り込み済みの変更
+        self._pulled = 0
+        self._merged = {}
+        self._seen_base = 0
+        self._pruned_at = 0.0
+
+    @property
+    def version(self):
+        with self._lock:
+            return self._latest()
+
+    def _latest(self):
+        row = self._conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+        return row[0] if row else 0
+
+    def _insert(self, table_name, kind, typed_df):
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT INTO changes (table_name, kind, payload, created_at) VALUES (?, ?, ?, ?)",
+                (table_name, kind, _encode_rows(typed_df, table_name), time.time()))
+            self._conn.commit()
+            return cur.lastrowid
+
+    def record(self, table_name, typed_df):
+        """追記された行を記録してバージョンを進める"""
+        return self._insert(table_name, "rows", typed_df)
+
+    def replace(self, table_name, typed_df):
+        """シート全体を書き換えた場合（重複削除など）。以後はこの内容をベースにする"""
+        return self._insert(table_name, "replace", typed_df)
+
+    def _pull(self):
+        rows = self._conn.execute(
+            "SELECT id, table_name, kind, payload FROM changes WHERE id > ? ORDER BY id", (self._pulled,)).fetchall()
+        for cid, table_name, kind, payload in rows:
+            self._decoded[cid] = (table_name, kind, _decode_rows(payload, table_name))
+            self._pulled = cid
+
+    def merged(self, table_name, base_df, base_version, base_token):
+        """base_df（base_version 時点で読み始めたもの）に、それ以降の変更を（他プロセスの分も）重ねて返す"""
+        with self._lock:
+            self._seen_base = max(self._seen_base, base_version)
+            self._pull()
+            entries = [(cid, kind, df) for cid, (t, kind, df) in sorted(self._decoded.items()) if t == table_name]
+            start_version, start_df, token = base_version, base_df, base_token
+            for cid, kind, df in entries:
+                if kind == "replace" and cid > start_version:
+                    start_version, start_df, token = cid, df, ("override", cid)
+
+            cache_key = (token, self._pulled)
+            hit = self._merged.get(table_name)
+            if hit and hit[0] == cache_key:
+                return hit[1]
+            deltas = [df for cid, kind, df in entries if kind == "rows" and cid > start_version]
+            out = concat_typed([start_df] + deltas) if deltas else start_df
+            self._merged[table_name] = (cache_key, out)
+            self._prune()
+            return out
+
+    def _prune(self):
+        # 手元：最新のベースに取り込み済みの変更は不要
+        self._decoded = {cid: e for cid, e in self._decoded.items() if cid > self._seen_base}
+        now = time.time()
+        if now - self._pruned_at < 60:
+            return
+        self._pruned_at = now
+        # 共有：生きている全プロセスが取り込み済み、かつ十分古い行だけ消す
+        self._conn.execute(
+            "INSERT INTO workers (worker, seen_base, heartbeat) VALUES (?, ?, ?) "
+            "ON CONFLICT(worker) DO UPDATE SET seen_base = excluded.seen_base, heartbeat = excluded.heartbeat",
+            (self.worker, self._seen_base, now))
+        self._conn.execute("DELETE FROM workers WHERE heartbeat < ?", (now - WORKER_TTL,))
+        self._conn.execute(
+            "DELETE FROM changes WHERE created_at < ? AND id <= (SELECT MIN(seen_base) FROM workers)",
+            (now - PRUNE_AGE,))
+        self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            pending = [e for cid, e in self._decoded.items() if cid > self._seen_base]
+            return {"version": self._latest(), "pending_entries": len(pending),
+                    "pending_rows": sum(len(e[2]) for e in pending)}
+
+
+# =========================
+# リース
+# =========================
+class LeaseStore:
+    """key -> (保持者, 期限)。期限切れか自分が保持者なら取得できる
+
+    保持者（セッション）ごとに最後に動いた時刻も持つ（acquire / heartbeat で更新）。
+    """
+
+    def __init__(self, path=SHARED_DB):
+        self._lock = threading.Lock()
+        self._conn = _connect(path)
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, holder TEXT NOT NULL, expires REAL NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS lease_holders (holder TEXT PRIMARY KEY, seen REAL NOT NULL);")
+        self._conn.commit()
+
+    def _touch(self, holder, now):
+        self._conn.execute("INSERT INTO lease_holders (holder, seen) VALUES (?, ?) "
+                           "ON CONFLICT(holder) DO UPDATE SET seen = excluded.seen", (holder, now))
+
+    def heartbeat(self, holder):
+        """保持者が動いていることを記録する（再実行ごとに呼ぶ）"""
+        now = time.time()
+        with self._lock:
+            self._touch(holder, now)
+            self._conn.execute("DELETE FROM lease_holders WHERE seen < ?", (now - LEASE_SEC,))
+            self._conn.commit()
+
+    def acquire(self, key, holder, ttl=LEASE_SEC):
+        """取得（延長）できたら True"""
+        now = time.time()
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT INTO leases (key, holder, expires) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET holder = excluded.holder, expires = excluded.expires "
+                "WHERE leases.holder = excluded.holder OR leases.expires < ?",
+                (key, holder, now + ttl, now))
+            if cur.rowcount == 1:
+                self._touch(holder, now)
+            self._conn.commit()
+            return cur.rowcount == 1
+
+    def release(self, keys, holder):
+        with self._lock:
+            self._conn.executemany("DELETE FROM leases WHERE key = ? AND holder = ?", [(k, holder) for k in keys])
+            self._conn.commit()
+
+    def transfer(self, old_holder, new_holder, idle=HOLDER_IDLE):
+        """old_holder が idle 秒以上動いていなければ、そのリースをすべて new_holder に移す（移したら True）
+
+        ログインし直した回答者が切れた前のセッションを引き継ぐため。前のセッションがまだ動いている
+        （別タブで開いたまま）なら移さない（呼び出し側は新しい保持者のまま続ける）。
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            row = self._conn.execute("SELECT seen FROM lease_holders WHERE holder = ?", (old_holder,)).fetchone()
+            if row is not None and row[0] > now - idle:
+                self._conn.commit()
+                return False
+            self._conn.execute("UPDATE leases SET holder = ? WHERE holder = ?", (new_holder, old_holder))
+            self._conn.execute("DELETE FROM lease_holders WHERE holder = ?", (old_holder,))
+            self._touch(new_holder, now)
+            self._conn.commit()
+            return True
+
+    def held_by_others(self, keys, holder):
+        """keys のうち他の保持者が有効なリースを持っているもの"""
+        keys, out, now = list(keys), set(), time.time()
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                part = keys[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT key FROM leases WHERE key IN ({','.join('?' * len(part))}) AND holder != ? AND expires > ?",
+                    (*part, holder, now)).fetchall()
+                out.update(r[0] for r in rows)
+        return out
+
+    @contextmanager
+    def hold(self, key, holder=None, ttl=FETCH_LEASE, wait=FETCH_LEASE, poll=0.2):
+        """リースを取れるまで待ってから実行（待ちきれなければリースなしで実行）
+
+        holder 省略時は呼び出しごとに別の保持者にする（同じプロセスの別スレッドとも排他になる）。
+        """
+        holder = holder or f"{WORKER_ID}/hold-{uuid.uuid4().hex[:8]}"
+        deadline = time.time() + wait
+        got = self.acquire(key, holder, ttl)
+        while not got and time.time() < deadline:
+            time.sleep(poll)
+            got = self.acquire(key, holder, ttl)
+        try:
+            yield got
+        finally:
+            if got:
+                self.release([key], holder)
+
+
+# =========================
+# 書き込みキュー
+# =========================
+class WriteQueue:
+    """シートへの追記を先に記録しておくキュー（送信に成功したら消す）
+
+    送信中は引き取りを延長し続ける（keep_claim）。送信の直前に書き込み先と、その時点の行数を
+    mark_sending で記録する。一度でも送信を始めた項目（失敗した・送信中にプロセスが落ちた）は
+    その記録付きで返すので、送る側はその行より後に既に書かれていないか確かめてから再送する。
+    MAX_ATTEMPTS 回失敗した項目（送れない値など、やり直しても同じ失敗は1回で）は保留（dead）にして
+    再送せず、stats() と requeue_dead() で扱う。
+    """
+
+    def __init__(self, path=SHARED_DB):
+        self._lock = threading.Lock()
+        self._conn = _connect(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS write_queue (id INTEGER PRIMARY KEY AUTOINCREMENT, sheet_id TEXT NOT NULL, "
+            "ws_name TEXT NOT NULL, columns TEXT NOT NULL, rows TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+            "next_try REAL NOT NULL, claimed_by TEXT, claim_expires REAL NOT NULL DEFAULT 0, error TEXT, "
+            "created_at REAL NOT NULL, dead INTEGER NOT NULL DEFAULT 0, sent_to TEXT, sent_from INTEGER)")
+        cols = {r[1] for r in self._conn.execute("PRAGMA table_info(write_queue)")}
+        if "dead" not in cols:   # 以前の版で作ったキュー
+            self._conn.execute("ALTER TABLE write_queue ADD COLUMN dead INTEGER NOT NULL DEFAULT 0")
+        if "sent_to" not in cols:
+            self._conn.execute("ALTER TABLE write_queue ADD COLUMN sent_to TEXT")
+            self._conn.execute("ALTER TABLE write_queue ADD COLUMN sent_from INTEGER")
+        self._conn.commit()
+
+    def enqueue(self, sheet_id, ws_name, df):
+        now = time.time()
+        rows = df.astype(object).where(df.notna(), "").values.tolist()
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT INTO write_queue (sheet_id, ws_name, columns, rows, next_try, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (sheet_id, ws_name, json.dumps(list(df.columns), ensure_ascii=False),
+                 json.dumps(rows, ensure_ascii=False, default=_json_value), now, now))
+            self._conn.commit()
+            return cur.lastrowid
+
+    def claim(self, worker=WORKER_ID, ids=None, claim_sec=CLAIM_SEC):
+        """送信する項目を引き取る -> [(id, sheet_id, ws_name, DataFrame, sent)]
+
+        ids 指定時はその項目だけ（再送待ちでも）。sent は前に送信を始めたことがある項目
+        （失敗した・引き取ったまま期限が切れた。シートに書かれている可能性がある）なら
+        (書き込み先, 送信前の行数)、初めてなら None。記録のない古い項目は (None, 0)。
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            if ids is None:
+                sel = self._conn.execute(
+                    "SELECT id FROM write_queue WHERE dead = 0 AND next_try <= ? AND claim_expires < ? ORDER BY id",
+                    (now, now))
+            else:
+                sel = self._conn.execute(
+                    f"SELECT id FROM write_queue WHERE id IN ({','.join('?' * len(ids))}) AND dead = 0 "
+                    "AND claim_expires < ?", (*ids, now))
+            got = [r[0] for r in sel.fetchall()]
+            rows = self._conn.execute(
+                f"SELECT id, sheet_id, ws_name, columns, rows, "
+                f"sent_to IS NOT NULL OR attempts > 0 OR claimed_by IS NOT NULL, sent_to, sent_from "
+                f"FROM write_queue WHERE id IN ({','.join('?' * len(got))}) ORDER BY id", got).fetchall() if got else []
+            self._conn.executemany("UPDATE write_queue SET claimed_by = ?, claim_expires = ? WHERE id = ?",
+                                   [(worker, now + claim_sec, i) for i in got])
+            self._conn.commit()
+        return [(i, sid, ws, pd.DataFrame(json.loads(r), columns=json.loads(c)),
+                 (to, frm or 0) if sent else None)
+                for i, sid, ws, c, r, sent, to, frm in rows]
+
+    def mark_sending(self, item_id, target, used_rows):
+        """送信の直前に、書き込み先と送信前の行数を記録する（最初の送信の分を残す）"""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE write_queue SET sent_to = COALESCE(sent_to, ?), "
+                "sent_from = CASE WHEN sent_to IS NULL THEN ? ELSE MIN(sent_from, ?) END WHERE id = ?",
+                (target, used_rows, used_rows, item_id))
+            self._conn.commit()
+
+    def renew(self, item_id, worker=WORKER_ID, claim_sec=CLAIM_SEC):
+        """引き取りを延長する（自分が引き取っている間だけ）。延長できたら True"""
+        with self._lock:
+            cur = self._conn.execute("UPDATE write_queue SET claim_expires = ? WHERE id = ? AND claimed_by = ?",
+                                     (time.time() + claim_sec, item_id, worker))
+            self._conn.commit()
+            return cur.rowcount == 1
+
+    @contextmanager
+    def keep_claim(self, item_id, worker=WORKER_ID, claim_sec=CLAIM_SEC):
+        """送信のあいだ裏のスレッドで引き取りを延長し続ける（遅い送信を他のプロセスが二重に送らない）"""
+        stop = threading.Event()
+
+        def loop():
+            while not stop.wait(claim_sec / 3):
+                try:
+                    self.renew(item_id, worker, claim_sec)
+                except sqlite3.Error:
+                    pass
+
+        t = threading.Thread(target=loop, name=f"write-claim-{item_id}", daemon=True)
+        t.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            t.join()
+
+    def done(self, item_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM write_queue WHERE id = ?", (item_id,))
+            self._conn.commit()
+
+    def fail(self, item_id, error, max_attempts=MAX_ATTEMPTS, permanent=False):
+        """送信失敗：引き取りを外し、回数に比例した間隔の後に再送する（max_attempts 回で保留にする）
+
+        permanent=True はやり直しても同じ結果になる失敗（送れない値など）で、すぐ保留にする。
+        """
+        with self._lock:
+            self._conn.execute(
+                "UPDATE write_queue SET attempts = attempts + 1, claimed_by = NULL, claim_expires = 0, error = ?, "
+                "next_try = ? + ? * (attempts + 1), dead = (? OR attempts + 1 >= ?) WHERE id = ?",
+                (str(error), time.time(), RETRY_SEC, bool(permanent), max_attempts, item_id))
+            self._conn.commit()
+
+    def requeue_dead(self):
+        """保留にした項目を再送待ちに戻す（原因を直した後に手動で）。戻した件数"""
+        with self._lock:
+            cur = self._conn.execute("UPDATE write_queue SET dead = 0, attempts = 0, next_try = 0 WHERE dead = 1")
+            self._conn.commit()
+            return cur.rowcount
+
+    def stats(self):
+        with self._lock:
+            n, rows, dead, dead_rows, err = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(json_array_length(rows)), 0), COALESCE(SUM(dead), 0), "
+                "COALESCE(SUM(CASE WHEN dead = 1 THEN json_array_length(rows) ELSE 0 END), 0), "
+                "(SELECT error FROM write_queue WHERE error IS NOT NULL ORDER BY id DESC LIMIT 1) FROM write_queue"
+            ).fetchone()
+        return {"items": n, "rows": rows, "dead": dead, "dead_rows": dead_rows, "last_error": err}
+
+
+def _json_value(o):
+    # numpy の整数・pandas の NA
+    if hasattr(o, "item"):
+        return o.item()
+    return None
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+# Google Sheets 共通ヘルパー（読み取り回数・書き込み回数を抑える）
+
+import json
+import os
+import time
+import tomllib
+
+import gspread
+
+from fusion_transport import authorize
+
+APPEND_CHUNK = 1000  # append_rows 1回あたりの行数
+SCOPES = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
+SECRETS_PATH = os.path.join(".streamlit", "secrets.toml")
+
+def open_client(credentials_path=None):
+    """CLI 用の gspread クライアント。
+
+    credentials_path（サービスアカウント JSON）が無ければ .streamlit/secrets.toml の
+    [gcp_service_account] を使う（Streamlit アプリと同じ認証情報）。通信は fusion_transport の共有セッション。
+    """
+    from google.oauth2.service_account import Credentials
+    if credentials_path:
+        with open(credentials_path, encoding="utf-8") as f:
+            info = json.load(f)
+    else:
+        with open(SECRETS_PATH, "rb") as f:
+            info = tomllib.load(f)["gcp_service_account"]
+    return authorize(Credentials.from_service_account_info(info, scopes=SCOPES))
+
+def batch_get_safe(sheet, ranges, retries=3, backoff=1.5):
+    """values_batch_get を使った一括取得（429/5xxは軽い指数バックオフ）"""
+    last_err = None
+    for i in range(retries):
+        try:
+            resp = sheet.values_batch_get(ranges=ranges)
+            value_ranges = resp.get("valueRanges", [])
+            return [vr.get("values", []) for vr in value_ranges]
+        except Exception as e:
+            last_err = e
+            time.sleep((backoff ** i))
+    raise last_err
+
+def ensure_ws(sheet_obj, ws_name, header_cols):
+    """ワークシート存在保証（ヘッダーのみ作成）。読み取りはしない。"""
+    try:
+        ws = sheet_obj.worksheet(ws_name)
+    except gspread.exceptions.WorksheetNotFound:
+        ws = sheet_obj.add_worksheet(title=ws_name, rows="1000", cols=str(len(header_cols)))
+        ws.update("A1", [header_cols])  # ヘッダー作成
+    return ws
+
+def append_rows_chunked(ws, rows, chunk=APPEND_CHUNK):
+    """行リストを chunk 行ずつ append_rows（呼び出し回数 = ceil(行数/chunk)）"""
+    for i in range(0, len(rows), chunk):
+        ws.append_rows(rows[i:i+chunk], value_input_option="USER_ENTERED")
+
+def rewrite_ws(ws, header_cols, rows):
+    """シートをヘッダー + rows で書き直す（重複削除・アーカイブ用）"""
+    ws.clear()
+    ws.resize(rows=1, cols=len(header_cols))
+    ws.update("A1", [header_cols])
+    append_rows_chunked(ws, rows)
+
+TMP_SUFFIX = "_書き込み中"   # replace_ws が書き込み中に使う一時シート名の接尾辞
+
+def replace_ws(sheet, tables, chunk=APPEND_CHUNK):
+    """[(ws_name, header_cols, rows)] を一時シートに書いてから、1回の batch_update で元のシートと入れ替える
+
+    rewrite_ws と違い、書き込み中も読み手は元のシートをそのまま読める（空・書きかけの状態が見えない）。
+    複数渡したシートは同時に入れ替わる。グリッドは「ヘッダー + rows」ちょうどで、タブの位置は元のまま。
+    """
+    existing = {ws.title: ws for ws in sheet.worksheets()}
+    tmps = []
+    for name, cols, rows in tables:
+        stale = existing.get(name + TMP_SUFFIX)
+        if stale is not None:   # 前回中断したときの一時シート
+            sheet.del_worksheet(stale)
+        tmp = sheet.add_worksheet(title=name + TMP_SUFFIX, rows=str(len(rows) + 1), cols=str(len(cols)))
+        tmp.update("A1", [cols])
+        append_rows_chunked(tmp, rows, chunk=chunk)
+        tmp.resize(rows=len(rows) + 1, cols=len(cols))
+        tmps.append((name, tmp))
+    reqs = []
+    for name, tmp in tmps:
+        props = {"sheetId": tmp.id, "title": name}
+        old = existing.get(name)
+        if old is not None:
+            reqs.append({"deleteSheet": {"sheetId": old.id}})
+            props["index"] = old.index
+        reqs.append({"updateSheetProperties": {"properties": props, "fields": ",".join(k for k in props if k != "sheetId")}})
+    sheet.batch_update({"requests": reqs})
+
+def trim_row(row):
+    """行のセル（末尾の空セルを除く。API は末尾の空セルを返さないので、比較はこれで揃える）"""
+    row = list(row or [])
+    while row and row[-1] == "":
+        row.pop()
+    return row
+
+def row_delete_requests(sheet_id, positions):
+    """データ行の位置（0 始まり。ヘッダーの次の行が 0）-> deleteDimension リクエスト
+
+    連続する行は1範囲にまとめ、後ろの範囲から消す（1回の batch_update の中で前の削除が
+    後の位置をずらさない）。末尾への追記は位置を変えないので、読んだ後の追記は残る。
+    """
+    ranges = []
+    for p in sorted(set(int(p) for p in positions)):
+        if ranges and ranges[-1][1] == p:
+            ranges[-1][1] = p + 1
+        else:
+            ranges.append([p, p + 1])
+    return [{"deleteDimension": {"range": {"sheetId": sheet_id, "dimension": "ROWS",
+                                           "startIndex": start + 1, "endIndex": end + 1}}}
+            for start, end in reversed(ranges)]
+
+# =========================
+# メタデータのみでサイズを取得（値は読まない）
+# =========================
+CELL_LIMIT  = 10_000_000  # スプレッドシート1つあたりのセル上限
+GRID_FIELDS = "sheets(properties(sheetId,title,gridProperties(rowCount,columnCount)))"
+
+def _quote(title):
+    return "'" + title.replace("'", "''") + "'"
+
+def fetch_grid_sizes(sheet):
+    """全ワークシートの確保サイズを1リクエストで取得 -> [{sheet_id, title, rows, cols}]"""
+    meta = sheet.fetch_sheet_metadata(params={"fields": GRID_FIELDS})
+    out = []
+    for s in meta.get("sheets", []):
+        p = s.get("properties", {})
+        g = p.get("gridProperties", {})
+        out.append({"sheet_id": p.get("sheetId"), "title": p.get("title"),
+                    "rows": int(g.get("rowCount", 0)), "cols": int(g.get("columnCount", 0))})
+    return out
+
+def fetch_key_rows(sheet, titles):
+    """A列（キー列）だけを一括取得して、キーのある最後の行までの行数を数える（1リクエスト）"""
+    if not titles:
+        return {}
+    vals = batch_get_safe(sheet, [f"{_quote(t)}!A:A" for t in titles])
+    return {t: len(v) for t, v in zip(titles, vals)}
+
+def fetch_used_rows(sheet, titles, sizes=None):
+    """使用行数（どれかの列に値がある最後の行まで）。
+
+    A列を一括取得したうえで、その下（A列が空の行。キー欠けの行など）を全列で読んで足す
+    （A列 1回 + 残り 1回。ふつう下は空なので転送は小さい）。列数は sizes（fetch_grid_sizes の
+    結果）から取り、省略時はメタデータを1回読む。
+    """
+    used = fetch_key_rows(sheet, titles)
+    if not used:
+        return used
+    grid = {s["title"]: s for s in (sizes if sizes is not None else fetch_grid_sizes(sheet))}
+    tails = [t for t in used if t in grid and used[t] < grid[t]["rows"] and grid[t]["cols"] > 0]
+    if tails:
+        ranges = [f"{_quote(t)}!A{used[t] + 1}:{_col_letter(grid[t]['cols'])}" for t in tails]
+        for t, v in zip(tails, batch_get_safe(sheet, ranges)):
+            used[t] += len(v)
+    return used
+
+def _col_letter(n):
+    return gspread.utils.rowcol_to_a1(1, n)[:-1]
+
+def resize_grids(sheet, sizes):
+    """[(sheet_id, rows, cols)] をまとめて1回の batch_update でリサイズ"""
+    reqs = [{"updateSheetProperties": {
+                "properties": {"sheetId": sid, "gridProperties": {"rowCount": rows, "columnCount": cols}},
+                "fields": "gridProperties(rowCount,columnCount)"}}
+            for sid, rows, cols in sizes]
+    if reqs:
+        sheet.batch_update({"requests": reqs})
+    return len(reqs)
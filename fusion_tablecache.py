@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+# 読み込んだテーブルのディスクキャッシュ（スプレッドシートの更新時刻つき）
+#
+# 再起動・TTL 切れのたびに全ワークシートを読み直す代わりに、Drive の modifiedTime を
+# 1回だけ確認し、前回保存時と同じなら Parquet から復元する。型（カテゴリ列・UInt16）は
+# Parquet の pandas メタデータでそのまま戻る。
+# 読み始め時点の変更ログの版数も一緒に保存し、復元した表にはその版数以降の追記を重ねる。
+
+import json
+import os
+import shutil
+import threading
+import time
+
+import pandas as pd
+
+TABLE_CACHE_DIR = os.path.join(os.environ.get("FUSION_CACHE_DIR", ".fusion_cache"), "tables")
+
+
+def sheet_stamp(sheet):
+    """スプレッドシートの更新時刻（Drive メタデータ1回）。取得できなければ None（キャッシュを使わない）"""
+    try:
+        return sheet.get_lastUpdateTime()
+    except Exception:
+        return None
+
+
+def _restore_dtypes(df, dtypes):
+    """保存時の dtype に戻す（空のカテゴリ列・object の文字列列は Parquet だけでは戻らない）"""
+    for c, t in dtypes.items():
+        if c not in df.columns or str(df[c].dtype) == t:
+            continue
+        df[c] = df[c].astype(object if t == "object" else t)
+    return df
+
+
+class TableCache:
+    """キー（シートID など）ごとに {表名: DataFrame} + issues を保存"""
+
+    def __init__(self, root=TABLE_CACHE_DIR):
+        self.root = root
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def _dir(self, key):
+        return os.path.join(self.root, key)
+
+    def load(self, key, stamp):
+        """保存時の stamp と一致すれば (frames, issues, version)、違えば None
+
+        version は保存した表を読み始めた時点の変更ログの版数（ChangeLog.merged の base_version）。
+        """
+        d = self._dir(key)
+        try:
+            with open(os.path.join(d, "stamp.json"), encoding="utf-8") as f:
+                meta = json.load(f)
+            if stamp is None or meta.get("stamp") != stamp:
+                self.misses += 1
+                return None
+            frames = {name: _restore_dtypes(pd.read_parquet(os.path.join(d, f"{i}.parquet")),
+                                            meta.get("dtypes", {}).get(name, {}))
+                      for i, name in enumerate(meta["tables"])}
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return frames, meta.get("issues", []), meta.get("version", 0)
+
+    def save(self, key, stamp, frames, issues=(), version=0, started=None):
+        """一時ディレクトリに書いてから入れ替える（途中の状態を読ませない）
+
+        started（読み始めた時刻）より後に invalidate されていたら保存しない（古い内容になるため）。
+        保存できたら True。
+        """
+        if stamp is None or self._invalidated_since(key, started):
+            return False
+        d = self._dir(key)
+        tmp = f"{d}.tmp{os.getpid()}_{threading.get_ident()}"
+        os.makedirs(tmp, exist_ok=True)
+        names = list(frames)
+        for i, name in enumerate(names):
+            frames[name].to_parquet(os.path.join(tmp, f"{i}.parquet"), index=False)
+        with open(os.path.join(tmp, "stamp.json"), "w", encoding="utf-8") as f:
+            json.dump({"stamp": stamp, "tables": names, "issues": list(issues), "version": version,
+                       "dtypes": {n: {c: str(t) for c, t in frames[n].dtypes.items()} for n in names}},
+                      f, ensure_ascii=False)
+        with self._lock:
+            if self._invalidated_since(key, started):
+                shutil.rmtree(tmp, ignore_errors=True)
+                return False
+            shutil.rmtree(d, ignore_errors=True)
+            os.replace(tmp, d)
+        if self._invalidated_since(key, started):
+            # 入れ替えの間に他のプロセスが invalidate した
+            self._remove_stamp(key)
+            return False
+        return True
+
+    def _mark_path(self, key):
+        return f"{self._dir(key)}.invalidated"
+
+    def _invalidated_since(self, key, started):
+        if started is None:
+            return False
+        try:
+            with open(self._mark_path(key), encoding="utf-8") as f:
+                return float(f.read() or 0) >= started
+        except (OSError, ValueError):
+            return False
+
+    def _remove_stamp(self, key):
+        try:
+            os.remove(os.path.join(self._dir(key), "stamp.json"))
+        except OSError:
+            pass
+
+    def invalidate(self, key):
+        """自分で書き込んだ直後など（Drive の更新時刻の反映遅れで古い内容を使わないように）
+
+        時刻を記録し、それより前に読み始めた読込の保存も拒否する（他のプロセスの分も）。
+        """
+        with self._lock:
+            os.makedirs(self.root, exist_ok=True)
+            with open(self._mark_path(key), "w", encoding="utf-8") as f:
+                f.write(repr(time.time()))
+            self._remove_stamp(key)
+
+    def cached(self, key, sheet, fetch, lock=None, version=0):
+        """stamp が同じならディスクから、違えば fetch() -> (frames, issues) を実行して保存
+
+        戻り値は (frames, issues, version)。version は fetch する場合は渡した値（読み始め時点の
+        変更ログの版数）、ディスクから戻した場合は保存時の値。
+        lock(key) はプロセス間の排他（複数プロセス運用で同じシートを同時に読まないように）。
+        待っている間に他のプロセスが保存していれば、それを使う。
+        """
+        stamp = sheet_stamp(sheet)
+        hit = self.load(key, stamp)
+        if hit is not None:
+            return hit
+        if lock is not None:
+            with lock(key):
+                hit = self.load(key, stamp)
+                if hit is not None:
+                    return hit
+                return self._fetch_and_save(key, stamp, fetch, version)
+        return self._fetch_and_save(key, stamp, fetch, version)
+
+    def _fetch_and_save(self, key, stamp, fetch, version):
+        started = time.time()
+        frames, issues = fetch()
+        try:
+            self.save(key, stamp, frames, issues, version, started)
+        except Exception:
+            pass   # キャッシュに書けなくても読み込み自体は成功させる
+        return frames, issues, version
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+# 大きな顕微鏡画像のタイルピラミッド（多段解像度）
+#
+# レベル0 = 画面サイズ（長辺 SCREEN_SIDE 以下）のプレビュー、最上位 = 原寸。
+# 各レベルを TILE px 角の JPEG タイルに分けてディスクに置き、表示時は
+# 拡大率と表示位置に必要なタイルだけを読んで1枚に合成する。
+
+import hashlib
+import io
+import json
+import math
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from PIL import Image
+
+from fusion_images import read_source, _as_8bit
+
+TILE_DIR    = os.path.join(os.environ.get("FUSION_CACHE_DIR", ".fusion_cache"), "tiles")
+TILE        = 512
+SCREEN_SIDE = 1024     # レベル0（最初に表示するプレビュー）の長辺
+VIEW_PX     = 1024     # 拡大表示の出力幅
+QUALITY     = 88
+
+TILE_MAX_PIXELS = 1_000_000_000   # タイル元画像だけに許す画素数（PIL の既定は約 8900 万）
+
+_limit_lock = threading.Lock()
+
+@contextmanager
+def _large_image_limit(limit=TILE_MAX_PIXELS):
+    """Image.open の間だけ画素数の上限を上げる（PIL の展開爆弾対策は全体では既定のまま）
+
+    上限は Image.open の中でだけ見られるので、上げている時間はヘッダーを読む間だけ。
+    """
+    with _limit_lock:
+        saved = Image.MAX_IMAGE_PIXELS
+        Image.MAX_IMAGE_PIXELS = limit
+        try:
+            yield
+        finally:
+            Image.MAX_IMAGE_PIXELS = saved
+
+def tile_key(url):
+    return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+def _rgb_or_l(img):
+    """JPEG にできるモード（L / RGB）へ。16bit 以上は切り捨てずに 8bit へ伸ばしてから"""
+    img = _as_8bit(img)
+    return img if img.mode in ("RGB", "L") else img.convert("RGB")
+
+def _jpeg(img):
+    out = io.BytesIO()
+    _rgb_or_l(img).save(out, format="JPEG", quality=QUALITY)
+    return out.getvalue()
+
+def build_pyramid(data, out_dir, tile=TILE, screen_side=SCREEN_SIDE):
+    """画像バイト列 -> out_dir/{level}/{col}_{row}.jpg + meta.json。戻り値は meta"""
+    with _large_image_limit():
+        img = Image.open(io.BytesIO(data))
+    img.load()
+    img = _rgb_or_l(img)
+    w, h = img.size
+    n_down = max(0, math.ceil(math.log2(max(w, h) / screen_side))) if max(w, h) > screen_side else 0
+
+    levels = []
+    tmp_dir = f"{out_dir}.tmp{os.getpid()}_{threading.get_ident()}"
+    os.makedirs(tmp_dir, exist_ok=True)
+    for lv in range(n_down + 1):
+        scale = 2 ** (n_down - lv)
+        lw, lh = max(1, round(w / scale)), max(1, round(h / scale))
+        level_img = img if scale == 1 else img.resize((lw, lh), Image.Resampling.LANCZOS)
+        cols, rows = math.ceil(lw / tile), math.ceil(lh / tile)
+        os.makedirs(os.path.join(tmp_dir, str(lv)), exist_ok=True)
+        for c in range(cols):
+            for r in range(rows):
+                box = (c * tile, r * tile, min(lw, (c + 1) * tile), min(lh, (r + 1) * tile))
+                with open(os.path.join(tmp_dir, str(lv), f"{c}_{r}.jpg"), "wb") as f:
+                    f.write(_jpeg(level_img.crop(box)))
+        if lv == 0:
+            with open(os.path.join(tmp_dir, "preview.jpg"), "wb") as f:
+                f.write(_jpeg(level_img))
+        levels.append({"w": lw, "h": lh, "cols": cols, "rows": rows})
+
+    meta = {"width": w, "height": h, "tile": tile, "levels": levels}
+    with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    try:
+        os.replace(tmp_dir, out_dir)   # 完成してから公開（作成途中を読ませない）
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)   # 同時作成で先を越された
+    return meta
+
+
+class TileStore:
+    """画像URL ごとのタイルピラミッドの読み出し"""
+
+    def __init__(self, root=TILE_DIR, build_workers=1):
+        self.root = root
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._builder = ThreadPoolExecutor(max_workers=build_workers)
+
+    def path(self, url):
+        return os.path.join(self.root, tile_key(url))
+
+    def meta(self, url):
+        p = os.path.join(self.path(url), "meta.json")
+        if not os.path.exists(p):
+            return None
+        with open(p, encoding="utf-8") as f:
+            return json.load(f)
+
+    def build(self, url, data):
+        if self.meta(url) is None:
+            os.makedirs(self.root, exist_ok=True)
+            build_pyramid(data, self.path(url))
+        return self.meta(url)
+
+    def build_in_background(self, url):
+        """未作成なら原画像を読んでバックグラウンドで作る（同じ URL は1回だけ）"""
+        with self._lock:
+            if url in self._pending:
+                return
+            self._pending.add(url)
+
+        def run():
+            try:
+                if self.meta(url) is None:
+                    self.build(url, read_source(url))
+            except Exception:
+                pass   # 読めない画像は通常表示のまま
+            finally:
+                with self._lock:
+                    self._pending.discard(url)
+
+        self._builder.submit(run)
+
+    def preview(self, url):
+        """レベル0（画面サイズ）のプレビュー。最初の表示はこれだけ送る"""
+        with open(os.path.join(self.path(url), "preview.jpg"), "rb") as f:
+            return f.read()
+
+    def zoom_options(self, meta, view_px=VIEW_PX):
+        """意味のある拡大率（原寸を超えない 1, 2, 4, ...）"""
+        zooms = [1]
+        while view_px * zooms[-1] < meta["width"]:
+            zooms.append(zooms[-1] * 2)
+        return zooms
+
+    def view(self, url, zoom, cx=0.5, cy=0.5, view_px=VIEW_PX):
+        """拡大率 zoom・中心 (cx, cy)（0〜1）の表示範囲を、必要なタイルだけ読んで合成"""
+        meta = self.meta(url)
+        if zoom <= 1:
+            return self.preview(url)
+        levels = meta["levels"]
+        need_w = view_px * zoom
+        lv = next((i for i, L in enumerate(levels) if L["w"] >= need_w), len(levels) - 1)
+        L, tile = levels[lv], meta["tile"]
+        vw, vh = L["w"] / zoom, L["h"] / zoom
+        left = min(max(cx * L["w"] - vw / 2, 0), L["w"] - vw)
+        top  = min(max(cy * L["h"] - vh / 2, 0), L["h"] - vh)
+        c0, c1 = int(left // tile), min(L["cols"] - 1, int((left + vw - 1) // tile))
+        r0, r1 = int(top // tile), min(L["rows"] - 1, int((top + vh - 1) // tile))
+
+        canvas = Image.new("RGB", ((c1 - c0 + 1) * tile, (r1 - r0 + 1) * tile))
+        for c in range(c0, c1 + 1):
+            for r in range(r0, r1 + 1):
+                with Image.open(os.path.join(self.path(url), str(lv), f"{c}_{r}.jpg")) as t:
+                    canvas.paste(_rgb_or_l(t).convert("RGB"), ((c - c0) * tile, (r - r0) * tile))
+        x, y = left - c0 * tile, top - r0 * tile
+        crop = canvas.crop((round(x), round(y), round(x + vw), round(y + vh)))
+        if crop.width > view_px:
+            crop = crop.resize((view_px, max(1, round(crop.height * view_px / crop.width))), Image.Resampling.LANCZOS)
+        return _jpeg(crop)
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+# Google Sheets の HTTP 通信（接続プールの共有・gzip・トークンの先行更新・リクエストごとの計測）
+#
+# gspread.authorize は呼ぶたびに新しいセッションを作るので、クライアントを作り直すたびに
+# TLS 接続とアクセストークンの取得がやり直しになる。ここではサービスアカウントごとに
+# keep-alive の接続プール付きセッションを1つだけ作ってプロセス内の全クライアントで共有し、
+#   - 応答は gzip で受け取る（Google API は User-Agent に "gzip" を含むときだけ圧縮する）
+#   - 送信する JSON は区切りの空白を省き、日本語を \uXXXX にせず UTF-8 のまま送る
+#     （FUSION_GZIP_UPLOAD=1 なら大きな本文は gzip で送る）
+#   - トークンは期限の REFRESH_MARGIN 秒前に裏で更新する（リクエストが更新を待たない）。
+#     更新は認証情報ごとのロックで1本にする（裏の更新・期限切れ・401 後の更新が重ならない）
+#   - リクエストごとの時間・送受信バイト数を数える（transport_stats）
+# 使い方は gspread.authorize と同じ（authorize(credentials) -> gspread.Client）。
+
+import gzip
+import json
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+import gspread
+from gspread.http_client import HTTPClient
+from gspread.utils import convert_credentials
+
+POOL_SIZE       = 32            # 同時に張っておく接続数（セッション数・スレッド数より多め）
+REQUEST_TIMEOUT = (10, 120)     # (接続, 応答) 秒。大きな一括取得があるので応答は長め
+REFRESH_MARGIN  = 300           # トークンの期限のこの秒数前に更新する
+GZIP_UPLOAD     = os.environ.get("FUSION_GZIP_UPLOAD", "0") == "1"
+GZIP_MIN_BYTES  = 16 * 1024     # これより小さい本文は圧縮しない
+USER_AGENT      = "cell-fusion-app (gzip)"
+TIMING_WINDOW   = 2000          # 応答時間の分位点に使う直近のリクエスト数
+
+
+class TransportStats:
+    """リクエスト数・応答時間・送受信バイト数（全クライアント共通）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ms = deque(maxlen=TIMING_WINDOW)
+        self.requests = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0      # 通信路上（gzip のまま）
+        self.bytes_decoded = 0       # 展開後
+        self.token_refreshes = 0
+        self.refresh_errors = 0
+
+    def record(self, ms, sent, received, decoded, ok):
+        with self._lock:
+            self.requests += 1
+            self.errors += not ok
+            self.bytes_sent += sent
+            self.bytes_received += received
+            self.bytes_decoded += decoded
+            self._ms.append(ms)
+
+    def snapshot(self):
+        with self._lock:
+            ms = sorted(self._ms)
+            out = {"requests": self.requests, "errors": self.errors, "bytes_sent": self.bytes_sent,
+                   "bytes_received": self.bytes_received, "bytes_decoded": self.bytes_decoded,
+                   "token_refreshes": self.token_refreshes, "refresh_errors": self.refresh_errors}
+        out["p50_ms"] = ms[len(ms) // 2] if ms else None
+        out["p95_ms"] = ms[min(len(ms) - 1, int(len(ms) * 0.95))] if ms else None
+        return out
+
+
+_stats = TransportStats()
+_sessions = {}                  # (サービスアカウント, スコープ) -> (credentials, AuthorizedSession)
+_sessions_lock = threading.Lock()
+
+
+def transport_stats():
+    return _stats.snapshot()
+
+
+def _pooled_session(credentials):
+    """認証情報ごとに1つの AuthorizedSession（初回だけ作る。2回目以降は最初の認証情報を使い回す）"""
+    from google.auth.transport.requests import AuthorizedSession
+    from requests.adapters import HTTPAdapter
+    key = (getattr(credentials, "service_account_email", None) or id(credentials),
+           tuple(getattr(credentials, "scopes", None) or ()))
+    with _sessions_lock:
+        if key in _sessions:
+            return _sessions[key]
+        _serialize_refresh(credentials)
+        session = AuthorizedSession(credentials, refresh_timeout=REQUEST_TIMEOUT[1])
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE)
+        session.mount("https://", adapter)
+        session.headers.update({"Accept-Encoding": "gzip", "User-Agent": USER_AGENT})
+        _sessions[key] = (credentials, session)
+    threading.Thread(target=_refresh_loop, args=(credentials, session), name="sheets-token-refresh",
+                     daemon=True).start()
+    return credentials, session
+
+
+def _serialize_refresh(credentials):
+    """credentials.refresh を認証情報ごとのロックで直列化する
+
+    AuthorizedSession は期限切れ（before_request）と 401 の応答で refresh を呼ぶので、裏の先行更新と
+    複数スレッドのリクエストが同時に更新しうる。ロックを待つ間に他のスレッドが更新していたら、その
+    トークンを使う（更新し直さない）。
+    """
+    if getattr(credentials, "_fusion_refresh_lock", None) is not None:
+        return
+    lock = threading.Lock()
+    refresh = credentials.refresh
+
+    def locked_refresh(request):
+        token = credentials.token
+        with lock:
+            if credentials.token != token and credentials.valid:
+                return
+            refresh(request)
+
+    credentials._fusion_refresh_lock = lock
+    credentials.refresh = locked_refresh
+
+
+def _seconds_left(credentials):
+    expiry = getattr(credentials, "expiry", None)
+    if not getattr(credentials, "token", None) or expiry is None:
+        return None
+    now = datetime.now(timezone.utc).replace(tzinfo=None)   # google-auth の expiry は naive UTC
+    return (expiry - now).total_seconds()
+
+
+def _refresh_loop(credentials, session):
+    """トークンの期限が近づいたら裏で更新する（最初のトークンは最初のリクエストが取る）"""
+    while True:
+        left = _seconds_left(credentials)
+        if left is None:
+            time.sleep(30)
+            continue
+        if left > REFRESH_MARGIN:
+            time.sleep(min(left - REFRESH_MARGIN, 600))
+            continue
+        try:
+            credentials.refresh(session._auth_request)
+            with _stats._lock:
+                _stats.token_refreshes += 1
+        except Exception:
+            # 失敗してもリクエスト側の通常の更新に任せる（少し待って再試行）
+            with _stats._lock:
+                _stats.refresh_errors += 1
+            time.sleep(30)
+
+
+class PooledHTTPClient(HTTPClient):
+    """gspread の HTTPClient（共有セッション・圧縮・計測付き）"""
+
+    def __init__(self, auth, session=None):
+        if session is not None:
+            self.auth, self.session = auth, session
+        else:
+            self.auth, self.session = _pooled_session(convert_credentials(auth))
+        self.timeout = REQUEST_TIMEOUT
+
+    def request(self, method, endpoint, params=None, data=None, json=None, files=None, headers=None):
+        headers = dict(headers or {})
+        if json is not None:
+            data = _dumps(json)
+            headers["Content-Type"] = "application/json; charset=utf-8"
+            if GZIP_UPLOAD and len(data) >= GZIP_MIN_BYTES:
+                data = gzip.compress(data, compresslevel=5)
+                headers["Content-Encoding"] = "gzip"
+        t0 = time.perf_counter()
+        response = None
+        try:
+            response = self.session.request(method=method, url=endpoint, params=params, data=data, files=files,
+                                            headers=headers, timeout=self.timeout)
+        finally:
+            ms = (time.perf_counter() - t0) * 1000
+            decoded = len(response.content) if response is not None else 0
+            _stats.record(ms, len(data) if isinstance(data, (bytes, str)) else 0,
+                          _wire_bytes(response, decoded), decoded, response is not None and response.ok)
+        if not response.ok:
+            raise gspread.exceptions.APIError(response)
+        return response
+
+
+class UnsendableRequest(ValueError):
+    """送る前に分かる、何度送っても失敗するリクエスト（JSON にできない値を含む）"""
+
+
+def _dumps(obj):
+    # NaN / Infinity は JSON ではない（Sheets が 400 を返す）ので、送る前に UnsendableRequest にする
+    try:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), allow_nan=False).encode("utf-8")
+    except ValueError as e:
+        raise UnsendableRequest(str(e)) from e
+
+
+def _wire_bytes(response, decoded):
+    """受信したバイト数（gzip のまま）。分からなければ展開後の長さ"""
+    if response is None:
+        return 0
+    length = response.headers.get("Content-Length")
+    if length and length.isdigit():
+        return int(length)
+    try:
+        return int(response.raw.tell()) or decoded
+    except Exception:
+        return decoded
+
+
+def authorize(credentials):
+    """gspread.authorize の代わり（共有の接続プールとトークンを使うクライアント）"""
+    return gspread.Client(auth=credentials, http_client=PooledHTTPClient)
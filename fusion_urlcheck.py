@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+# 画像URL の事前チェック（状態・応答時間のキャッシュ）
+#
+# 表示の時点で URL が切れていると空のカードが出て、評価者は「判別不能」でスキップするしかない。
+# 画像リストの URL をスレッドプールで並列に HEAD（通らなければ 1 バイトの Range GET）し、
+# 結果を .fusion_cache/url_status.sqlite に残す。アプリは dead の画像を出題から外し、
+# 遅い・一時エラーの画像はサイドバーに出す。
+
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+URL_STATUS_DB = os.path.join(os.environ.get("FUSION_CACHE_DIR", ".fusion_cache"), "url_status.sqlite")
+CHECK_WORKERS = 16
+CHECK_TIMEOUT = 5          # 秒（表示の取得タイムアウトより短く）
+SLOW_MS       = 2000       # これ以上かかる URL は「遅い」
+DEAD_STATUS   = {401, 403, 404, 410}
+DEAD_AFTER    = 3          # 一時エラー（タイムアウト・5xx 等）がこの回数続いたら dead
+RECHECK_SEC   = {"ok": 24 * 3600, "slow": 3600, "error": 60, "dead": 6 * 3600}
+RELOAD_OVERLAP = 5         # 他のプロセスの結果を読み直すとき、前回の最新より少し前から読む（秒）
+
+
+def probe(url, timeout=CHECK_TIMEOUT, session=None):
+    """1つの URL（or ローカルパス）を確認 -> (HTTP ステータス or None, 応答時間 ms, エラー文)"""
+    t0 = time.perf_counter()
+    status, err = None, ""
+    try:
+        if url.startswith(("http://", "https://")):
+            r = session.head(url, timeout=timeout, allow_redirects=True)
+            if r.status_code in (403, 405, 501):
+                # HEAD を受け付けないサーバ・署名付き URL は先頭1バイトだけ GET
+                r = session.get(url, timeout=timeout, headers={"Range": "bytes=0-0"}, stream=True)
+                r.close()
+            status = r.status_code
+            if status >= 400:
+                err = r.reason or ""
+        else:
+            status, err = (200, "") if os.path.getsize(url) > 0 else (204, "空ファイル")
+    except FileNotFoundError as e:
+        status, err = 404, str(e)
+    except Exception as e:   # タイムアウト・接続エラー
+        err = f"{type(e).__name__}: {e}"
+    return status, (time.perf_counter() - t0) * 1000, err
+
+
+def classify(status, latency_ms, fails):
+    """(ステータス, 応答時間, 連続失敗回数) -> ok / slow / error / dead"""
+    if status is not None and 200 <= status < 300 and status != 204:
+        return "slow" if latency_ms >= SLOW_MS else "ok"
+    if status in DEAD_STATUS or status == 204:
+        return "dead"
+    return "dead" if fails >= DEAD_AFTER else "error"
+
+
+class UrlHealthChecker:
+    """画像URL -> 状態のキャッシュ（SQLite + メモリ）と、バックグラウンドの並列チェック"""
+
+    def __init__(self, path=URL_STATUS_DB, workers=CHECK_WORKERS, timeout=CHECK_TIMEOUT):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._pending = set()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS url_status ("
+            "url TEXT PRIMARY KEY, state TEXT NOT NULL, status INTEGER, latency_ms REAL, error TEXT, "
+            "fails INTEGER NOT NULL, checked_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+        # URL 数は画像リストの行数程度なので全件をメモリに持つ（表示のたびに SQL を引かない）。
+        # 他のプロセス（check_image_urls.py・別のレプリカ）の結果は、DB ファイルが更新されたら
+        # 前回読んだ最新の checked_at 以降の行だけ読み直して取り込む
+        self._path = path
+        self._rows = {}
+        self._loaded_upto = 0.0
+        self._db_mtime = None
+        with self._lock:
+            self._reload()
+
+    def _mtime(self):
+        m = 0.0
+        for p in (self._path, self._path + "-wal"):
+            try:
+                m = max(m, os.stat(p).st_mtime)
+            except OSError:
+                pass
+        return m
+
+    def _reload(self):
+        """DB が更新されていれば、新しい行をメモリに取り込む（self._lock を持って呼ぶ）"""
+        mtime = self._mtime()
+        if mtime == self._db_mtime:
+            return
+        self._db_mtime = mtime
+        rows = self._conn.execute("SELECT url, state, status, latency_ms, error, fails, checked_at FROM url_status "
+                                  "WHERE checked_at > ?", (self._loaded_upto - RELOAD_OVERLAP,)).fetchall()
+        for url, state, status, ms, err, fails, at in rows:
+            prev = self._rows.get(url)
+            if prev is None or at > prev["checked_at"]:
+                self._rows[url] = {"state": state, "status": status, "latency_ms": ms, "error": err,
+                                   "fails": fails, "checked_at": at}
+            self._loaded_upto = max(self._loaded_upto, at)
+
+    def _session(self):
+        s = getattr(self._local, "session", None)
+        if s is None:
+            import requests
+            s = self._local.session = requests.Session()
+        return s
+
+    def _check(self, url):
+        status, ms, err = probe(url, self.timeout, self._session())
+        with self._lock:
+            prev = self._rows.get(url)
+            ok = status is not None and 200 <= status < 300
+            fails = 0 if ok else (prev["fails"] if prev else 0) + 1
+            row = {"state": classify(status, ms, fails), "status": status, "latency_ms": round(ms, 1),
+                   "error": err, "fails": fails, "checked_at": time.time()}
+            self._rows[url] = row
+            self._pending.discard(url)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO url_status (url, state, status, latency_ms, error, fails, checked_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (url, row["state"], status, row["latency_ms"], err, fails, row["checked_at"]))
+            self._conn.commit()
+        return row
+
+    def due(self, urls, now=None):
+        """未確認・確認から時間が経った URL（状態ごとに再確認の間隔が違う）"""
+        now = now or time.time()
+        with self._lock:
+            self._reload()
+            out = []
+            for u in dict.fromkeys(urls):
+                r = self._rows.get(u)
+                if u not in self._pending and (r is None or now - r["checked_at"] > RECHECK_SEC[r["state"]]):
+                    out.append(u)
+            return out
+
+    def submit(self, urls):
+        """要確認の URL をバックグラウンドで確認する（待たない）。戻り値は投入した件数"""
+        todo = self.due(urls)
+        with self._lock:
+            self._pending.update(todo)
+        for u in todo:
+            self._pool.submit(self._check, u)
+        return len(todo)
+
+    def check_many(self, urls, on_result=None):
+        """要確認の URL を並列に確認して待つ（CLI 用）。on_result(url, row) で進捗を受け取れる"""
+        todo = self.due(urls)
+        with self._lock:
+            self._pending.update(todo)
+        for u, row in zip(todo, self._pool.map(self._check, todo)):
+            if on_result:
+                on_result(u, row)
+        return len(todo)
+
+    def record_failure(self, url, error):
+        """表示時に取得できなかった URL（次の submit ですぐ再確認される）
+
+        再実行のたびに呼ばれるので失敗回数は数えず、一時エラーの再確認の間隔も縮めない
+        （dead の判定は確認の結果だけで行う）。
+        """
+        with self._lock:
+            prev = self._rows.get(url)
+            if prev is not None and prev["state"] in ("error", "dead"):
+                return
+            self._rows[url] = {"state": "error", "status": None, "latency_ms": None, "error": error,
+                               "fails": prev["fails"] if prev else 0, "checked_at": 0.0}
+
+    def get(self, url):
+        with self._lock:
+            self._reload()
+            return self._rows.get(url)
+
+    def dead(self, urls=None):
+        """確認済みで dead の URL の集合（未確認は含まない。urls 省略時は全件から）"""
+        with self._lock:
+            self._reload()
+            if urls is None:
+                return {u for u, r in self._rows.items() if r["state"] == "dead"}
+            return {u for u in urls if (r := self._rows.get(u)) is not None and r["state"] == "dead"}
+
+    def stats(self):
+        with self._lock:
+            self._reload()
+            counts = {"ok": 0, "slow": 0, "error": 0, "dead": 0}
+            for r in self._rows.values():
+                counts[r["state"]] += 1
+            counts["pending"] = len(self._pending)
+            return counts
+
+    def problems(self, urls=None):
+        """dead / slow / error の URL と状態（表示用。urls を渡すとその中だけ）"""
+        with self._lock:
+            self._reload()
+            items = self._rows.items() if urls is None else ((u, self._rows.get(u)) for u in urls)
+            return {u: dict(r) for u, r in items if r is not None and r["state"] != "ok"}
@@ -4,6 +4,7 @@ import os
 file_path = r"C:\mix\googleapp\flashcard_google.py"
 
 # 評価対象の画像フォルダの絶対パス（仮のパス）
+# streamlit_mamiya.py はこの引数を受け取ると画像リストシートを使わず、フォルダを直接走査する
 folder_path = r"C:\mix\googleapp"
 
 # Streamlit 実行 + 引数にフォルダパスを渡す
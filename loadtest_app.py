@@ -0,0 +1,424 @@
+# -*- coding: utf-8 -*-
+# 同時接続の負荷試験ツール（Streamlit の AppTest + 遅延つきの疑似 Google Sheets）
+#
+# 使い方:
+#   python loadtest_app.py                                  # 1, 2, 4, 8 セッションで各 20 操作
+#   python loadtest_app.py --sessions 4 16 32 --clicks 40 --latency-ms 200
+#   python loadtest_app.py --sessions 8 --csv loadtest.csv
+#
+# 1つのプロセスの中で N 個のセッション（AppTest）をスレッドで同時に動かし、
+# ログイン → 進む / スキップ / 戻る / 途中保存 をランダムに繰り返す。st.cache_resource /
+# st.cache_data はセッション間で共有されるので、1台のサーバに N 人が接続した状態に近い。
+# Sheets API はメモリ上の疑似実装に置き換え、呼び出しごとに遅延を入れて回数を数える。
+#
+# 出力（N ごと）: 操作ごとの応答時間 p50/p95/p99、セッションあたりの CPU 時間・メモリ増分、
+# Sheets 呼び出し回数/分（読み取り・メタデータ・書き込み）。最初の段のメモリ増分には
+# アプリのモジュール読み込み分も含まれる。
+
+import argparse
+import contextlib
+import csv
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from unittest import mock
+
+import numpy as np
+
+from fusion_imagelist import IMAGE_SHEET_ID
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "streamlit_mamiya.py")
+USERS = [("mamiya", "a"), ("arai", "a"), ("yamazaki", "protoplast")]   # アプリの USER_CREDENTIALS
+ACTIONS = {"進む": 0.75, "スキップ": 0.08, "戻る": 0.07, "途中保存": 0.10}
+APP_TIMEOUT = 120
+
+
+# =========================
+# 疑似 Google Sheets（gspread の使っている部分だけ）
+# =========================
+class CallStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {"read": 0, "metadata": 0, "write": 0}
+
+    def add(self, kind):
+        with self._lock:
+            self.counts[kind] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counts)
+
+
+class FakeBackend:
+    """全スプレッドシートの中身・遅延・呼び出し回数"""
+
+    def __init__(self, latency_ms=120, write_latency_ms=250, seed=0):
+        self.latency = latency_ms / 1000
+        self.write_latency = write_latency_ms / 1000
+        self.stats = CallStats()
+        self.sheets = {}
+        self._lock = threading.Lock()
+        self._rng = random.Random(seed)
+
+    def call(self, kind):
+        """API 1回分：遅延（平均の ±50%）を入れて数える"""
+        self.stats.add(kind)
+        base = self.write_latency if kind == "write" else self.latency
+        with self._lock:
+            d = base * self._rng.uniform(0.5, 1.5)
+        time.sleep(d)
+
+    def open_by_key(self, key):
+        with self._lock:
+            if key not in self.sheets:
+                self.sheets[key] = FakeSpreadsheet(self, key)
+            return self.sheets[key]
+
+
+_A1 = re.compile(r"^([A-Z]+)(\d*)(?::([A-Z]+)(\d*))?$")
+
+def _col(letters):
+    n = 0
+    for ch in letters:
+        n = n * 26 + ord(ch) - 64
+    return n - 1
+
+
+class FakeWorksheet:
+    def __init__(self, book, title, rows=1000, cols=26):
+        self.book = book
+        self.title = title
+        self.id = abs(hash((book.id, title))) % 10**8
+        self.values = []
+        self.row_count = int(rows)
+        self.col_count = int(cols)
+        self._lock = threading.Lock()
+
+    def read(self, a1):
+        m = _A1.match(a1)
+        c0 = _col(m.group(1))
+        c1 = _col(m.group(3)) if m.group(3) else c0
+        r0 = int(m.group(2) or 1) - 1
+        with self._lock:
+            r1 = int(m.group(4)) if m.group(4) else len(self.values)
+            out = [r[c0:c1 + 1] for r in self.values[r0:r1]]
+        while out and not any(out[-1]):
+            out.pop()
+        return out
+
+    def append_rows(self, rows, value_input_option=None, **kw):
+        self.book.backend.call("write")
+        with self._lock:
+            self.values.extend([["" if v is None else str(v) for v in r] for r in rows])
+            self.row_count = max(self.row_count, len(self.values))
+
+    def update(self, a1, values=None, **kw):
+        self.book.backend.call("write")
+        if isinstance(a1, list):
+            a1, values = values, a1
+        m = _A1.match(a1)
+        r0 = int(m.group(2) or 1) - 1
+        with self._lock:
+            for i, row in enumerate(values):
+                while len(self.values) <= r0 + i:
+                    self.values.append([])
+                self.values[r0 + i] = [str(v) for v in row]
+
+    def get_all_values(self, **kw):
+        self.book.backend.call("read")
+        with self._lock:
+            return [list(r) for r in self.values]
+
+    def clear(self):
+        self.book.backend.call("write")
+        with self._lock:
+            self.values = []
+
+    def resize(self, rows=None, cols=None):
+        self.book.backend.call("write")
+        if rows:
+            self.row_count = int(rows)
+        if cols:
+            self.col_count = int(cols)
+
+
+class FakeSpreadsheet:
+    def __init__(self, backend, key):
+        self.backend = backend
+        self.id = key
+        self.wss = {}
+        self._lock = threading.Lock()
+        self._modified = 0
+
+    def worksheet(self, title):
+        import gspread
+        self.backend.call("metadata")
+        with self._lock:
+            if title not in self.wss:
+                raise gspread.exceptions.WorksheetNotFound(title)
+            return self.wss[title]
+
+    def add_worksheet(self, title, rows, cols, **kw):
+        self.backend.call("write")
+        with self._lock:
+            ws = self.wss[title] = FakeWorksheet(self, title, rows, cols)
+            return ws
+
+    def worksheets(self):
+        self.backend.call("metadata")
+        return list(self.wss.values())
+
+    def values_batch_get(self, ranges, params=None):
+        self.backend.call("read")
+        out = []
+        for r in ranges:
+            name, _, a1 = r.rpartition("!")
+            ws = self.wss.get(name.strip("'").replace("''", "'"))
+            out.append({"range": r, "values": ws.read(a1)} if ws is not None else {"range": r})
+        return {"valueRanges": out}
+
+    def fetch_sheet_metadata(self, params=None):
+        self.backend.call("metadata")
+        return {"sheets": [{"properties": {"sheetId": ws.id, "title": ws.title,
+                                           "gridProperties": {"rowCount": ws.row_count, "columnCount": ws.col_count}}}
+                           for ws in self.wss.values()]}
+
+    def batch_update(self, body):
+        self.backend.call("write")
+        return {}
+
+    def get_lastUpdateTime(self):
+        self.backend.call("metadata")
+        return str(sum(len(ws.values) for ws in self.wss.values()))
+
+
+def seed_backend(backend, image_dir, n_folders, per_folder, side=512):
+    """画像リスト（ローカルの小さな PNG を指す）を作る。画像は全フォルダで使い回す"""
+    from PIL import Image
+    rng = np.random.default_rng(0)
+    paths = []
+    for j in range(min(per_folder, 16)):
+        p = os.path.join(image_dir, f"img{j}.png")
+        Image.fromarray(rng.integers(0, 255, (side, side), dtype=np.uint8)).save(p)
+        paths.append(p)
+    book = backend.open_by_key(IMAGE_SHEET_ID)
+    ws = book.wss["画像リスト"] = FakeWorksheet(book, "画像リスト")
+    ws.values = [["フォルダ", "画像ファイル名", "画像URL"]] + [
+        [f"cond{i % 4}_{10 * (i // 4 + 1)}min", f"img{i}_{j}.png", paths[j % len(paths)]]
+        for i in range(n_folders) for j in range(per_folder)]
+    ws.row_count = len(ws.values) + 100
+
+
+# =========================
+# セッションの操作
+# =========================
+def _button(at, label):
+    for b in list(at.button) + list(at.sidebar.button):
+        if b.label == label:
+            return b
+    return None
+
+
+def run_session(idx, clicks, seed, record):
+    """1セッション：開く → ログイン → clicks 回の操作。record(操作, 秒, 例外の有無)"""
+    from streamlit.testing.v1 import AppTest
+    rng = random.Random(seed)
+    at = AppTest.from_file(APP_PATH, default_timeout=APP_TIMEOUT)
+
+    def timed(action):
+        t0 = time.perf_counter()
+        at.run()
+        record(action, time.perf_counter() - t0, bool(at.exception))
+
+    timed("表示")
+    user, password = USERS[idx % len(USERS)]
+    at.text_input[0].set_value(user)
+    at.text_input[1].set_value(password)
+    at.button[0].click()
+    timed("ログイン")
+    names, weights = list(ACTIONS), list(ACTIONS.values())
+    for _ in range(clicks):
+        action = rng.choices(names, weights)[0]
+        if action == "進む":
+            if not at.number_input:
+                break   # 全フォルダ終了
+            at.number_input[0].set_value(rng.randint(1, 30))
+            b = _button(at, "進む →")
+        else:
+            b = _button(at, {"スキップ": "スキップ", "戻る": "← 戻る", "途中保存": "途中保存"}[action])
+        if b is None:
+            break
+        b.click()
+        timed(action)
+
+
+def shared_runtime_patches():
+    """AppTest を同時に動かすためのパッチ
+
+    AppTest は実行のたびに Runtime._instance・st.secrets・config.get_option を差し替えて
+    元に戻すので、並行に動かすと他のセッションの実行中に消える。最初に作られた Runtime を
+    使い続け（キャッシュもその中で全セッション共有になる）、secrets と設定はプロセス全体で
+    1回だけ差し替える。スクリプトのコンパイル（ast.parse）もスレッド安全ではないので1つずつ行う。
+    """
+    import streamlit as st
+    from streamlit.testing.v1 import app_test
+    from streamlit.testing.v1.util import patch_config_options
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    from streamlit.runtime.secrets import Secrets
+    pinned = []
+    compile_lock = threading.Lock()
+    get_bytecode = ScriptCache.get_bytecode
+
+    def locked_bytecode(self, path):
+        with compile_lock:
+            return get_bytecode(self, path)
+
+    def instance(cls):
+        if not pinned and cls._instance is not None:
+            pinned.append(cls._instance)
+        if not pinned:
+            raise RuntimeError("Runtime hasn't been created!")
+        return pinned[0]
+
+    secrets = Secrets()
+    secrets._secrets = {"gcp_service_account": {"type": "service_account"}}
+    return [mock.patch.object(Runtime, "instance", classmethod(instance)),
+            mock.patch.object(Runtime, "exists", classmethod(lambda cls: bool(pinned) or cls._instance is not None)),
+            mock.patch.object(ScriptCache, "get_bytecode", locked_bytecode),
+            mock.patch.object(st, "secrets", secrets),
+            mock.patch.object(app_test, "patch_config_options", lambda overrides: contextlib.nullcontext()),
+            patch_config_options({"global.appTest": True})]
+
+
+def _rss_bytes():
+    """現在の RSS（Linux は /proc、それ以外は ru_maxrss で代用）"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_level(n, args, backend, cache_dir):
+    """N セッション同時の1回分 -> 集計行"""
+    import streamlit as st
+    st.cache_data.clear()
+    st.cache_resource.clear()
+    for name in os.listdir(cache_dir):
+        shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+
+    samples, lock = [], threading.Lock()
+
+    def record(action, sec, failed):
+        with lock:
+            samples.append((action, sec, failed))
+
+    calls0, cpu0, rss0, t0 = backend.stats.snapshot(), time.process_time(), _rss_bytes(), time.perf_counter()
+    def session(i):
+        try:
+            run_session(i, args.clicks, args.seed * 1000 + i, record)
+        except Exception:
+            traceback.print_exc()
+            record("中断", 0.0, True)
+
+    threads = [threading.Thread(target=session, args=(i,))
+               for i in range(n)]
+    for th in threads:
+        th.start()
+        time.sleep(args.ramp_ms / 1000)
+    for th in threads:
+        th.join()
+    wall = time.perf_counter() - t0
+    cpu = time.process_time() - cpu0
+    rss = _rss_bytes() - rss0
+    calls = {k: v - calls0[k] for k, v in backend.stats.snapshot().items()}
+
+    row = {"sessions": n, "clicks": len(samples), "errors": sum(f for _, _, f in samples),
+           "wall_s": round(wall, 1), "cpu_s_per_session": round(cpu / n, 2),
+           "cpu_util": round(cpu / wall, 2), "rss_mb_per_session": round(rss / n / 2**20, 1)}
+    for kind, c in calls.items():
+        row[f"{kind}_per_min"] = round(c / wall * 60, 1)
+    groups = {"全体": [s for a, s, _ in samples if a in ACTIONS]}
+    for action in ["ログイン", *ACTIONS]:
+        groups[action] = [s for a, s, _ in samples if a == action]
+    for name, secs in groups.items():
+        if secs:
+            p50, p95, p99 = np.percentile(np.array(secs) * 1000, [50, 95, 99])
+            row[f"{name}_p50_ms"], row[f"{name}_p95_ms"], row[f"{name}_p99_ms"] = round(p50), round(p95), round(p99)
+    return row
+
+
+def print_row(row):
+    print(f"\n== {row['sessions']} セッション: {row['clicks']} 操作 / 例外 {row['errors']} / {row['wall_s']}s ==")
+    for name in ["全体", "ログイン", *ACTIONS]:
+        if f"{name}_p50_ms" in row:
+            print(f"  {name:<6} p50 {row[f'{name}_p50_ms']:>6} ms  p95 {row[f'{name}_p95_ms']:>6} ms  "
+                  f"p99 {row[f'{name}_p99_ms']:>6} ms")
+    print(f"  CPU {row['cpu_s_per_session']} s/セッション（使用率 {row['cpu_util']:.0%}）"
+          f" / メモリ +{row['rss_mb_per_session']} MB/セッション")
+    print(f"  Sheets 呼び出し/分: 読み取り {row['read_per_min']} / メタデータ {row['metadata_per_min']}"
+          f" / 書き込み {row['write_per_min']}")
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="streamlit_mamiya.py の同時接続数ごとの応答時間・負荷を測る")
+    ap.add_argument("--sessions", type=int, nargs="+", default=[1, 2, 4, 8], help="同時セッション数（複数指定で順に）")
+    ap.add_argument("--clicks", type=int, default=20, help="1セッションあたりの操作回数（ログイン後）")
+    ap.add_argument("--latency-ms", type=float, default=120, help="疑似 Sheets の読み取り・メタデータの平均遅延")
+    ap.add_argument("--write-latency-ms", type=float, default=250, help="疑似 Sheets の書き込みの平均遅延")
+    ap.add_argument("--folders", type=int, default=40)
+    ap.add_argument("--per-folder", type=int, default=30)
+    ap.add_argument("--ramp-ms", type=float, default=200, help="セッションを開始する間隔")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--csv", help="集計を CSV に保存")
+    args = ap.parse_args(argv)
+
+    work = tempfile.mkdtemp(prefix="fusion_loadtest_")
+    cache_dir = os.path.join(work, "cache")
+    image_dir = os.path.join(work, "images")
+    os.makedirs(cache_dir)
+    os.makedirs(image_dir)
+    # アプリのモジュールが読み込まれる前に、キャッシュの置き場所を一時ディレクトリへ
+    os.environ["FUSION_CACHE_DIR"] = cache_dir
+    os.environ.pop("FUSION_IMAGE_DIR", None)
+    sys.argv = sys.argv[:1]   # アプリは引数のディレクトリを画像フォルダとみなすので渡さない
+
+    backend = FakeBackend(args.latency_ms, args.write_latency_ms, args.seed)
+    seed_backend(backend, image_dir, args.folders, args.per_folder)
+    patches = [mock.patch("gspread.authorize", lambda *a, **k: backend),
+               mock.patch("fusion_transport.authorize", lambda *a, **k: backend),
+               mock.patch("google.oauth2.service_account.Credentials.from_service_account_info",
+                          lambda *a, **k: object()),
+               *shared_runtime_patches()]
+    rows = []
+    try:
+        with contextlib.ExitStack() as stack:
+            for p in patches:
+                stack.enter_context(p)
+            for n in args.sessions:
+                row = run_level(n, args, backend, cache_dir)
+                print_row(row)
+                rows.append(row)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    if args.csv and rows:
+        cols = list(dict.fromkeys(k for r in rows for k in r))
+        with open(args.csv, "w", newline="", encoding="utf-8-sig") as f:
+            w = csv.DictWriter(f, fieldnames=cols)
+            w.writeheader()
+            w.writerows(rows)
+        print(f"\n保存: {args.csv}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
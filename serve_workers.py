@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# 評価アプリを複数プロセスで起動する（同じマシンのコアを使って同時接続数を増やす）
+#
+# 使い方:
+#   python serve_workers.py --workers 4                  # 8501〜8504 番ポートで streamlit_mamiya.py
+#   python serve_workers.py --workers 2 --base-port 9000 --app streamlit_mamiya.py
+#
+# 各プロセスは FUSION_SHARED=1 で起動し、.fusion_cache/shared_state.sqlite（共有ログ・書き込みキュー・
+# リース）とテーブルのディスクキャッシュを共有する。前段のロードバランサーは WebSocket を通し、
+# セッションを同じポートに固定する（sticky session）こと。
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="評価アプリを共有状態つきで複数プロセス起動する")
+    ap.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2))
+    ap.add_argument("--base-port", type=int, default=8501)
+    ap.add_argument("--app", default="streamlit_mamiya.py")
+    ap.add_argument("app_args", nargs="*", help="アプリに渡す引数（画像フォルダなど）")
+    args = ap.parse_args(argv)
+
+    env = dict(os.environ, FUSION_SHARED="1")
+    procs = []
+    for i in range(args.workers):
+        port = args.base_port + i
+        cmd = [sys.executable, "-m", "streamlit", "run", args.app, "--server.port", str(port),
+               "--server.headless", "true"] + (["--"] + args.app_args if args.app_args else [])
+        procs.append(subprocess.Popen(cmd, env=env))
+        print(f"worker {i}: http://localhost:{port}（pid {procs[-1].pid}）")
+    try:
+        while all(p.poll() is None for p in procs):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for p in procs:
+            if p.poll() is None:
+                p.terminate()
+        for p in procs:
+            p.wait()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
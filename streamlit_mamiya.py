@@ -3,40 +3,73 @@
 
 import streamlit as st
 import pandas as pd
+import contextlib
+import io
+import os
 import random
 import re
+import sys
 import time
-import gspread
+import uuid
+from collections import Counter
 from google.oauth2.service_account import Credentials
 
+from fusion_schema import (
+    required_cols, skip_cols, image_cols,
+    time_from_folder, norm_folder_series, parse_table, frame_to_typed, concat_typed,
+)
+from fusion_changelog import ChangeLog
+from fusion_sheets import (batch_get_safe, ensure_ws, rewrite_ws, fetch_used_rows, fetch_key_rows, append_rows_chunked,
+                           trim_row, _quote, CELL_LIMIT)
+from fusion_monitor import CellUsageMonitor, SHRINK_MARGIN
+from fusion_cursor import CursorStore
+from fusion_images import scan_image_folder, MmapImageReader, SharedImageCache
+from fusion_tiles import TileStore
+from fusion_estimate import EstimateStore, ESTIMATE_DB, ESTIMATE_LOG_WS, estimate_log_cols
+from fusion_kinetics import KineticsEngine, export_table
+from fusion_packed import (PACKED_WS, PACKED_LOG, MIXED_ISSUE, packed_cols, pack_rows, unpack_values,
+                           write_target, log_formats)
+from fusion_tablecache import TableCache
+from fusion_dashboard import ProgressDashboard, remaining_by_user, REFRESH_SEC
+from fusion_phash import PhashIndex, INDEX_PATH as PHASH_INDEX_PATH
+from fusion_archive import DIGEST_WS, digest_cols, expand_digest, digest_pairs, run_archive
+from fusion_imagelist import IMAGE_SHEET_ID, LazyImageList, StaleIndexError, sort_by_folder
+from fusion_urlcheck import UrlHealthChecker
+from fusion_shared import SHARED_MODE, WORKER_ID, MAX_ATTEMPTS, SharedChangeLog, LeaseStore, WriteQueue, image_lease_key
+from fusion_profiler import RerunProfiler, PROFILE_DIR, MAX_PROFILES
+from fusion_transport import authorize, transport_stats, UnsendableRequest
+
 # =========================
 # 基本設定
 # =========================
 st.set_page_config(page_title="融合度評価", layout="centered")
 st.title("融合度評価")
 
-# === Google Sheets IDs ===
-IMAGE_SHEET_ID = "1gDGW6B3Sj9piVHN5vEvQ9JlMp2BjGhdnyL32R7MdF8I"
+# === Google Sheets IDs ===（IMAGE_SHEET_ID は CLI と共通なので fusion_imagelist から）
 LOG_SHEET_ID   = "17xAIAz6xIoM9eZHona-GyMMdM5zku4cRtUXCud5Rc5Y"
 SCOPES = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
 
-# === 列定義 ===
-required_cols = ["回答者", "親フォルダ", "時間", "選択フォルダ", "画像ファイル名", "①未融合", "②接触", "③融合中", "④完全融合"]
-skip_cols     = ["回答者", "親フォルダ", "時間", "選択フォルダ", "画像ファイル名", "スキップ理由"]
-image_cols    = ["フォルダ", "画像ファイル名", "画像URL"]
+# まとめてスキップで選べる理由（1枚ずつの「スキップ」は 判別不能）
+SKIP_REASONS = ["判別不能", "ピンぼけ・不鮮明", "画像の破損・表示不可", "フォルダごと対象外"]
+
+# === ローカル画像フォルダ（googlestart.py の引数 or FUSION_IMAGE_DIR） ===
+# 指定時は画像リストシートを読まず、フォルダを走査して画像リストを作る
+LOCAL_IMAGE_ROOT = next((a for a in sys.argv[1:] if os.path.isdir(a)), None) or os.environ.get("FUSION_IMAGE_DIR") or None
+
+# 列定義・正規化（norm_folder / time_from_folder）・型付き取り込みは fusion_schema.py
+
+# =========================
+# 遅い再実行のプロファイル（管理者がサイドバーで有効化。FUSION_PROFILE_MS でも可）
+# =========================
+ADMIN_USERS = {"mamiya"}
 
-# === 正規化設定（必要なら接頭辞を追加） ===
-STRIP_PREFIXES = ("homogeneous_mix/",)
+@st.cache_resource
+def get_profiler():
+    """再実行のサンプリングプロファイラ（全セッション共有。しきい値を超えた再実行だけ保存）"""
+    return RerunProfiler()
 
-def norm_folder(s: str) -> str:
-    """選択フォルダの表記ゆれを正規化（接頭辞除去・区切り統一・前後空白除去）"""
-    if not isinstance(s, str):
-        return s
-    s = s.replace("\\", "/").strip()
-    for p in STRIP_PREFIXES:
-        if s.startswith(p):
-            s = s[len(p):]
-    return s
+profiler = get_profiler()
+profiler.begin(__file__, st.session_state.get("username", ""))
 
 # =========================
 # Google クライアント（1回作成）
@@ -44,66 +77,178 @@ def norm_folder(s: str) -> str:
 @st.cache_resource
 def get_clients():
     credentials = Credentials.from_service_account_info(st.secrets["gcp_service_account"], scopes=SCOPES)
-    gc = gspread.authorize(credentials)
+    gc = authorize(credentials)   # 接続プール・トークンをプロセス内で共有（fusion_transport）
     image_sheet = gc.open_by_key(IMAGE_SHEET_ID)
     log_sheet   = gc.open_by_key(LOG_SHEET_ID)
+    ensure_ws(log_sheet, DIGEST_WS, digest_cols)  # 一括取得の範囲に含めるため存在を保証
+    ensure_ws(log_sheet, PACKED_WS, packed_cols)
     return gc, image_sheet, log_sheet
 
 gc, image_sheet, log_sheet = get_clients()
 
+@st.cache_resource
+def get_change_log():
+    """書き込み済み行の共有ログ（全セッション共通。FUSION_SHARED=1 なら全プロセス共通の SQLite）"""
+    return SharedChangeLog() if SHARED_MODE else ChangeLog()
+
+change_log = get_change_log()
+
+@st.cache_resource
+def get_shared_stores():
+    """複数プロセス運用（FUSION_SHARED=1）の画像リースと書き込みキュー。1プロセスなら (None, None)"""
+    if not SHARED_MODE:
+        return None, None
+    return LeaseStore(), WriteQueue()
+
+lease_store, write_queue = get_shared_stores()
+
+@st.cache_resource
+def get_cursor_store():
+    """回答者ごとの評価カーソル（ローカル SQLite。再接続・再起動後の再開用）"""
+    return CursorStore()
+
+cursor_store = get_cursor_store()
+
+@st.cache_resource
+def _load_phash_index(mtime):
+    return PhashIndex.load(PHASH_INDEX_PATH)
+
+def get_phash_index():
+    """重複画像インデックス（build_phash_index.py で作成。無ければ None。更新されたら読み直す）"""
+    if not os.path.exists(PHASH_INDEX_PATH):
+        return None
+    return _load_phash_index(os.path.getmtime(PHASH_INDEX_PATH))
+
+@st.cache_resource
+def get_image_cache():
+    """全セッション共有の画像キャッシュ（画像URL -> デコード・再エンコード済み。ローカル画像は mmap で読む）"""
+    return SharedImageCache(reader=MmapImageReader())
+
+image_cache = get_image_cache()
+
+@st.cache_resource
+def get_tile_store():
+    """大きな画像のタイルピラミッド（build_tiles.py で事前作成。未作成の画像は表示時に裏で作る）"""
+    return TileStore()
+
+tile_store = get_tile_store()
+
+@st.cache_resource
+def get_url_checker():
+    """画像URL の状態キャッシュ（check_image_urls.py と共有。表示中のフォルダは裏で確認する）"""
+    return UrlHealthChecker()
+
+url_checker = get_url_checker()
+
+@st.cache_resource
+def _open_estimate_store():
+    return EstimateStore()
+
+def get_estimate_store():
+    """①〜④ の推定件数（build_estimates.py で作成。無ければ None）"""
+    if not os.path.exists(ESTIMATE_DB):
+        return None
+    return _open_estimate_store()
+
 # =========================
 # ユーティリティ
 # =========================
-def _to_df(values, header_expected):
-    """A1形式の値配列 -> DataFrame。欠損列は補完、余剰列は落とす。"""
-    if not values or len(values) == 0:
-        return pd.DataFrame(columns=header_expected)
-    header = values[0]
-    rows   = values[1:] if len(values) > 1 else []
-    df = pd.DataFrame(rows, columns=header)
-    for c in header_expected:
-        if c not in df.columns:
-            df[c] = ""
-    return df[header_expected]
-
-def batch_get_safe(sheet, ranges, retries=3, backoff=1.5):
-    """values_batch_get を使った一括取得（429/5xxは軽い指数バックオフ）"""
-    last_err = None
-    for i in range(retries):
-        try:
-            resp = sheet.values_batch_get(ranges=ranges)
-            value_ranges = resp.get("valueRanges", [])
-            return [vr.get("values", []) for vr in value_ranges]
-        except Exception as e:
-            last_err = e
-            time.sleep((backoff ** i))
-    raise last_err
-
-def ensure_ws(sheet_obj, ws_name, header_cols):
-    """ワークシート存在保証（ヘッダーのみ作成）。読み取りはしない。"""
-    try:
-        ws = sheet_obj.worksheet(ws_name)
-    except gspread.exceptions.WorksheetNotFound:
-        ws = sheet_obj.add_worksheet(title=ws_name, rows="1000", cols=str(len(header_cols)))
-        ws.update("A1", [header_cols])  # ヘッダー作成
-    return ws
-
+@profiler.stage("append_df_to_sheet")
 def append_df_to_sheet(sheet_obj, df: pd.DataFrame, ws_name: str):
-    """append-only（読まない）。"""
+    """append-only（読まない）。複数プロセス運用では先に書き込みキューへ入れてから送る"""
     if df.empty:
         return
-    ws = ensure_ws(sheet_obj, ws_name, df.columns.tolist())
-    ws.append_rows(df.values.tolist(), value_input_option="USER_ENTERED")
-
-def time_from_folder(folder_name: str) -> str:
-    m = re.search(r'(\d+min)', folder_name)
-    return m.group(1) if m else "不明"
-def compute_remaining(image_list_df, combined_df, skip_df, username):
-    """サーバ回答・スキップ・セッション回答・セッション内スキップを除いた残り枚数を計算"""
+    if write_queue is None:
+        _write_df(sheet_obj, df, ws_name)
+        return
+    item_id = write_queue.enqueue(sheet_obj.id, ws_name, df)
+    if drain_writes([item_id]):
+        st.session_state.write_deferred = True
+
+def drain_writes(ids=None):
+    """書き込みキューの項目を送る（ids 省略時は再送待ちの全項目。他プロセスの失敗分も）。戻り値は失敗件数"""
+    failed = 0
+    sheets = {IMAGE_SHEET_ID: image_sheet, LOG_SHEET_ID: log_sheet}
+    for item_id, sheet_id, ws_name, df, sent in write_queue.claim(WORKER_ID, ids):
+        try:
+            with write_queue.keep_claim(item_id, WORKER_ID):
+                sheet_obj = sheets.get(sheet_id) or gc.open_by_key(sheet_id)
+                key_rows = fetch_key_rows(sheet_obj, _target_candidates(ws_name))
+                target = _write_target(ws_name, key_rows)
+                # 前の送信が書けていた（書いた後に落ちた・応答だけ失敗した）なら送り直さない
+                if sent is not None and _already_written(sheet_obj, df, sent[0] or target, sent[1]):
+                    _after_write(sheet_obj, df, ws_name)
+                else:
+                    write_queue.mark_sending(item_id, target, key_rows.get(target, 0))
+                    _write_df(sheet_obj, df, ws_name, target)
+            write_queue.done(item_id)
+        except UnsendableRequest as e:
+            write_queue.fail(item_id, e, permanent=True)   # 送り直しても同じ（NaN など）
+            failed += 1
+        except Exception as e:
+            write_queue.fail(item_id, e)
+            failed += 1
+    return failed
+
+def _target_candidates(ws_name):
+    return ["今回の評価", PACKED_WS] if ws_name == "今回の評価" else [ws_name]
+
+def _write_target(ws_name, key_rows):
+    """実際に追記するワークシート名。今回の評価 は回答のある形式に書き続ける（key_rows は A列の行数）"""
+    return write_target(key_rows) if ws_name == "今回の評価" else ws_name
+
+def _sheet_rows(df, target):
+    """target（_write_target の結果）に実際に追記する行"""
+    return pack_rows(df) if target == PACKED_WS else df.values.tolist()
+
+def _already_written(sheet_obj, df, target, sent_from):
+    """この項目の行が、送信前の行数 sent_from より後にひと続きで書かれているか"""
+    rows = _sheet_rows(df, target)
+    used = fetch_used_rows(sheet_obj, [target]).get(target, 0)
+    start = max(2, sent_from + 1)
+    if not rows or used < start + len(rows) - 1:
+        return False
+    got = [trim_row(r) for r in batch_get_safe(sheet_obj, [f"{_quote(target)}!{start}:{used}"])[0]]
+    want = [trim_row(["" if v is None else str(v) for v in r]) for r in rows]
+    return any(got[i:i + len(want)] == want for i in range(len(got) - len(want) + 1))
+
+def _write_df(sheet_obj, df, ws_name, target=None):
+    if target is None:
+        target = _write_target(ws_name, fetch_key_rows(sheet_obj, _target_candidates(ws_name))
+                               if ws_name == "今回の評価" else {})
+    rows = _sheet_rows(df, target)
+    if target == PACKED_WS:
+        # 圧縮形式：保存1回分を 4 セルにまとめる（RAW なので式として解釈されない）
+        ws = ensure_ws(sheet_obj, PACKED_WS, packed_cols)
+        ws.append_rows(rows, value_input_option="RAW")
+    else:
+        ws = ensure_ws(sheet_obj, ws_name, df.columns.tolist())
+        append_rows_chunked(ws, rows)   # まとめてスキップ等の大きな追記も分割して送る
+    _after_write(sheet_obj, df, ws_name)
+
+def _after_write(sheet_obj, df, ws_name):
+    # 自分の書き込み直後はディスクキャッシュを使わない（Drive の更新時刻の反映遅れ対策）
+    if sheet_obj is log_sheet:
+        table_cache.invalidate(LOG_CACHE_KEY)
+    # 成功した追記はキャッシュ済みテーブルへ即反映（再読取しない）
+    if ws_name in ("今回の評価", "スキップログ"):
+        change_log.record(ws_name, frame_to_typed(df, ws_name))
+
+@profiler.stage("compute_remaining")
+def compute_remaining(image_list_df, combined_df, skip_df, username, archived_df=None, dup_index=None,
+                      folder_index=None, dead_urls=None):
+    """サーバ回答・スキップ・アーカイブ済み・セッション回答・セッション内スキップを除いた残り枚数を計算
+
+    画像URL が dead_urls（表示不可と確認済み）の未評価画像は出題されないので残りに含めず、別に数える。
+    戻り値は (残り合計, フォルダ別の残り, フォルダ別の表示不可)。
+    image_list_df が None（索引だけ読んでいる）ときは、索引の枚数から済みペアの数を引く
+    （画像URL が分からないので表示不可は数えない）。
+    """
     user_df = combined_df[combined_df["回答者"] == username].copy()
 
     answered_server = set(zip(user_df["選択フォルダ_norm"], user_df["画像ファイル名"]))
     skipped_server  = set(zip(skip_df["選択フォルダ_norm"],  skip_df["画像ファイル名"]))
+    answered_archived, skipped_archived = digest_pairs(archived_df, username)
     answered_local  = st.session_state.get("answered_pairs_session", set())
 
     # ★ 追加: セッション内のスキップ（まだシートを再読込していない分）も除外
@@ -115,48 +260,227 @@ def compute_remaining(image_list_df, combined_df, skip_df, username):
     )
 
     done_pairs = answered_server.union(skipped_server).union(answered_local).union(local_skipped)
+    done_pairs |= answered_archived | skipped_archived
+    if dup_index is not None:
+        done_pairs = dup_index.expand_done(done_pairs)  # 重複画像は1枚評価すれば済み
+
+    if image_list_df is None:
+        # 画像リストから消えた画像のペアも引いてしまうので概算（0 未満にはしない）
+        done_by_folder = Counter(f for f, _ in done_pairs)
+        if dup_index is not None:
+            done_by_folder.update(dup_index.extra_copies(done_pairs))   # 出題されない重複
+        remaining_by_folder = {f: max(0, folder_index.count(f) - done_by_folder.get(f, 0))
+                               for f in folder_index.folders}
+        return sum(remaining_by_folder.values()), remaining_by_folder, {}
 
     tmp = image_list_df.copy()
     tmp["pair_norm"] = list(zip(tmp["フォルダ_norm"], tmp["画像ファイル名"]))
     tmp["done"] = tmp["pair_norm"].isin(done_pairs)
+    tmp["dead"] = ~tmp["done"] & tmp["画像URL"].isin(dead_urls or ())
 
-    remaining_total = int((~tmp["done"]).sum())
-    remaining_by_folder = (
-        tmp.groupby("フォルダ_norm")["done"]
-           .apply(lambda s: int((~s).sum()))
-           .to_dict()
-    )
-    return remaining_total, remaining_by_folder
+    tmp["left"] = ~tmp["done"] & ~tmp["dead"]
+    if dup_index is not None:
+        # 未評価の重複グループは1回だけ数える（最初の1枚のフォルダに）
+        left = tmp.index[tmp["left"]]
+        tmp.loc[left[dup_index.redundant(tmp.loc[left, "pair_norm"].tolist())], "left"] = False
+
+    remaining_total = int(tmp["left"].sum())
+    grouped = tmp.groupby("フォルダ_norm", observed=True)
+    remaining_by_folder = grouped["left"].sum().astype(int).to_dict()
+    dead_by_folder = {f: n for f, n in grouped["dead"].sum().astype(int).to_dict().items() if n}
+    return remaining_total, remaining_by_folder, dead_by_folder
 
 
 
 # =========================
 # テーブル一括読取（キャッシュ）
 # =========================
-@st.cache_data(ttl=600)
-def load_all_tables():
-    # IMAGE_SHEET: 画像リスト
+@st.cache_resource
+def get_table_cache():
+    """読み込んだテーブルのディスクキャッシュ（再起動後も更新時刻が同じなら再ダウンロードしない）"""
+    return TableCache()
+
+table_cache = get_table_cache()
+LOG_CACHE_KEY = f"log_{LOG_SHEET_ID}"
+
+@st.cache_resource
+def get_lazy_images():
+    """画像リストのフォルダ単位の取得（画像フォルダ索引シートがあるとき。全セッション共有）"""
+    return LazyImageList(image_sheet)
+
+def _fetch_image_tables():
     img_vals = batch_get_safe(image_sheet, ["画像リスト!A1:C"])
-    # LOG_SHEET: 今回の評価 + スキップログ
-    log_vals = batch_get_safe(log_sheet, ["今回の評価!A1:I", "スキップログ!A1:F"])
-    img_df  = _to_df(img_vals[0] if img_vals else [], image_cols)
-    eval_df = _to_df(log_vals[0] if len(log_vals) > 0 else [], required_cols)
-    skip_df = _to_df(log_vals[1] if len(log_vals) > 1 else [], skip_cols)
+    img_df, img_issues = parse_table(img_vals[0] if img_vals else [], image_cols, "画像リスト")
+    img_df["フォルダ_norm"] = norm_folder_series(img_df["フォルダ"])
+    return {"画像リスト": img_df}, img_issues
 
-    # ★ 正規化列を付与
-    img_df["フォルダ_norm"] = img_df["フォルダ"].map(norm_folder)
-    eval_df["選択フォルダ_norm"] = eval_df["選択フォルダ"].map(norm_folder)
-    skip_df["選択フォルダ_norm"] = skip_df["選択フォルダ"].map(norm_folder)
-    return img_df, eval_df, skip_df
+def _fetch_log_tables():
+    # LOG_SHEET: 今回の評価 + スキップログ
+    log_vals = batch_get_safe(log_sheet, ["今回の評価!A1:I", "スキップログ!A1:F", f"{DIGEST_WS}!A1:E",
+                                          f"{PACKED_WS}!A1:D"])
+    # 型付き取り込み（カテゴリ列・小整数の件数列）。不正行は issues で報告
+    rows_df, eval_issues = parse_table(log_vals[0] if len(log_vals) > 0 else [], required_cols, "今回の評価")
+    # 圧縮形式の行は通常形式に戻して同じ表に足す（現在の書き込み形式を後ろに = 同じ回答はそちらが残る）
+    packed_vals, packed_issues = unpack_values(log_vals[3] if len(log_vals) > 3 else [])
+    packed_df, more_issues = parse_table(packed_vals, required_cols, "今回の評価")
+    eval_issues += packed_issues + more_issues
+    parts = {"今回の評価": rows_df, PACKED_WS: packed_df}
+    if len(rows_df) and len(packed_df):
+        eval_issues.append(MIXED_ISSUE)
+    eval_df = concat_typed([parts[n] for n in log_formats()])
+    skip_df, skip_issues = parse_table(log_vals[1] if len(log_vals) > 1 else [], skip_cols, "スキップログ")
+
+    # ★ 正規化列を付与（ユニーク値単位の .str 演算）
+    eval_df["選択フォルダ_norm"] = norm_folder_series(eval_df["選択フォルダ"])
+    skip_df["選択フォルダ_norm"] = norm_folder_series(skip_df["選択フォルダ"])
+    # アーカイブ済みペア（完了ダイジェスト）
+    archived_df = expand_digest(log_vals[2] if len(log_vals) > 2 else [])
+    return {"今回の評価": eval_df, "スキップログ": skip_df, DIGEST_WS: archived_df}, eval_issues + skip_issues
+
+def fetch_lock(key):
+    """複数プロセス運用では同じシートの読込を1回に任せる（他は保存されたキャッシュを使う）
+
+    保持者は呼び出しごとに別（同じプロセスの別セッションとも排他にする）。
+    """
+    return lease_store.hold(f"fetch:{key}") if lease_store is not None else contextlib.nullcontext()
 
-# 初回ロード（以後は手動リロードまで再読取しない）
-image_list_df, combined_df, skip_df = load_all_tables()
+@st.cache_data(ttl=600)
+def load_all_tables():
+    # 読み始め時点の共有ログ版数（これ以降の追記は current_tables でマージ）
+    base_version = get_change_log().version
+    loaded_at = time.time()
+    # IMAGE_SHEET: 画像リスト（ローカルフォルダ指定時はシートを読まない）
+    # 索引シート（build_image_list.py --index）があれば画像リストは読まず、フォルダ単位で取得する
+    folder_index = None if LOCAL_IMAGE_ROOT else get_lazy_images().load_index()
+    img_df, img_issues = None, []
+    if LOCAL_IMAGE_ROOT:
+        img_df = scan_image_folder(LOCAL_IMAGE_ROOT)
+    elif folder_index is None:
+        # 更新時刻が前回と同じならディスクキャッシュから（メタデータ1回だけ）
+        frames, img_issues, _ = table_cache.cached(f"image_{IMAGE_SHEET_ID}", image_sheet, _fetch_image_tables,
+                                                   lock=fetch_lock)
+        img_df = frames["画像リスト"]
+    if img_df is not None:
+        # フォルダ順に並べておき、フォルダの行は索引で切り出す（毎回の絞り込みをしない）
+        img_df, folder_index = sort_by_folder(img_df)
+    # ディスクから戻した表は保存時（その表を読み始めた時点）の版数以降の追記を重ねる
+    frames, log_issues, log_version = table_cache.cached(LOG_CACHE_KEY, log_sheet, _fetch_log_tables,
+                                                         lock=fetch_lock, version=base_version)
+    eval_df, skip_df, archived_df = frames["今回の評価"], frames["スキップログ"], frames[DIGEST_WS]
+
+    meta = {"issues": img_issues + log_issues, "version": log_version,
+            "loaded_at": loaded_at, "archived_df": archived_df, "folder_index": folder_index}
+    return img_df, eval_df, skip_df, meta
+
+def current_tables():
+    """キャッシュ済みテーブル + 共有ログの追記分（read-your-writes）"""
+    with profiler.stage("load_all_tables"):
+        img_df, eval_df, skip_df, meta = load_all_tables()
+    eval_df = change_log.merged("今回の評価", eval_df, meta["version"], meta["loaded_at"])
+    skip_df = change_log.merged("スキップログ", skip_df, meta["version"], meta["loaded_at"])
+    return img_df, eval_df, skip_df, meta
+
+# 初回ロード（以後は手動リロードまで再読取しない。追記分は共有ログからマージ）
+image_list_df, combined_df, skip_df, load_meta = current_tables()
+ingest_issues = load_meta["issues"]
+archived_df   = load_meta["archived_df"]
+folder_index  = load_meta["folder_index"]   # image_list_df が None なら索引だけ（フォルダ単位で取得）
+
+def folder_rows(folder_norm):
+    """フォルダの画像行（並べ替え済みの全件から切り出し or 索引の範囲だけ取得）"""
+    if image_list_df is not None:
+        return folder_index.slice(image_list_df, folder_norm)
+    return get_lazy_images().rows(folder_index, folder_norm)
+
+def full_image_list():
+    """全件が必要な管理機能（全員の進捗・アーカイブ）用。索引モードでは初回だけ全件を読む"""
+    if image_list_df is not None:
+        return image_list_df
+    try:
+        return get_lazy_images().full(folder_index)
+    except StaleIndexError as e:
+        # フォルダ単位の取得と同じ：このプロセスでは全件読み込みに戻す
+        st.warning(f"画像フォルダ索引が古いため、画像リストを全件読み直します（{e}）")
+        load_all_tables.clear()
+        st.rerun()
 
 # =========================
 # ログイン
 # =========================
 USER_CREDENTIALS = {"mamiya": "a", "arai": "a", "yamazaki": "protoplast"}
 
+def buffer_owner():
+    """このセッションの未保存バッファの持ち主 ID"""
+    if "buffer_owner" not in st.session_state:
+        st.session_state.buffer_owner = f"{WORKER_ID}/{uuid.uuid4().hex[:8]}"
+    return st.session_state.buffer_owner
+
+def restore_cursor(user):
+    """保存済みカーソル（フォルダ順・位置）と未保存バッファをセッションへ復元。
+
+    バッファは引き取る（他のセッションに残っていた分はそちらでは書かれなくなる）。
+    """
+    entries = cursor_store.take_buffers(user)
+    if entries:
+        cursor_store.save_buffer(user, buffer_owner(), entries)   # 引き取った分をすぐ自分の行に
+    st.session_state.buffered_entries = entries
+    st.session_state.buffer_saved = list(entries)
+    st.session_state.answered_pairs_session = {(e["選択フォルダ"], e["画像ファイル名"]) for e in entries}
+    cur = cursor_store.load(user)
+    if not cur:
+        return bool(entries)
+    # 保存後に画像リストへ追加されたフォルダは末尾に（ランダム順で）足す
+    order = list(cur["folder_order"])
+    known = set(order)
+    added = [f for f in folder_index.folders if f not in known]
+    random.shuffle(added)
+    st.session_state.folder_order = order + added
+    st.session_state.folder_index = cur["folder_index"]
+    if cur.get("image_files"):
+        st.session_state.image_files = pd.DataFrame(cur["image_files"])
+        st.session_state.index = cur["index"]
+    st.session_state.restored_lease_holder = cur.get("lease_holder")
+    st.session_state.cursor_restored = True
+    return True
+
+def save_cursor(user):
+    """現在のカーソルを保存（位置・バッファが変わった時だけ書く）"""
+    ss = st.session_state
+    if "folder_order" not in ss:
+        return
+    image_files = ss.get("image_files")
+    fp = (len(ss.folder_order), ss.folder_index, ss.get("index"),
+          None if image_files is None else len(image_files),
+          tuple(tuple(e.values()) for e in ss.buffered_entries))
+    if ss.get("cursor_fp") == fp:
+        return
+    save_buffer(user)
+    cursor_store.save(user, {
+        "folder_order": list(ss.folder_order),
+        "folder_index": ss.folder_index,
+        "index": ss.get("index", 0),
+        "image_files": None if image_files is None else image_files.astype(object).to_dict("records"),
+        "lease_holder": ss.get("lease_holder"),
+    })
+    ss.cursor_fp = fp
+
+def _drop_claimed():
+    """前に保存したバッファが他のセッションに引き取られた：その分は向こうが書くので捨てる"""
+    ss = st.session_state
+    saved = ss.get("buffer_saved", [])
+    ss.buffered_entries = [e for e in ss.buffered_entries if e not in saved]
+    ss.buffer_saved = []
+
+def save_buffer(user):
+    """未保存バッファを自分の行に保存（引き取られていたら、その分を捨ててから）"""
+    ss = st.session_state
+    if ss.buffered_entries == ss.get("buffer_saved", []):
+        return
+    if not cursor_store.save_buffer(user, buffer_owner(), ss.buffered_entries, expect_row=bool(ss.get("buffer_saved"))):
+        _drop_claimed()
+        cursor_store.save_buffer(user, buffer_owner(), ss.buffered_entries)
+    ss.buffer_saved = list(ss.buffered_entries)
+
 if "authenticated" not in st.session_state:
     st.session_state.authenticated = False
 
@@ -168,6 +492,7 @@ if not st.session_state.authenticated:
         if input_username in USER_CREDENTIALS and USER_CREDENTIALS[input_username] == input_password:
             st.session_state.authenticated = True
             st.session_state.username = re.sub(r'[^a-zA-Z0-9_一-龯ぁ-んァ-ヶ]', '_', input_username.strip())
+            restore_cursor(st.session_state.username)
             st.success("ログイン成功")
             st.rerun()
         else:
@@ -176,13 +501,35 @@ if not st.session_state.authenticated:
 
 username = st.session_state.username
 st.sidebar.markdown(f"**ログイン中:** `{username}`")
+profiler.tag(username)
+if "lease_holder" not in st.session_state:
+    st.session_state.lease_holder = f"{WORKER_ID}/{uuid.uuid4().hex[:8]}"
+    # ログインし直した（別プロセスに繋がった）ら、前のセッションの表示中の画像を引き継ぐ。
+    # 前のセッションがまだ動いている（別タブで開いたまま）ときは引き継がず、新しい保持者で続ける
+    prev_holder = st.session_state.pop("restored_lease_holder", None)
+    if lease_store is not None and prev_holder:
+        lease_store.transfer(prev_holder, st.session_state.lease_holder)
+if lease_store is not None:
+    lease_store.heartbeat(st.session_state.lease_holder)
+
+# 前回失敗した書き込み（他プロセスの分も）があれば再送
+if write_queue is not None:
+    drain_writes()
+if st.session_state.pop("write_deferred", False):
+    st.sidebar.warning("シートへの書き込みに失敗しました。キューに残したので後で自動的に再送します。")
 
 # =========================
 # セッション内メモリ（重複防止）
 # =========================
 # スキップキー（回答者×選択フォルダ_norm×画像ファイル名）
+def build_skip_keys(skip_df, archived_df):
+    """(回答者, 選択フォルダ_norm, 画像ファイル名)：スキップログ + アーカイブ済みスキップ"""
+    arc = archived_df[archived_df["種別"] == "スキップ"]
+    return (set(zip(skip_df["回答者"], skip_df["選択フォルダ_norm"], skip_df["画像ファイル名"]))
+            | set(zip(arc["回答者"], arc["選択フォルダ_norm"], arc["画像ファイル名"])))
+
 if "skip_keys" not in st.session_state:
-    st.session_state.skip_keys = set(zip(skip_df["回答者"], skip_df["選択フォルダ_norm"], skip_df["画像ファイル名"]))
+    st.session_state.skip_keys = build_skip_keys(skip_df, archived_df)
 
 # セッションで新規に回答済みの (選択フォルダ_norm, 画像ファイル名) を追跡
 if "answered_pairs_session" not in st.session_state:
@@ -192,38 +539,145 @@ if "answered_pairs_session" not in st.session_state:
 if "buffered_entries" not in st.session_state:
     st.session_state.buffered_entries = []
 
+def flush_buffer():
+    """バッファを今回の評価へ追記してクリア（カーソルも保存）。書いたら True
+
+    書く前に保存済みの自分の行を引き取る（他のセッションと同じ回答を書かない）。
+    """
+    ss = st.session_state
+    if cursor_store.take_buffers(username, buffer_owner()) is None and ss.get("buffer_saved"):
+        _drop_claimed()
+    ss.buffer_saved = []
+    if not ss.buffered_entries:
+        return False
+    buffered_df = pd.DataFrame(ss.buffered_entries)
+    try:
+        append_df_to_sheet(log_sheet, buffered_df[required_cols], "今回の評価")
+        # 推定値を初期値に入れた回答：送信値が推定のままだったか（監査用）
+        if "推定値" in buffered_df.columns:
+            est_df = buffered_df[buffered_df["推定値"].notna()]
+            append_df_to_sheet(log_sheet, est_df[estimate_log_cols], ESTIMATE_LOG_WS)
+    except Exception:
+        save_buffer(username)   # 書けなかった分は自分の行に戻す
+        raise
+    ss.buffered_entries = []
+    save_cursor(username)
+    return True
+
+if st.session_state.pop("cursor_restored", False):
+    st.sidebar.info("前回の続きから再開しました")
+
 # =========================
 # サイドバー：運用ツール（手動発火）
 # =========================
 with st.sidebar.expander("データ更新・保守", expanded=False):
+    log_stats = change_log.stats()
+    st.caption(f"共有ログ v{log_stats['version']}（未再読込の追記 {log_stats['pending_rows']} 行をマージ中）")
+    st.caption(f"ディスクキャッシュ: 再利用 {table_cache.hits} 回 / 再ダウンロード {table_cache.misses} 回")
+    if write_queue is not None:
+        wq = write_queue.stats()
+        st.caption(f"複数プロセス運用（{WORKER_ID}）: 未送信の書き込み {wq['items']} 件 / {wq['rows']} 行"
+                   + (f"（直近のエラー: {wq['last_error']}）" if wq["items"] and wq["last_error"] else ""))
+        if wq["dead"]:
+            st.error(f"{wq['dead']} 件 / {wq['dead_rows']} 行の書き込みが {MAX_ATTEMPTS} 回失敗したため再送を止めています"
+                     f"（直近のエラー: {wq['last_error']}）。原因を直してから再送してください。")
+            if st.button("保留中の書き込みを再送する"):
+                write_queue.requeue_dead()
+                failed = drain_writes()
+                st.success("再送しました" if not failed else f"{failed} 件はまた失敗しました（キューに残しています）")
+    ts = transport_stats()
+    if ts["requests"]:
+        st.caption(f"Sheets 通信: {ts['requests']:,} 回（p50 {ts['p50_ms']:.0f} ms / p95 {ts['p95_ms']:.0f} ms, "
+                   f"エラー {ts['errors']:,}）/ 受信 {ts['bytes_received'] / 2**20:,.1f} MB"
+                   f"（展開後 {ts['bytes_decoded'] / 2**20:,.1f} MB）/ 送信 {ts['bytes_sent'] / 2**20:,.1f} MB")
+    if image_list_df is None:
+        st.caption(f"画像リスト: 索引 {len(folder_index):,} フォルダ / {folder_index.total:,} 枚"
+                   f"（フォルダ単位の取得 {get_lazy_images().fetches} 回）")
     if st.button("シートを再読み込み"):
-        st.cache_data.clear()
-        image_list_df, combined_df, skip_df = load_all_tables()
+        table_cache.invalidate(LOG_CACHE_KEY)   # 手動の再読み込みはログを必ず取り直す
+        load_all_tables.clear()
+        image_list_df, combined_df, skip_df, load_meta = current_tables()
+        ingest_issues, archived_df = load_meta["issues"], load_meta["archived_df"]
+        folder_index = load_meta["folder_index"]
         # セッション内キー再構築（正規化版）
-        st.session_state.skip_keys = set(zip(skip_df["回答者"], skip_df["選択フォルダ_norm"], skip_df["画像ファイル名"]))
+        st.session_state.skip_keys = build_skip_keys(skip_df, archived_df)
         st.success("最新データに更新しました")
+    if st.button("評価順をリセット（最初から）"):
+        flush_buffer()
+        cursor_store.clear(username)
+        for k in ("folder_order", "folder_index", "image_files", "index", "cursor_fp"):
+            st.session_state.pop(k, None)
+        st.rerun()
+
+if username in ADMIN_USERS:
+    with st.sidebar.expander("遅い再実行のプロファイル（管理者向け）", expanded=False):
+        st.number_input("しきい値（ms, 0 = 無効）", min_value=0, value=profiler.threshold_ms, step=100,
+                        key="profile_ms", on_change=lambda: profiler.configure(st.session_state.profile_ms))
+        st.caption(f"全員の再実行のうち、しきい値を超えたものだけスタックを保存します（{PROFILE_DIR}、"
+                   f"最新 {MAX_PROFILES} 件まで。flamegraph.pl / speedscope で開けます）")
+        st.caption(f"計測 {profiler.measured:,} 回 / 保存 {profiler.saved:,} 件")
+        slow_runs = profiler.slowest(10)
+        for r in slow_runs:
+            stages = " / ".join(f"{k} {v:,.0f}ms" for k, v in sorted(r["stages"].items(), key=lambda kv: -kv[1]))
+            st.write(f"- {time.strftime('%m-%d %H:%M:%S', time.localtime(r['at']))} {r['label'] or '-'} "
+                     f"**{r['ms']:,.0f} ms**" + (f"（{stages}）" if stages else ""))
+        saved_runs = [r["path"] for r in slow_runs if r["path"]]
+        if saved_runs:
+            profile_path = st.selectbox("ダウンロードするプロファイル", saved_runs, format_func=os.path.basename)
+            with open(profile_path, "rb") as f:
+                st.download_button("プロファイルをダウンロード", f.read(), os.path.basename(profile_path), "text/plain")
+
+with st.sidebar.expander("画像キャッシュ（全員で共有）", expanded=False):
+    cs = image_cache.stats()
+    st.write(f"- {cs['items']:,} 枚 / {cs['bytes'] / 2**20:,.1f} MB（上限 {cs['max_bytes'] / 2**20:,.0f} MB）")
+    st.write(f"- ヒット率 {cs['hit_rate']:.1%}（ヒット {cs['hits']:,} / ミス {cs['misses']:,} / 同時取得の合流 {cs['coalesced']:,}）")
+    st.write(f"- 追い出し {cs['evictions']:,} / 取得エラー {cs['errors']:,}（失敗を覚えていて取得を省いた {cs['failed_hits']:,}）")
+
+with st.sidebar.expander("表示設定", expanded=False):
+    tile_mode = st.toggle("タイル表示（大きな画像を拡大して見る）", key="tile_mode")
+
+if ingest_issues:
+    with st.sidebar.expander(f"取り込み時の不正行（{len(ingest_issues)}件）", expanded=False):
+        st.write("\n".join(f"- {msg}" for msg in ingest_issues[:50]))
+        if len(ingest_issues) > 50:
+            st.caption(f"ほか {len(ingest_issues) - 50} 件")
+
+@st.cache_resource
+def get_cell_monitor():
+    """セル使用量モニタ（プロセス内で1つ。30分に1回自動チェックし、上限の8割で自動縮小）"""
+    return CellUsageMonitor()
 
-with st.sidebar.expander("セル使用量をチェック（押した時だけ）", expanded=False):
+cell_monitor = get_cell_monitor()
+cell_monitor.maybe_check(log_sheet)   # 裏のスレッドで実行（この再実行は待たない）
+
+with st.sidebar.expander("セル使用量をチェック（メタデータのみ）", expanded=False):
     if st.button("今すぐチェックする"):
         try:
-            total_cells = 0
-            details = []
-            for ws in log_sheet.worksheets():
-                cells = ws.row_count * ws.col_count
-                total_cells += cells
-                details.append(f"{ws.title}: {ws.row_count} rows × {ws.col_count} cols = {cells:,} cells")
-            st.write("### LOG_SHEET 全体セル数:", f"{total_cells:,}")
-            st.write("\n".join(details))
+            cell_monitor.check(log_sheet)
         except Exception as e:
             st.error(f"セル使用量チェックでエラー: {e}")
+    report = cell_monitor.last_report
+    if report:
+        st.write("### LOG_SHEET 全体セル数:", f"{report['total_cells']:,}（上限の {report['total_cells'] / CELL_LIMIT:.1%}）")
+        details = []
+        for sz in report["sheets"]:
+            used = f"、使用 {sz['used_rows']:,} 行" if sz["used_rows"] is not None else ""
+            details.append(f"{sz['title']}: {sz['rows']} rows × {sz['cols']} cols = {sz['rows'] * sz['cols']:,} cells{used}")
+        st.write("\n".join(details))
+        for line in report["shrunk"]:
+            st.caption(f"自動縮小: {line}")
+        growth = cell_monitor.growth_per_day(report["spreadsheet"])
+        if growth:
+            st.caption("増加ペース: " + " / ".join(f"{t} {g:+,.0f} 行/日" for t, g in growth.items()))
+        st.caption("最終チェック: " + time.strftime("%Y-%m-%d %H:%M", time.localtime(report["ts"])))
 
 with st.sidebar.expander("巨大シートの最適化（手動）", expanded=False):
     def shrink_to_minimal(ws, keep_cols: list):
         try:
-            used_rows = len(ws.get_all_values())  # ここは手動時のみ呼ぶ
+            used_rows = fetch_used_rows(log_sheet, [ws.title])[ws.title]
             if used_rows == 0:
                 used_rows = 1
-            ws.resize(rows=used_rows + 100, cols=len(keep_cols))
+            ws.resize(rows=used_rows + SHRINK_MARGIN, cols=len(keep_cols))
             ws.update('A1', [keep_cols])
             st.success(f"{ws.title}: {used_rows}行, {len(keep_cols)}列 に最適化しました。")
         except Exception as e:
@@ -243,6 +697,29 @@ with st.sidebar.expander("巨大シートの最適化（手動）", expanded=Fal
         except Exception as e:
             st.error(f"今回の評価取得エラー: {e}")
 
+with st.sidebar.expander("ログのアーカイブ（手動）", expanded=False):
+    st.markdown("古い行・完了フォルダの行をアーカイブへ移し、判定用に **完了ダイジェスト** を残します。")
+    keep_recent = st.number_input("ホットに残す直近の行数（0 = 行数で切らない）", min_value=0, value=0, step=1000)
+    archive_completed = st.checkbox("回答者ごとに完了したフォルダの行を移す", value=True)
+    archive_target = st.radio("アーカイブ先", ["parquet", "sheet"], horizontal=True,
+                              format_func=lambda t: "ローカル Parquet" if t == "parquet" else "アーカイブ用シート")
+    if st.button("アーカイブを実行"):
+        try:
+            summary = run_archive(log_sheet, full_image_list(),
+                                  keep_recent=keep_recent or None, completed_only=archive_completed,
+                                  target=archive_target)
+            # 移した行はホット側から削除済み（行の位置が変わる）ので、ベースを読み直す
+            table_cache.invalidate(LOG_CACHE_KEY)
+            load_all_tables.clear()
+            image_list_df, combined_df, skip_df, load_meta = current_tables()
+            archived_df, folder_index = load_meta["archived_df"], load_meta["folder_index"]
+            st.session_state.skip_keys = build_skip_keys(skip_df, archived_df)
+            for name, (moved, kept, dest) in summary.items():
+                st.write(f"- {name}: {moved:,} 行を移動 / ホット {kept:,} 行" + (f"（{dest}）" if dest else ""))
+            st.success("アーカイブ完了")
+        except Exception as e:
+            st.error(f"アーカイブ中のエラー: {e}")
+
 with st.sidebar.expander("スキップログ重複クリーニング（手動）", expanded=False):
     st.markdown("**回答者×選択フォルダ×画像ファイル名（選択フォルダは正規化）** で重複削除（最後の1件を残す）。")
     if st.button("重複削除を実行"):
@@ -259,61 +736,64 @@ with st.sidebar.expander("スキップログ重複クリーニング（手動）
                         df[c] = ""
                 df = df[skip_cols]
                 # 正規化キーを追加
-                df["選択フォルダ_norm"] = df["選択フォルダ"].map(norm_folder)
+                df["選択フォルダ_norm"] = norm_folder_series(df["選択フォルダ"])
                 df_dedup = df.drop_duplicates(subset=["回答者","選択フォルダ_norm","画像ファイル名"], keep="last").copy()
                 # 書き戻しは正規化名で統一
                 df_dedup["選択フォルダ"] = df_dedup["選択フォルダ_norm"]
                 df_dedup = df_dedup[skip_cols]
 
-                ws.clear()
-                ws.resize(rows=1, cols=len(skip_cols))
-                ws.update("A1", [skip_cols])
-                CHUNK = 1000
-                rows = df_dedup.values.tolist()
-                for i in range(0, len(rows), CHUNK):
-                    ws.append_rows(rows[i:i+CHUNK], value_input_option="USER_ENTERED")
-
-                # キャッシュ＆セッション更新
-                st.cache_data.clear()
-                _, _, skip_df = load_all_tables()
-                st.session_state.skip_keys = set(zip(skip_df["回答者"], skip_df["選択フォルダ_norm"], skip_df["画像ファイル名"]))
+                rewrite_ws(ws, skip_cols, df_dedup.values.tolist())
+                table_cache.invalidate(LOG_CACHE_KEY)
+
+                # 共有テーブルを書き換え後の内容に置換（再読取しない）＆セッション更新
+                change_log.replace("スキップログ", frame_to_typed(df_dedup, "スキップログ"))
+                _, _, skip_df, _ = current_tables()
+                st.session_state.skip_keys = build_skip_keys(skip_df, archived_df)
                 st.success(f"重複削除（正規化）完了: {len(df)} → {len(df_dedup)} 行")
         except Exception as e:
             st.error(f"重複クリーニング中のエラー: {e}")
 
 with st.sidebar.expander("今回の評価 重複クリーニング（手動）", expanded=False):
-    st.markdown("**回答者×選択フォルダ×画像ファイル名（選択フォルダは正規化）** で重複削除（最後の1件を残す）。")
+    st.markdown("**回答者×選択フォルダ×画像ファイル名（選択フォルダは正規化）** で重複削除（最後の1件を残す）。"
+                "圧縮形式（今回の評価_packed）の回答も含め、結果は現在の書き込み形式のシートにまとめる。"
+                "FUSION_PACKED_LOG を切り替えたときは、これを実行するまで元の形式に書き続ける。")
     if st.button("今回の評価の重複削除を実行"):
         try:
-            ws = log_sheet.worksheet("今回の評価")
-            vals = ws.get_all_values()
-            if not vals:
+            row_vals, packed_raw = batch_get_safe(log_sheet, ["今回の評価!A1:I", f"{PACKED_WS}!A1:D"])
+            packed_vals, packed_issues = unpack_values(packed_raw)
+            if packed_issues:
+                # 読めない圧縮行があると書き直しで失われるので中止
+                st.error("今回の評価_packed に読めない行があるため中止しました: " + " / ".join(packed_issues))
+            elif not row_vals and len(packed_vals) <= 1:
                 st.info("今回の評価が空です。")
             else:
-                header, data = vals[0], vals[1:]
-                df = pd.DataFrame(data, columns=header)
-                for c in required_cols:
-                    if c not in df.columns:
-                        df[c] = ""
-                df = df[required_cols]
+                frames = []
+                by_ws = {"今回の評価": row_vals, PACKED_WS: packed_vals}
+                for vals in (by_ws[n] for n in log_formats()):   # 読込と同じ順（現在の書き込み形式が後ろ）
+                    if len(vals) > 1:
+                        frames.append(pd.DataFrame(vals[1:], columns=vals[0]).reindex(columns=required_cols))
+                df = pd.concat(frames, ignore_index=True).fillna("") if frames else pd.DataFrame(columns=required_cols)
                 # 正規化キーを追加
-                df["選択フォルダ_norm"] = df["選択フォルダ"].map(norm_folder)
+                df["選択フォルダ_norm"] = norm_folder_series(df["選択フォルダ"])
                 df_dedup = df.drop_duplicates(subset=["回答者","選択フォルダ_norm","画像ファイル名"], keep="last").copy()
                 # 書き戻しは正規化名で統一
                 df_dedup["選択フォルダ"] = df_dedup["選択フォルダ_norm"]
                 df_dedup = df_dedup[required_cols]
 
-                ws.clear()
-                ws.resize(rows=1, cols=len(required_cols))
-                ws.update("A1", [required_cols])
-                CHUNK = 1000
-                rows = df_dedup.values.tolist()
-                for i in range(0, len(rows), CHUNK):
-                    ws.append_rows(rows[i:i+CHUNK], value_input_option="USER_ENTERED")
-
-                # 再読込
-                st.cache_data.clear()
-                image_list_df, combined_df, skip_df = load_all_tables()
+                # 先に書き込み先を書き直してから、もう一方を空にする（途中で失敗しても回答は消えない）
+                row_ws, packed_ws = log_sheet.worksheet("今回の評価"), log_sheet.worksheet(PACKED_WS)
+                if PACKED_LOG:
+                    rewrite_ws(packed_ws, packed_cols, pack_rows(df_dedup))
+                    rewrite_ws(row_ws, required_cols, [])
+                else:
+                    rewrite_ws(row_ws, required_cols, df_dedup.values.tolist())
+                    rewrite_ws(packed_ws, packed_cols, [])
+                table_cache.invalidate(LOG_CACHE_KEY)
+
+                # 共有テーブルを書き換え後の内容に置換（再読取しない）
+                change_log.replace("今回の評価", frame_to_typed(df_dedup, "今回の評価"))
+                image_list_df, combined_df, skip_df, load_meta = current_tables()
+                folder_index = load_meta["folder_index"]
                 st.success(f"重複削除（正規化）完了: {len(df)} → {len(df_dedup)} 行")
         except Exception as e:
             st.error(f"重複クリーニング中のエラー: {e}")
@@ -322,13 +802,13 @@ with st.sidebar.expander("今回の評価 重複クリーニング（手動）",
 # 評価フロー構築
 # =========================
 # 画像リストが空なら停止
-if image_list_df.empty:
+if not len(folder_index):
     st.warning("画像リストが空です。画像リストシートを確認してください。")
     st.stop()
 
 # フォルダ順（最初の一回だけランダム）→ 正規化名で管理
 if "folder_order" not in st.session_state:
-    all_folders = image_list_df["フォルダ_norm"].dropna().unique().tolist()
+    all_folders = list(folder_index.folders)
     random.shuffle(all_folders)
     st.session_state.folder_order = all_folders
     st.session_state.folder_index = 0
@@ -336,20 +816,24 @@ if "folder_order" not in st.session_state:
 folder_names = st.session_state.folder_order
 if st.session_state.folder_index >= len(folder_names):
     # 最後にバッファ吐き出し
-    if st.session_state.buffered_entries:
-        buffered_df = pd.DataFrame(st.session_state.buffered_entries)[required_cols]
-        append_df_to_sheet(log_sheet, buffered_df, "今回の評価")
-        st.session_state.buffered_entries = []
+    flush_buffer()
+    save_cursor(username)
     st.success("すべてのフォルダを評価しました！")
     st.stop()
 
 selected_folder_norm = folder_names[st.session_state.folder_index]
+phash_index = get_phash_index()
 # === 残り枚数（全体 / 現在フォルダ） ===
 with st.sidebar.expander("進捗（残り枚数）", expanded=True):
     try:
-        remaining_total, remaining_by_folder = compute_remaining(image_list_df, combined_df, skip_df, username)
+        remaining_total, remaining_by_folder, dead_by_folder = compute_remaining(
+            image_list_df, combined_df, skip_df, username, archived_df, phash_index, folder_index,
+            url_checker.dead())
         st.metric("全体の残り", remaining_total)
         st.metric("このフォルダの残り", remaining_by_folder.get(selected_folder_norm, 0))
+        if dead_by_folder:
+            st.caption(f"表示不可 {sum(dead_by_folder.values()):,} 枚（このフォルダ "
+                       f"{dead_by_folder.get(selected_folder_norm, 0):,} 枚）は出題しないので残りに含めていません")
 
         # 残りが多い順に上位だけ（例：10件）を簡易表示
         top_items = sorted(remaining_by_folder.items(), key=lambda x: x[1], reverse=True)[:10]
@@ -362,19 +846,121 @@ with st.sidebar.expander("進捗（残り枚数）", expanded=True):
     except Exception as e:
         st.error(f"残り枚数の計算でエラー: {e}")
 
-# 表示は元のフォルダ列を使いつつ、選択は_normで絞る
-folder_images = image_list_df[image_list_df["フォルダ_norm"] == selected_folder_norm].copy()
+@st.cache_resource
+def get_kinetics():
+    """融合キネティクスの集計（全セッション共有。評価ログの追記分だけ取り込む）"""
+    return KineticsEngine()
+
+with st.sidebar.expander("融合キネティクス（管理者向け）", expanded=False):
+    if st.checkbox("条件 × 時間で集計する", key="show_kinetics"):
+        t0 = time.time()
+        kinetics = get_kinetics()
+        kinetics.update(combined_df, phash_index)
+        kin_df = kinetics.table()
+        st.caption(f"{int(kin_df['画像数'].sum()):,} 枚から集計（{time.time() - t0:.2f}s, 95%CI はブートストラップ。"
+                   "アーカイブ済みの行は含まない。重複画像には同じ回答者の評価を使う）")
+        if kin_df.empty:
+            st.caption("評価がまだありません。")
+        else:
+            chart = kin_df.dropna(subset=["分"]).pivot_table(index="分", columns="条件", values="融合率")
+            st.line_chart(chart)
+            st.dataframe(kin_df[["条件", "時間", "画像数", "融合率", "融合率_下限", "融合率_上限", "完全融合率"]]
+                         .style.format({c: "{:.1%}" for c in ("融合率", "融合率_下限", "融合率_上限", "完全融合率")}),
+                         hide_index=True)
+            csv_buf, pq_buf = io.BytesIO(), io.BytesIO()
+            export_table(kin_df, csv_buf, fmt="csv")
+            export_table(kin_df, pq_buf, fmt="parquet")
+            st.download_button("CSV をダウンロード", csv_buf.getvalue(), "fusion_kinetics.csv", "text/csv")
+            st.download_button("Parquet をダウンロード", pq_buf.getvalue(), "fusion_kinetics.parquet",
+                               "application/octet-stream")
 
-# 既存（サーバ）回答 + セッション中の新規回答 + スキップ を正規化キーで除外
-user_df = combined_df[combined_df["回答者"] == username].copy()
-answered_pairs_server = set(zip(user_df["選択フォルダ_norm"], user_df["画像ファイル名"]))
-answered_pairs_local  = st.session_state.answered_pairs_session
-skipped_pairs_server  = set(zip(skip_df["選択フォルダ_norm"], skip_df["画像ファイル名"]))
-done_pairs = answered_pairs_server.union(answered_pairs_local).union(skipped_pairs_server)
+@st.cache_resource
+def get_dashboard():
+    """全ログシートの差分同期の写し（全セッション共有）"""
+    return ProgressDashboard()
+
+@st.fragment(run_every=REFRESH_SEC)
+def render_dashboard():
+    dashboard = get_dashboard()
+    dashboard.refresh(gc)
+    eval_all, skip_all, digest_all = dashboard.tables()
+    by_folder = remaining_by_user(full_image_list(), eval_all, skip_all, digest_all, phash_index)
+    rates = dashboard.throughput()
+    done_n = eval_all["回答者"].astype(object).value_counts()
+    summary = pd.DataFrame({
+        "評価済み": done_n.reindex(by_folder.columns, fill_value=0),
+        "残り": by_folder.sum(),
+        "枚/時": pd.Series(rates, dtype="float64").reindex(by_folder.columns),
+    })
+    summary["残り時間(h)"] = summary["残り"] / summary["枚/時"].where(summary["枚/時"] > 0)
+    st.caption(f"最終同期: {time.strftime('%H:%M:%S', time.localtime(dashboard.refreshed_at))}"
+               f"（{REFRESH_SEC}秒ごとに追記分だけ取得）")
+    for label, err in dashboard.errors().items():
+        st.warning(f"{label} のログを取得できませんでした（前回の内容を表示）: {err}")
+    st.dataframe(summary.style.format({"枚/時": "{:.0f}", "残り時間(h)": "{:.1f}"}, na_rep="-"))
+    st.write("フォルダ別の残り（回答者ごと）")
+    st.dataframe(by_folder[by_folder.sum(axis=1) > 0])
+
+with st.sidebar.expander("全員の進捗（リーダー向け）", expanded=False):
+    if st.checkbox("全ログシートを集計する", key="show_dashboard"):
+        render_dashboard()
+
+# 表示は元のフォルダ列を使いつつ、選択は_normで絞る（索引で該当範囲だけ）
+try:
+    folder_images = folder_rows(selected_folder_norm).copy()
+except StaleIndexError as e:
+    # 索引作成後に画像リストが書き換えられた：このプロセスでは全件読み込みに戻す
+    st.warning(f"画像フォルダ索引が古いため、画像リストを全件読み直します（{e}）")
+    load_all_tables.clear()
+    st.rerun()
+if image_list_df is None and st.session_state.folder_index + 1 < len(folder_names):
+    get_lazy_images().prefetch(folder_index, folder_names[st.session_state.folder_index + 1])
 
-# 正規化キーで判定
-folder_images["pair_norm"] = list(zip(folder_images["フォルダ_norm"], folder_images["画像ファイル名"]))
-filtered_images = folder_images[~folder_images["pair_norm"].isin(done_pairs)].drop(columns=["pair_norm"]).reset_index(drop=True)
+with profiler.stage("filtering"):
+    # 既存（サーバ）回答 + セッション中の新規回答 + スキップ を正規化キーで除外
+    user_df = combined_df[combined_df["回答者"] == username].copy()
+    answered_pairs_server = set(zip(user_df["選択フォルダ_norm"], user_df["画像ファイル名"]))
+    answered_pairs_local  = st.session_state.answered_pairs_session
+    skipped_pairs_server  = set(zip(skip_df["選択フォルダ_norm"], skip_df["画像ファイル名"]))
+    answered_pairs_archived, skipped_pairs_archived = digest_pairs(archived_df, username)
+    done_pairs = answered_pairs_server.union(answered_pairs_local).union(skipped_pairs_server)
+    done_pairs |= answered_pairs_archived | skipped_pairs_archived
+    if phash_index is not None:
+        done_pairs = phash_index.expand_done(done_pairs)
+
+    # 正規化キーで判定
+    folder_images["pair_norm"] = list(zip(folder_images["フォルダ_norm"], folder_images["画像ファイル名"]))
+    filtered_images = folder_images[~folder_images["pair_norm"].isin(done_pairs)].drop(columns=["pair_norm"]).reset_index(drop=True)
+    if phash_index is not None:
+        filtered_images = phash_index.collapse(filtered_images)  # 同じ視野の重複は1枚だけ出す
+
+    # 同じ回答者の別セッション（別プロセス）が表示中の画像は出さない
+    if lease_store is not None and not filtered_images.empty:
+        lease_keys = [image_lease_key(username, f, n)
+                      for f, n in zip(filtered_images["フォルダ_norm"], filtered_images["画像ファイル名"])]
+        busy = lease_store.held_by_others(lease_keys, st.session_state.lease_holder)
+        if busy:
+            filtered_images = filtered_images[[k not in busy for k in lease_keys]].reset_index(drop=True)
+
+    # このフォルダの画像URL を裏で確認し（確認済みは飛ばす）、切れている画像は出題しない
+    url_checker.submit(folder_images["画像URL"])
+    dead_urls = url_checker.dead(filtered_images["画像URL"])
+    if dead_urls:
+        filtered_images = filtered_images[~filtered_images["画像URL"].isin(dead_urls)].reset_index(drop=True)
+
+with st.sidebar.expander("画像URLの状態", expanded=False):
+    us = url_checker.stats()
+    st.caption(f"確認済み: 正常 {us['ok']:,} / 遅い {us['slow']:,} / 一時エラー {us['error']:,} / "
+               f"表示不可 {us['dead']:,}（確認中 {us['pending']:,}）")
+    folder_problems = url_checker.problems(folder_images["画像URL"])
+    if folder_problems:
+        st.write("このフォルダで問題のある画像（表示不可は出題から外しています）")
+        names = dict(zip(folder_images["画像URL"], folder_images["画像ファイル名"]))
+        for url, r in folder_problems.items():
+            ms = "" if r["latency_ms"] is None else f" {r['latency_ms']:.0f}ms"
+            st.write(f"- [{r['state']}] {names.get(url, url)}（{r['status'] or '-'}{ms} {r['error']}）")
+    if st.button("全画像のURLを確認する（バックグラウンド）"):
+        st.caption(f"{url_checker.submit(full_image_list()['画像URL']):,} 件を確認中")
 
 # 対象が空なら次フォルダへ
 if filtered_images.empty:
@@ -388,10 +974,7 @@ if "image_files" not in st.session_state:
 
 # 範囲外なら次フォルダへ（バッファ吐き出しも）
 if st.session_state.index >= len(st.session_state.image_files):
-    if st.session_state.buffered_entries:
-        buffered_df = pd.DataFrame(st.session_state.buffered_entries)[required_cols]
-        append_df_to_sheet(log_sheet, buffered_df, "今回の評価")
-        st.session_state.buffered_entries = []
+    flush_buffer()
     st.session_state.folder_index += 1
     st.session_state.pop("image_files", None)
     st.session_state.pop("index", None)
@@ -403,19 +986,110 @@ if st.session_state.index >= len(st.session_state.image_files):
 row = st.session_state.image_files.iloc[st.session_state.index]
 current_file = row["画像ファイル名"]
 current_url  = row["画像URL"]
+if url_checker.dead([current_url]):
+    # フォルダを読み込んだ後に表示不可と分かった画像は飛ばす（スキップログには書かない）
+    st.session_state.index += 1
+    st.rerun()
 folder_for_this_image = row["フォルダ"]          # 表示・時間抽出用（元名）
 folder_norm_this      = row["フォルダ_norm"]     # 判定・保存用（正規化名）
+if lease_store is not None and not lease_store.acquire(image_lease_key(username, folder_norm_this, current_file),
+                                                       st.session_state.lease_holder):
+    # フォルダを読み込んだ後に別セッションが表示し始めた画像は飛ばす
+    st.session_state.index += 1
+    st.rerun()
+save_cursor(username)  # 表示中の位置を永続化（再接続時はここから再開）
 
 st.progress((st.session_state.index + 1) / len(st.session_state.image_files))
-st.image(current_url, use_container_width=True)
-
-col1, col2, col3, col4 = st.columns(4)
-val_1 = col1.number_input("\u2460未融合", min_value=0, max_value=1000, step=1, key=f"val1_{current_file}")
-val_2 = col2.number_input("\u2461接触",   min_value=0, max_value=1000, step=1, key=f"val2_{current_file}")
-val_3 = col3.number_input("\u2462融合中", min_value=0, max_value=1000, step=1, key=f"val3_{current_file}")
-val_4 = col4.number_input("\u2463完全融合", min_value=0, max_value=1000, step=1, key=f"val4_{current_file}")
-
-colA, colB, colC = st.columns(3)
+tile_meta = tile_store.meta(current_url) if tile_mode else None
+if tile_meta is not None:
+    # 最初は画面サイズのプレビュー。拡大時は表示範囲のタイルだけ読んで合成
+    zoom_opts = tile_store.zoom_options(tile_meta)
+    zoom = st.select_slider("拡大", options=zoom_opts, value=1, format_func=lambda z: f"×{z}",
+                            key=f"zoom_{current_file}") if len(zoom_opts) > 1 else 1
+    cx = cy = 0.5
+    if zoom > 1:
+        pan_x, pan_y = st.columns(2)
+        cx = pan_x.slider("左右", 0.0, 1.0, 0.5, 0.05, key=f"cx_{current_file}")
+        cy = pan_y.slider("上下", 0.0, 1.0, 0.5, 0.05, key=f"cy_{current_file}")
+    st.image(tile_store.view(current_url, zoom, cx, cy), use_container_width=True)
+else:
+    # 共有キャッシュから表示（取得できなければブラウザに URL を直接渡す）
+    image_bytes = image_cache.get(current_url)
+    if image_bytes is None:
+        url_checker.record_failure(current_url, "表示時に取得できません")
+        url_checker.submit([current_url])
+    st.image(image_bytes or current_url, use_container_width=True)
+    if tile_mode:
+        tile_store.build_in_background(current_url)
+if st.session_state.index + 1 < len(st.session_state.image_files):
+    image_cache.prefetch(st.session_state.image_files.iloc[st.session_state.index + 1]["画像URL"])
+
+# 事前推定があれば初期値に入れる（評価者は確認・修正するだけ）
+estimate_store = get_estimate_store()
+est = estimate_store.get(folder_norm_this, current_file) if estimate_store is not None else None
+if est is not None:
+    st.caption("自動推定の件数を入力済みです。画像と見比べて確認・修正してください。")
+e1, e2, e3, e4 = (int(v or 0) for v in est) if est is not None else (0, 0, 0, 0)
+
+def submit_counts(username, folder_for_this_image, folder_norm_this, current_file, estimate=None):
+    """「進む →」（フォーム送信）のコールバック。送信1回 = 再実行1回で次の画像を描く
+
+    estimate は初期値に入れた推定件数（無ければ None）。推定のまま送ったかを 推定値の採用 に残す。
+    """
+    vals = [int(st.session_state.get(f"val{i}_{current_file}", 0) or 0) for i in range(1, 5)]
+    if sum(vals) == 0:
+        st.session_state.count_warning = True
+        return
+    new_entry = {
+        "回答者": username,
+        "親フォルダ": "mix",
+        "時間": time_from_folder(folder_for_this_image),  # 元名から抽出でOK
+        "選択フォルダ": folder_norm_this,                 # ★正規化名で保存
+        "画像ファイル名": current_file,
+        "①未融合": vals[0],
+        "②接触": vals[1],
+        "③融合中": vals[2],
+        "④完全融合": vals[3],
+        "推定値": None if estimate is None else ",".join(map(str, estimate)),
+        "採用": None if estimate is None else ("そのまま" if vals == list(estimate) else "修正"),
+    }
+    # 同一画像の重複をバッファ内で除去してから追加（正規化キーで判定）
+    st.session_state.buffered_entries = [
+        e for e in st.session_state.buffered_entries
+        if not (e["選択フォルダ"] == folder_norm_this and e["画像ファイル名"] == current_file)
+    ]
+    st.session_state.buffered_entries.append(new_entry)
+
+    # セッション内回答セットも更新（正規化名で）
+    st.session_state.answered_pairs_session.add((folder_norm_this, current_file))
+
+    # 入力リセット
+    for i in range(1, 5):
+        st.session_state.pop(f"val{i}_{current_file}", None)
+
+    # 10件で保存（書込み回数を抑制）
+    if len(st.session_state.buffered_entries) >= 10:
+        flush_buffer()
+        st.session_state.flash_saved = True
+
+    st.session_state.index += 1
+
+# 4つの件数と「進む →」はフォームにまとめる（入力中は再実行しない。Enter でも送信）
+with st.form(key=f"counts_{current_file}", border=False):
+    col1, col2, col3, col4 = st.columns(4)
+    col1.number_input("\u2460未融合", min_value=0, max_value=1000, value=e1, step=1, key=f"val1_{current_file}")
+    col2.number_input("\u2461接触",   min_value=0, max_value=1000, value=e2, step=1, key=f"val2_{current_file}")
+    col3.number_input("\u2462融合中", min_value=0, max_value=1000, value=e3, step=1, key=f"val3_{current_file}")
+    col4.number_input("\u2463完全融合", min_value=0, max_value=1000, value=e4, step=1, key=f"val4_{current_file}")
+    st.form_submit_button("進む →", type="primary", use_container_width=True, on_click=submit_counts,
+                          args=(username, folder_for_this_image, folder_norm_this, current_file,
+                                (e1, e2, e3, e4) if est is not None else None))
+if st.session_state.pop("count_warning", False):
+    st.warning("少なくとも1つは分類してください")
+if st.session_state.pop("flash_saved", False):
+    st.sidebar.success("保存しました（append-only）")
+
+colA, colB = st.columns(2)
 
 # 戻る
 with colA:
@@ -446,55 +1120,46 @@ with colB:
         st.session_state.index += 1
         st.rerun()
 
-# 進む
-with colC:
-    if st.button("進む →"):
-        if val_1 + val_2 + val_3 + val_4 == 0:
-            st.warning("少なくとも1つは分類してください")
-        else:
-            new_entry = {
-                "回答者": username,
-                "親フォルダ": "mix",
-                "時間": time_from_folder(folder_for_this_image),  # 元名から抽出でOK
-                "選択フォルダ": folder_norm_this,                 # ★正規化名で保存
-                "画像ファイル名": current_file,
-                "①未融合": val_1,
-                "②接触": val_2,
-                "③融合中": val_3,
-                "④完全融合": val_4
-            }
-            # 同一画像の重複をバッファ内で除去してから追加（正規化キーで判定）
-            st.session_state.buffered_entries = [
-                e for e in st.session_state.buffered_entries
-                if not (e["選択フォルダ"] == folder_norm_this and e["画像ファイル名"] == current_file)
-            ]
-            st.session_state.buffered_entries.append(new_entry)
-
-            # セッション内回答セットも更新（正規化名で）
-            st.session_state.answered_pairs_session.add((folder_norm_this, current_file))
-
-            # 入力リセット
-            for i in range(1, 5):
-                k = f"val{i}_{current_file}"
-                if k in st.session_state:
-                    del st.session_state[k]
-
-            # 10件で保存（書込み回数を抑制）
-            if len(st.session_state.buffered_entries) >= 10:
-                buffered_df = pd.DataFrame(st.session_state.buffered_entries)[required_cols]
-                append_df_to_sheet(log_sheet, buffered_df, "今回の評価")
-                st.session_state.buffered_entries = []
-                st.sidebar.success("保存しました（append-only）")
-
-            st.session_state.index += 1
-            st.rerun()
+def bulk_skip(username, widget_key):
+    """「まとめてスキップ」のコールバック。範囲の画像を1回の追記でスキップログへ書き、出題から外す"""
+    ss = st.session_state
+    files, pos = ss.image_files, ss.index
+    first, last = ss.get(f"bulk_range_{widget_key}", (pos + 1, len(files)))
+    reason = ss.get(f"bulk_reason_{widget_key}", SKIP_REASONS[0])
+    target = files.iloc[first - 1:last]
+    entries, keys = [], set()
+    for folder, folder_norm, name in zip(target["フォルダ"], target["フォルダ_norm"], target["画像ファイル名"]):
+        key = (username, folder_norm, name)
+        # 既にスキップ済み・このセッションで回答済みの画像は書かない
+        if key in ss.skip_keys or key in keys or (folder_norm, name) in ss.answered_pairs_session:
+            continue
+        keys.add(key)
+        entries.append({"回答者": username, "親フォルダ": "mix", "時間": time_from_folder(folder),
+                        "選択フォルダ": folder_norm, "画像ファイル名": name, "スキップ理由": reason})
+    if entries:
+        append_df_to_sheet(log_sheet, pd.DataFrame(entries)[skip_cols], "スキップログ")
+        ss.skip_keys |= keys
+    # 範囲の画像を一覧から外し、表示位置は「今の画像（外したなら範囲の次の画像）」に合わせる
+    keep = [i for i in range(len(files)) if not first - 1 <= i < last]
+    ss.image_files = files.iloc[keep].reset_index(drop=True)
+    ss.index = sum(1 for i in keep if i < pos)
+    ss.bulk_skipped = len(entries)
+
+with st.expander("まとめてスキップ（フォルダの残り・範囲）", expanded=False):
+    n_files, pos = len(st.session_state.image_files), st.session_state.index
+    with st.form(key=f"bulk_skip_{current_file}", border=False):
+        st.selectbox("理由", SKIP_REASONS, key=f"bulk_reason_{current_file}")
+        if n_files - pos > 1:
+            st.select_slider("範囲（このフォルダの何枚目から何枚目まで）", options=list(range(pos + 1, n_files + 1)),
+                             value=(pos + 1, n_files), key=f"bulk_range_{current_file}")
+        st.caption(f"既定はこの画像からフォルダの最後まで（{n_files - pos} 枚）。1回の書き込みで記録します。")
+        st.form_submit_button("スキップする", on_click=bulk_skip, args=(username, current_file))
+if "bulk_skipped" in st.session_state:
+    st.sidebar.success(f"{st.session_state.pop('bulk_skipped')} 枚をまとめてスキップしました")
 
 # 途中保存
 if st.sidebar.button("途中保存"):
-    if st.session_state.buffered_entries:
-        buffered_df = pd.DataFrame(st.session_state.buffered_entries)[required_cols]
-        append_df_to_sheet(log_sheet, buffered_df, "今回の評価")
-        st.session_state.buffered_entries = []
+    if flush_buffer():
         st.success("途中保存しました（append-only）")
     else:
         st.info("保存対象はありません。")
@@ -5,13 +5,14 @@ import random
 import re
 import gspread
 from google.oauth2.service_account import Credentials
+from fusion_transport import authorize
 
 # === Google Sheets 設定 ===
 IMAGE_SHEET_ID = "1gDGW6B3Sj9piVHN5vEvQ9JlMp2BjGhdnyL32R7MdF8I"
 LOG_SHEET_ID = "1enxtvK8528BrDxkvuPRcMlJwBHKtek75eQQSa0K2Xm8"
 scope = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
 credentials = Credentials.from_service_account_info(st.secrets["gcp_service_account"], scopes=scope)
-gc = gspread.authorize(credentials)
+gc = authorize(credentials)   # 接続・トークンは再実行をまたいで共有（fusion_transport）
 image_sheet = gc.open_by_key(IMAGE_SHEET_ID)
 log_sheet = gc.open_by_key(LOG_SHEET_ID)
 
@@ -20,7 +21,7 @@ skip_cols = ["回答者", "親フォルダ", "時間", "選択フォルダ", "
 
 @st.cache_data(ttl=60)
 def load_ws_data(sheet_id: str, ws_name: str, header_cols: list) -> pd.DataFrame:
-    gc = gspread.authorize(credentials)
+    gc = authorize(credentials)
     sheet = gc.open_by_key(sheet_id)
     try:
         ws = sheet.worksheet(ws_name)
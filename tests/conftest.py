@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+# テストからリポジトリ直下の fusion_*.py を import できるようにする
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import re
+
+import gspread
+import pandas as pd
+import pytest
+
+import fusion_archive
+from fusion_archive import run_archive, DIGEST_WS
+from fusion_schema import TABLE_COLS
+
+EVAL_COLS = TABLE_COLS["今回の評価"]
+IMAGES = pd.DataFrame({"フォルダ_norm": ["A", "A", "B"], "画像ファイル名": ["a1", "a2", "b1"]})
+
+def row(user, folder, name):
+    return [user, "mix", "", folder, name, "1", "0", "0", "0"]
+
+class FakeWorksheet:
+    def __init__(self, title, sheet_id, values):
+        self.title, self.id, self.values = title, sheet_id, values
+
+    def append_rows(self, rows, value_input_option=None):
+        self.values += [[str(c) for c in r] for r in rows]
+
+    def update(self, cell, values):
+        self.values[:1] = values
+
+class FakeSheet:
+    """run_archive が使う分だけの Spreadsheet。after_read は最初の読み込み直後に1回だけ呼ぶ"""
+
+    def __init__(self, tables):
+        self.ws = {name: FakeWorksheet(name, i, [list(r) for r in rows]) for i, (name, rows) in enumerate(tables.items())}
+        self.after_read = None
+        self.deletes = 0
+
+    def worksheet(self, name):
+        if name not in self.ws:
+            raise gspread.exceptions.WorksheetNotFound(name)
+        return self.ws[name]
+
+    def add_worksheet(self, title, rows, cols):
+        self.ws[title] = FakeWorksheet(title, len(self.ws), [])
+        return self.ws[title]
+
+    def values_batch_get(self, ranges):
+        out = []
+        for r in ranges:
+            name, a1 = r.rsplit("!", 1)
+            lo = int(re.match(r"[A-Z]+(\d+)", a1).group(1)) - 1
+            ws = self.ws.get(name.strip("'"))
+            out.append({"values": [list(v) for v in ws.values[lo:]] if ws else []})
+        if self.after_read:
+            hook, self.after_read = self.after_read, None
+            hook(self)
+        return {"valueRanges": out}
+
+    def fetch_sheet_metadata(self, params=None):
+        return {"sheets": [{"properties": {"sheetId": w.id, "title": w.title,
+                                           "gridProperties": {"rowCount": 1000, "columnCount": 9}}}
+                           for w in self.ws.values()]}
+
+    def batch_update(self, body):
+        by_id = {w.id: w for w in self.ws.values()}
+        for req in body["requests"]:
+            rng = req["deleteDimension"]["range"]
+            del by_id[rng["sheetId"]].values[rng["startIndex"]:rng["endIndex"]]
+        self.deletes += 1
+
+@pytest.fixture(autouse=True)
+def archive_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(fusion_archive, "ARCHIVE_DIR", str(tmp_path))
+
+def _sheet(eval_rows):
+    return FakeSheet({"今回の評価": [EVAL_COLS] + eval_rows, "スキップログ": [TABLE_COLS["スキップログ"]]})
+
+def test_completed_rows_are_deleted_and_appended_rows_kept():
+    sheet = _sheet([row("u", "A", "a1"), row("u", "B", "b1"), row("u", "A", "a2")])
+    sheet.after_read = lambda s: s.ws["今回の評価"].append_rows([row("v", "A", "a1")])
+    summary = run_archive(sheet, IMAGES, completed_only=True)
+    assert summary["今回の評価"][:2] == (3, 0)
+    assert sheet.ws["今回の評価"].values[1:] == [row("v", "A", "a1")]
+    assert len(sheet.ws[DIGEST_WS].values) == 3   # ヘッダー + (u, A) + (u, B)
+
+def test_rows_rewritten_after_read_abort_the_delete():
+    rows = [row("u", "A", "a1"), row("u", "A", "a2"), row("w", "B", "b1")]
+    sheet = _sheet(list(rows))
+    sheet.after_read = lambda s: s.ws["今回の評価"].values.pop(1)   # 重複削除などで行がずれる
+    with pytest.raises(RuntimeError):
+        run_archive(sheet, IMAGES, completed_only=True)
+    assert sheet.deletes == 0
+    assert sheet.ws["今回の評価"].values[1:] == rows[1:]
+
+def test_rerun_after_abort_does_not_digest_twice():
+    rows = [row("u", "A", "a1"), row("u", "A", "a2")]
+    sheet = _sheet(list(rows))
+    sheet.after_read = lambda s: s.ws["今回の評価"].values.__setitem__(2, row("x", "A", "a2"))
+    with pytest.raises(RuntimeError):
+        run_archive(sheet, IMAGES, keep_recent=0)
+    digest = [list(r) for r in sheet.ws[DIGEST_WS].values]
+    sheet.ws["今回の評価"].values[2] = row("u", "A", "a2")
+    summary = run_archive(sheet, IMAGES, keep_recent=0)
+    assert summary["今回の評価"] == (2, 0, None)
+    assert sheet.ws[DIGEST_WS].values == digest
+    assert sheet.ws["今回の評価"].values == [EVAL_COLS]
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import pandas as pd
+
+from fusion_changelog import ChangeLog
+from fusion_schema import frame_to_typed, required_cols
+from fusion_tablecache import TableCache
+
+def _typed(*names):
+    rows = [["u", "mix", "10min", "condA_10min", n, "1", "0", "0", "0"] for n in names]
+    return frame_to_typed(pd.DataFrame(rows, columns=required_cols), "今回の評価")
+
+def test_merged_adds_only_entries_after_base_version():
+    log = ChangeLog()
+    log.record("今回の評価", _typed("a"))
+    base_version = log.version
+    log.record("今回の評価", _typed("b"))
+    log.record("スキップログ", _typed("x"))
+    out = log.merged("今回の評価", _typed("base"), base_version, "t0")
+    assert out["画像ファイル名"].tolist() == ["base", "b"]
+
+def test_merged_starts_from_newer_replace():
+    log = ChangeLog()
+    log.record("今回の評価", _typed("a"))
+    log.replace("今回の評価", _typed("r"))
+    log.record("今回の評価", _typed("c"))
+    out = log.merged("今回の評価", _typed("base"), 0, "t0")
+    assert out["画像ファイル名"].tolist() == ["r", "c"]
+
+def test_merged_result_is_cached_until_version_changes():
+    log = ChangeLog()
+    base = _typed("base")
+    first = log.merged("今回の評価", base, 0, "t0")
+    assert log.merged("今回の評価", base, 0, "t0") is first
+    log.record("今回の評価", _typed("d"))
+    assert log.merged("今回の評価", base, 0, "t0")["画像ファイル名"].tolist() == ["base", "d"]
+
+class _Sheet:
+    def get_lastUpdateTime(self):
+        return "2026-01-01T00:00:00Z"
+
+def test_table_cache_returns_saved_version(tmp_path):
+    cache = TableCache(str(tmp_path))
+    fetched = cache.cached("log", _Sheet(), lambda: ({"t": _typed("a")}, []), version=3)
+    assert fetched[2] == 3
+    frames, issues, version = cache.cached("log", _Sheet(), lambda: ({"t": _typed("b")}, []), version=9)
+    assert version == 3 and frames["t"]["画像ファイル名"].tolist() == ["a"]
+
+def test_table_cache_rejects_save_invalidated_during_fetch(tmp_path):
+    cache = TableCache(str(tmp_path))
+
+    def fetch():
+        cache.invalidate("log")   # 読んでいる間に書き込みがあった
+        return {"t": _typed("old")}, []
+
+    cache.cached("log", _Sheet(), fetch)
+    assert cache.load("log", _Sheet().get_lastUpdateTime()) is None
+    cache.cached("log", _Sheet(), lambda: ({"t": _typed("new")}, []))
+    assert cache.load("log", _Sheet().get_lastUpdateTime())[0]["t"]["画像ファイル名"].tolist() == ["new"]
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from fusion_estimate import label_components
+
+def _flood(mask):
+    """画素ごとの幅優先探索（8連結）で (面積, 幅, 高さ) を出す参照実装"""
+    h, w = mask.shape
+    seen = np.zeros_like(mask, dtype=bool)
+    out = []
+    for y0, x0 in zip(*np.nonzero(mask)):
+        if seen[y0, x0]:
+            continue
+        seen[y0, x0] = True
+        stack, pix = [(y0, x0)], []
+        while stack:
+            y, x = stack.pop()
+            pix.append((y, x))
+            for dy in (-1, 0, 1):
+                for dx in (-1, 0, 1):
+                    ny, nx = y + dy, x + dx
+                    if 0 <= ny < h and 0 <= nx < w and mask[ny, nx] and not seen[ny, nx]:
+                        seen[ny, nx] = True
+                        stack.append((ny, nx))
+        ys, xs = zip(*pix)
+        out.append((len(pix), max(xs) - min(xs) + 1, max(ys) - min(ys) + 1))
+    return sorted(out)
+
+def _sorted(comps):
+    return sorted(map(tuple, comps.tolist()))
+
+def test_empty_mask():
+    assert label_components(np.zeros((4, 5), dtype=bool)).shape == (0, 3)
+
+def test_diagonal_touch_is_one_component():
+    mask = np.array([[1, 0, 0],
+                     [0, 1, 0],
+                     [0, 0, 1]], dtype=bool)
+    assert _sorted(label_components(mask)) == [(3, 3, 3)]
+
+def test_u_shape_joins_runs_found_later():
+    # 2本の縦棒は最下行で初めてつながる
+    mask = np.array([[1, 0, 0, 1],
+                     [1, 0, 0, 1],
+                     [1, 1, 1, 1]], dtype=bool)
+    assert _sorted(label_components(mask)) == [(8, 4, 3)]
+
+def test_matches_flood_fill_on_random_masks():
+    rng = np.random.default_rng(0)
+    for _ in range(30):
+        mask = rng.random((rng.integers(1, 25), rng.integers(1, 25))) < 0.45
+        assert _sorted(label_components(mask)) == _flood(mask)
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from fusion_imagelist import LazyImageList, FolderIndex, StaleIndexError
+
+HEADER = ["フォルダ", "画像ファイル名", "画像URL"]
+
+class FakeSheet:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def values_batch_get(self, ranges):
+        return {"valueRanges": [{"values": [HEADER] + self.rows}]}
+
+def _rows(*folders):
+    return [[f, f"{f}_{i}.png", f"/img/{f}_{i}.png"] for i, f in enumerate(folders)]
+
+def test_full_matches_index_and_is_sliced():
+    index = FolderIndex(["a", "b"], [0, 2], [2, 1])
+    lazy = LazyImageList(FakeSheet(_rows("a", "a", "b")))
+    assert len(lazy.full(index)) == 3
+    assert lazy.rows(index, "b")["画像ファイル名"].tolist() == ["b_2.png"]
+
+def test_full_rejects_rows_appended_after_index():
+    index = FolderIndex(["a", "b"], [0, 2], [2, 1])
+    lazy = LazyImageList(FakeSheet(_rows("a", "a", "b", "a")))
+    with pytest.raises(StaleIndexError):
+        lazy.full(index)
+    assert lazy.stale and lazy.load_index() is None
+
+def test_full_rejects_rows_moved_within_range():
+    index = FolderIndex(["a", "b"], [0, 2], [2, 1])
+    lazy = LazyImageList(FakeSheet(_rows("a", "b", "a")))
+    with pytest.raises(StaleIndexError, match="3行目"):
+        lazy.full(index)
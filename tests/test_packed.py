@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import pandas as pd
+
+import fusion_packed
+from fusion_packed import pack_rows, unpack_values, packed_cols
+from fusion_schema import parse_table, required_cols
+
+def _frame(rows):
+    values = [required_cols] + rows
+    df, _ = parse_table(values, required_cols, "今回の評価")
+    return df
+
+ROWS = [
+    ["u1", "mix", "10min", "condA_10min", "a.png", "1", "0", "2", "0"],
+    ["u2", "mix", "10min", "condA_10min", "b.png", "0", "", "0", "3"],
+    ["u1", "mix", "45min", "condB_30min", "c.png", "5", "1", "0", "0"],   # フォルダ名と違う時間
+    ["u1", "other", "", "misc", "日本語.tif", "0", "0", "0", "1000"],
+]
+
+def _round_trip(rows_packed):
+    values, issues = unpack_values([packed_cols] + rows_packed)
+    assert issues == []
+    return _frame(values[1:])
+
+def test_round_trip_keeps_every_column():
+    df = _frame(ROWS)
+    back = _round_trip(pack_rows(df))
+    pd.testing.assert_frame_equal(back, df)
+
+def test_round_trip_splits_large_payloads(monkeypatch):
+    monkeypatch.setattr(fusion_packed, "PAYLOAD_LIMIT", 120)
+    df = _frame(ROWS * 5)
+    packed = pack_rows(df)
+    assert len(packed) > 1
+    assert sum(int(r[2]) for r in packed) == len(df)
+    pd.testing.assert_frame_equal(_round_trip(packed), df)
+
+def test_users_cell_lists_answerers():
+    assert pack_rows(_frame(ROWS))[0][0] == "u1,u2"
+
+def test_bad_payload_is_reported():
+    values, issues = unpack_values([packed_cols, ["u1", "z1", "1", "not-base64!"], ["u1", "z9", "1", "x"]])
+    assert values == [required_cols]
+    assert [i.split("（")[0] for i in issues] == ["今回の評価_packed: 2行目 復号できません",
+                                                  "今回の評価_packed: 3行目 復号できません"]
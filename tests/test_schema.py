@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from fusion_schema import parse_table, required_cols, count_cols
+
+def _row(name, *counts):
+    return ["u", "mix", "10min", "condA_10min", name, *counts]
+
+def test_parse_table_reports_clamped_and_rounded_counts():
+    df, issues = parse_table([required_cols, _row("a.png", "-3", "70000", "1.6", "2")], required_cols, "今回の評価")
+    assert df[count_cols].iloc[0].tolist() == [0, 65535, 2, 2]
+    assert issues == ["今回の評価: 2行目 ①未融合 を 0 に丸めました（'-3'）",
+                      "今回の評価: 2行目 ②接触 を 65535 に丸めました（'70000'）",
+                      "今回の評価: 2行目 ③融合中 を 2 に丸めました（'1.6'）"]
+
+def test_parse_table_keeps_valid_counts_quiet():
+    df, issues = parse_table([required_cols, _row("a.png", "0", "3", "2.0", "")], required_cols, "今回の評価")
+    assert issues == []
+    assert df["③融合中"].iat[0] == 2 and df["④完全融合"].isna().iat[0]
+
+def test_parse_table_reports_non_numeric_and_blank_keys():
+    values = [required_cols, _row("a.png", "x", "1", "1", "1"), _row("", "1", "1", "1", "1")]
+    df, issues = parse_table(values, required_cols, "今回の評価")
+    assert len(df) == 1 and df["①未融合"].isna().iat[0]
+    assert "今回の評価: 2行目 ①未融合 が数値ではありません（'x'）" in issues
+    assert "今回の評価: 3行目 キー列が空のため除外" in issues
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import time
+
+import pandas as pd
+
+import fusion_shared as fs
+from fusion_shared import LeaseStore, WriteQueue
+
+def _df():
+    return pd.DataFrame({"回答者": ["u", "u"], "画像ファイル名": ["a.png", "b.png"]})
+
+def test_lease_blocks_other_holder_until_released(tmp_path):
+    leases = LeaseStore(str(tmp_path / "s.sqlite"))
+    assert leases.acquire("k", "s1")
+    assert not leases.acquire("k", "s2")
+    assert leases.held_by_others(["k", "x"], "s2") == {"k"}
+    leases.release(["k"], "s1")
+    assert leases.acquire("k", "s2")
+
+def test_lease_expires(tmp_path):
+    leases = LeaseStore(str(tmp_path / "s.sqlite"))
+    assert leases.acquire("k", "s1", ttl=-1)
+    assert leases.acquire("k", "s2")
+
+def test_transfer_only_from_idle_holder(tmp_path):
+    leases = LeaseStore(str(tmp_path / "s.sqlite"))
+    leases.acquire("k", "old")
+    assert not leases.transfer("old", "new")              # まだ動いている
+    assert leases.held_by_others(["k"], "new") == {"k"}
+    assert leases.transfer("old", "new", idle=-1)
+    assert leases.held_by_others(["k"], "old") == {"k"}
+
+def test_hold_is_exclusive_per_call(tmp_path):
+    leases = LeaseStore(str(tmp_path / "s.sqlite"))
+    with leases.hold("fetch") as got:
+        assert got
+        with leases.hold("fetch", wait=0) as again:
+            assert not again
+    with leases.hold("fetch", wait=0) as got:
+        assert got
+
+def test_claim_is_exclusive_and_marks_sent_items(tmp_path):
+    q = WriteQueue(str(tmp_path / "s.sqlite"))
+    i = q.enqueue("sheet", "今回の評価", _df())
+    (item,) = q.claim("w1", [i])
+    assert item[0] == i and item[3].equals(_df()) and item[4] is None
+    assert q.claim("w2", [i]) == []                        # w1 が引き取り中
+    q.mark_sending(i, "今回の評価", 10)
+    q.mark_sending(i, "今回の評価", 12)                    # 最初の送信の行数を残す
+    q.fail(i, "timeout")
+    (item,) = q.claim("w2", [i])
+    assert item[4] == ("今回の評価", 10)
+
+def test_expired_claim_is_returned_as_maybe_sent(tmp_path):
+    q = WriteQueue(str(tmp_path / "s.sqlite"))
+    i = q.enqueue("sheet", "スキップログ", _df())
+    q.claim("w1", [i], claim_sec=0.05)
+    time.sleep(0.1)
+    (item,) = q.claim("w2", [i])
+    assert item[4] == (None, 0)                          # 送信前の行数が分からない古い形
+
+def test_keep_claim_renews_while_sending(tmp_path):
+    q = WriteQueue(str(tmp_path / "s.sqlite"))
+    i = q.enqueue("sheet", "スキップログ", _df())
+    q.claim("w1", [i], claim_sec=0.3)
+    with q.keep_claim(i, "w1", claim_sec=0.3):
+        time.sleep(0.5)
+        assert q.claim("w2", [i]) == []
+    q.done(i)
+    assert q.stats()["items"] == 0
+
+def test_dead_letter_after_max_attempts_or_permanent_failure(tmp_path):
+    q = WriteQueue(str(tmp_path / "s.sqlite"))
+    i = q.enqueue("sheet", "スキップログ", _df())
+    j = q.enqueue("sheet", "スキップログ", _df())
+    for _ in range(fs.MAX_ATTEMPTS):
+        q.fail(i, "boom")
+    q.fail(j, "NaN", permanent=True)
+    assert q.stats()["dead"] == 2
+    assert q.claim("w1", [i, j]) == []
+    assert q.requeue_dead() == 2
+    assert len(q.claim("w1")) == 2